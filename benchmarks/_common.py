@@ -0,0 +1,82 @@
+#Shared helpers for the benchmarks: imports, timing and reporting
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "db_backup")
+sys.path.insert(0, PACKAGE_DIR)
+# Benchmarks always run against the simulated server
+os.environ["DB_BACKUP_DRIVER"] = "fake"
+
+
+class Result:
+    """One measured number"""
+
+    def __init__(self, name, value, unit, **details):
+        self.name = name
+        self.value = value
+        self.unit = unit
+        self.details = details
+
+    def describe(self):
+        extra = ", ".join(f"{k}={v}" for k, v in self.details.items())
+        return f"{self.name:<48} {self.value:>14,.2f} {self.unit:<12} {extra}"
+
+    def as_dict(self):
+        return {"name": self.name, "value": self.value, "unit": self.unit, **self.details}
+
+
+@contextmanager
+def scratch_dir(prefix="db_backup_bench_"):
+    path = tempfile.mkdtemp(prefix=prefix)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class Stopwatch:
+    def __init__(self):
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def write_random_file(path, size, chunk=4 * 1024 * 1024):
+    """A file of ``size`` bytes that compresses like a real, partly empty backup"""
+    block = os.urandom(chunk // 2) + bytes(chunk // 2)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+    return path
+
+
+def main(run, argv=None):
+    """Command line of every benchmark module: run it and print or save the results"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quick", action="store_true", help="smaller workloads, for a smoke test")
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    args = parser.parse_args(argv)
+    results = run(quick=args.quick)
+    for result in results:
+        print(result.describe())
+    if args.json:
+        save(results, args.json)
+    return 0
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump({"python": platform.python_version(), "platform": platform.platform(),
+                   "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "results": [r.as_dict() for r in results]}, f, indent=2)
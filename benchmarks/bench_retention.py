@@ -0,0 +1,72 @@
+#Retention planning over directories with 10k backup files
+import datetime
+import logging
+import os
+
+from _common import Result, Stopwatch, main, scratch_dir
+
+from catalog import Catalog
+from retention import RetentionPolicy, backup_sets, plan_retention, prune_backups
+
+
+def populate(directory, databases, sets_per_database):
+    """Empty files named like a nightly full, a diff at noon and six-hourly logs.
+
+    The sets span weeks, so the GFS policy below has whole chains to delete.
+    """
+    start = datetime.datetime(2024, 1, 1)
+    count = 0
+    for d in range(databases):
+        for i in range(sets_per_database):
+            taken = start + datetime.timedelta(hours=6 * i)
+            if i % 4 == 0:
+                extension = ".bak"
+            elif i % 4 == 2:
+                extension = ".dif"
+            else:
+                extension = ".trn"
+            open(os.path.join(directory, f"db{d:03d}_{taken:%Y%m%d_%H%M%S}{extension}"), 'w').close()
+            count += 1
+    return count
+
+
+def run(quick=False):
+    logging.disable(logging.INFO)
+    databases, per_database = (10, 100) if quick else (50, 200)
+    policy = RetentionPolicy(keep_last=2, keep_daily=7, keep_weekly=4, keep_monthly=3)
+    results = []
+    with scratch_dir() as directory:
+        files = populate(directory, databases, per_database)
+
+        watch = Stopwatch()
+        for d in range(databases):
+            plan_retention(backup_sets([directory], f"db{d:03d}"), policy, f"db{d:03d}")
+        results.append(Result(f"retention: plan from directory scan, {files} files",
+                              watch.elapsed / databases * 1000, "ms/database"))
+
+        catalog = Catalog(os.path.join(directory, "catalog.db"))
+        watch = Stopwatch()
+        for d in range(databases):
+            catalog.reconcile([directory], f"db{d:03d}")
+        results.append(Result(f"retention: initial catalog reconcile, {files} files",
+                              watch.elapsed, "s"))
+
+        watch = Stopwatch()
+        for d in range(databases):
+            plan_retention(backup_sets([directory], f"db{d:03d}", catalog), policy, f"db{d:03d}")
+        results.append(Result(f"retention: plan from catalog, {files} files",
+                              watch.elapsed / databases * 1000, "ms/database"))
+
+        watch = Stopwatch()
+        deleted = 0
+        for d in range(databases):
+            plan = prune_backups([directory], f"db{d:03d}", policy, catalog)
+            deleted += len(plan.sets)
+        results.append(Result("retention: prune with the catalog", watch.elapsed, "s",
+                              sets_deleted=deleted))
+        catalog.close()
+    return results
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(run))
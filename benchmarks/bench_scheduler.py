@@ -0,0 +1,81 @@
+#How late the scheduler wakes up for a due job, and how much of a window planned batches use
+import datetime
+import logging
+import random
+import statistics
+import threading
+
+from _common import Result, Stopwatch, main
+
+from backup_engine import BackupJob
+from planner import Estimate, plan_jobs
+from scheduler import Scheduler
+
+LEAD = 0.2
+
+
+def wakeup_latency(other_jobs):
+    """Seconds between a job falling due and its function running"""
+    now = datetime.datetime.now()
+    boundary = (now + datetime.timedelta(minutes=1)).replace(second=0, microsecond=0)
+    # Shift the scheduler's clock so the next minute boundary is LEAD seconds away
+    shift = boundary - now - datetime.timedelta(seconds=LEAD)
+    clock = lambda: datetime.datetime.now() + shift
+    fired = threading.Event()
+    woke = []
+
+    def job():
+        woke.append(clock())
+        fired.set()
+
+    scheduler = Scheduler(clock=clock)
+    for i in range(other_jobs):
+        scheduler.add_job(f"idle{i}", f"{i % 60} {i % 24} 1 1 *", lambda: None)
+    scheduler.add_job("probe", "* * * * *", job)
+    scheduler.start()
+    try:
+        fired.wait(LEAD + 5)
+    finally:
+        scheduler.stop()
+    return (woke[0] - boundary).total_seconds() if woke else None
+
+
+def planned_batch(jobs_count, seed=3):
+    """Jobs on four servers, with a few large databases among many small ones"""
+    rng = random.Random(seed)
+    jobs = [BackupJob(f"sql{i % 4}", f"db{i}", "/backups") for i in range(jobs_count)]
+    estimates = {job.name: Estimate(rng.paretovariate(1.2) * 60) for job in jobs}
+    return jobs, estimates
+
+
+def run(quick=False):
+    logging.disable(logging.INFO)
+    samples = 5 if quick else 20
+    results = []
+    for other_jobs in (0, 1000):
+        latencies = [wakeup_latency(other_jobs) for _ in range(samples)]
+        latencies = [l for l in latencies if l is not None]
+        results.append(Result(f"scheduler: wakeup latency, {other_jobs} other jobs",
+                              statistics.median(latencies) * 1000, "ms median",
+                              max_ms=round(max(latencies) * 1000, 2), samples=len(latencies)))
+
+    start = datetime.datetime(2024, 1, 1, 22, 0)
+    jobs, estimates = planned_batch(200)
+    # No job can finish before the longest one, nor the batch before the work spread evenly
+    bound = max(max(e.seconds for e in estimates.values()),
+                sum(e.seconds for e in estimates.values()) / 8)
+    for longest_first in (False, True):
+        watch = Stopwatch()
+        plan = plan_jobs(jobs, estimates, start, max_workers=8, max_jobs_per_volume=8,
+                         longest_first=longest_first)
+        elapsed = watch.elapsed
+        results.append(Result(f"planner: {len(jobs)} jobs, " +
+                              ("longest first" if longest_first else "config order"),
+                              (plan.finish - start).total_seconds() / 3600, "h makespan",
+                              lower_bound_h=round(bound / 3600, 2),
+                              planning_ms=round(elapsed * 1000, 1)))
+    return results
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(run))
@@ -0,0 +1,111 @@
+#Throughput of the post-backup stages: hashing, compression, offsite copies and dedup
+import logging
+import os
+import random
+
+from _common import Result, Stopwatch, main, scratch_dir, write_random_file
+
+from compress import compress_file, decompress_file
+from dedup import DedupRepository
+from manifest import build_manifest, hash_file
+from offsite import OffsiteCopier
+
+MB = 1024 * 1024
+PAGE = 8192
+
+
+def nightly_fulls(directory, size, nights, seed=1):
+    """Full backups of a database that changes a little between nights.
+
+    Every night rewrites 0.5% of the pages in a few hot spots, inserts a few
+    new ones in the middle and gives the file a header of a different
+    length, so most data survives but moves.
+    """
+    rng = random.Random(seed)
+    pages = [rng.randbytes(PAGE // 2) + bytes(PAGE // 2) for _ in range(size // PAGE)]
+    for night in range(nights):
+        run = max(1, len(pages) // 800)
+        for _ in range(4):
+            start = rng.randrange(len(pages) - run)
+            pages[start:start + run] = [rng.randbytes(PAGE) for _ in range(run)]
+        for _ in range(3):
+            pages.insert(rng.randrange(len(pages)), rng.randbytes(PAGE))
+        path = os.path.join(directory, f"bench_202401{night + 1:02d}_230000.bak")
+        with open(path, 'wb') as f:
+            f.write(rng.randbytes(rng.randrange(512, 4096)))
+            for start in range(0, len(pages), 1024):
+                f.write(b"".join(pages[start:start + 1024]))
+        yield path
+
+
+def run(quick=False):
+    logging.disable(logging.INFO)
+    size = (16 if quick else 256) * MB
+    stripes = 4
+    results = []
+
+    def throughput(name, seconds, total, **details):
+        results.append(Result(name, total / seconds / MB, "MB/s", seconds=round(seconds, 2),
+                              **details))
+
+    with scratch_dir() as directory:
+        paths = [write_random_file(os.path.join(directory, f"bench_20240101_000000_{i + 1}of{stripes}.bak"),
+                                   size // stripes)
+                 for i in range(stripes)]
+
+        watch = Stopwatch()
+        hash_file(paths[0])
+        throughput("stage: sha-256, one file", watch.elapsed, size // stripes)
+
+        for workers in (1, stripes):
+            watch = Stopwatch()
+            build_manifest(paths, workers=workers)
+            throughput(f"stage: manifest of {stripes} stripes", watch.elapsed, size,
+                       workers=workers)
+
+        for codec in ("gzip", "zstd"):
+            try:
+                watch = Stopwatch()
+                compressed = compress_file(paths[0], codec, workers=os.cpu_count() or 2)
+            except ValueError:
+                continue
+            elapsed = watch.elapsed
+            throughput(f"stage: {codec} compression", elapsed, size // stripes,
+                       ratio=round(os.path.getsize(compressed) / (size // stripes), 3))
+            watch = Stopwatch()
+            decompress_file(compressed, compressed + ".out")
+            throughput(f"stage: {codec} decompression", watch.elapsed, size // stripes)
+            os.remove(compressed + ".out")
+
+        copier = OffsiteCopier([os.path.join(directory, "offsite")], workers=2)
+        watch = Stopwatch()
+        copier.copy_set(paths)
+        throughput("stage: offsite copy, 2 workers", watch.elapsed, size)
+
+    with scratch_dir() as directory:
+        nights = 5 if quick else 30
+        repository = DedupRepository(os.path.join(directory, "repo"))
+        logical = 0
+        for night, path in enumerate(nightly_fulls(directory, size, nights)):
+            watch = Stopwatch()
+            stored = repository.store(path)
+            elapsed = watch.elapsed
+            logical += stored.size
+            if night in (0, nights - 1):
+                throughput(f"stage: dedup store, night {night + 1}", elapsed, stored.size,
+                           new_bytes=stored.new_bytes)
+            if night < nights - 1:
+                os.remove(path)
+        stats = repository.stats()
+        results.append(Result(f"dedup: {nights} nightly fulls", logical / stats["stored_bytes"],
+                              "x smaller", logical_mb=round(logical / MB),
+                              stored_mb=round(stats["stored_bytes"] / MB)))
+        watch = Stopwatch()
+        repository.restore(stored.name, path + ".out")
+        throughput("stage: dedup restore", watch.elapsed, stored.size)
+        repository.close()
+    return results
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(run))
@@ -0,0 +1,31 @@
+#Run every benchmark: python benchmarks/run_all.py [--quick] [--json results.json]
+import argparse
+
+import _common
+
+import bench_engine
+import bench_retention
+import bench_scheduler
+import bench_stages
+
+BENCHMARKS = [bench_engine, bench_retention, bench_scheduler, bench_stages]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark db_backup against the simulated server.")
+    parser.add_argument("--quick", action="store_true", help="smaller workloads, for a smoke test")
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    args = parser.parse_args(argv)
+
+    results = []
+    for module in BENCHMARKS:
+        for result in module.run(quick=args.quick):
+            print(result.describe())
+            results.append(result)
+    if args.json:
+        _common.save(results, args.json)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
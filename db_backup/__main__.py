@@ -0,0 +1,15 @@
+#Allow running the headless tool as: python -m db_backup <command> (see cli.py)
+import multiprocessing
+import os
+import sys
+
+# The modules import each other as siblings, the same way they do when
+# db_backup.py is started directly or frozen into an executable.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cli import main  # noqa: E402
+
+if __name__ == "__main__":
+    # Lets the compression pool's worker processes start in a frozen executable
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,741 @@
+#Parallel backup engine for many databases across one or more servers
+import datetime
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backup_options import BACKUP_TYPES, BackupOptions, build_backup_query
+from connections import ConnectionManager, build_connection_string
+from metrics import JobMetrics
+from progress import ProgressTracker, estimate_backup_size, follow_backup
+from retention import RetentionPolicy, free_bytes, has_full_backup, prune_backups
+from scheduler import DailyWindow
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_JOBS_PER_SERVER = 2
+DEFAULT_MAX_JOBS_PER_VOLUME = 1
+WATCHDOG_INTERVAL = 5
+# Seconds a cancelled statement gets to stop before its session is killed
+CANCEL_GRACE = 2
+
+# Used when neither the database nor the top level of the config has a "schedule"
+LEGACY_SCHEDULE_KEY = "backup_time"
+
+
+class BackupCancelled(Exception):
+    """Raised inside a job when the engine has been asked to stop"""
+
+
+class RunningJob:
+    """A job in progress as cancellation and the watchdog see it.
+
+    ``session_id`` and ``cursor`` are set while the BACKUP command runs, so
+    a cancel targets exactly this job's session. ``lock`` is held while the
+    session is killed and while the job lets go of it, so a session id the
+    server has already handed to someone else is never killed.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.session_id = None
+        self.cursor = None
+        self.backup_started = None
+        self.last_progress = None
+        self.abort_reason = None
+        self.lock = threading.Lock()
+        self.ended = threading.Event()
+
+    def start_backup(self, session_id, cursor):
+        with self.lock:
+            self.session_id = session_id
+            self.cursor = cursor
+            self.backup_started = self.last_progress = time.monotonic()
+            self.ended.clear()
+
+    def end_backup(self):
+        with self.lock:
+            self.session_id = None
+            self.cursor = None
+            self.backup_started = None
+            self.ended.set()
+
+    def touch(self):
+        self.last_progress = time.monotonic()
+
+    def overdue(self, now=None):
+        """Why the watchdog should abort the running BACKUP, or None"""
+        if self.backup_started is None:
+            return None
+        now = time.monotonic() if now is None else now
+        job = self.job
+        if job.max_duration and now - self.backup_started > job.max_duration:
+            return f"Backup of {job.name} exceeded {job.max_duration / 60:g} minutes"
+        # Without STATS the server reports nothing until it is done
+        if (job.stall_timeout and job.options.stats
+                and now - self.last_progress > job.stall_timeout):
+            return f"Backup of {job.name} made no progress for {job.stall_timeout / 60:g} minutes"
+        return None
+
+
+def session_id(cursor):
+    """The server session a connection runs in"""
+    cursor.execute("SELECT @@SPID")
+    return int(cursor.fetchone()[0])
+
+
+def volume_of(path):
+    """Return a key identifying the volume a backup directory lives on"""
+    path = os.path.abspath(path)
+    drive, _ = os.path.splitdrive(path)
+    if drive:
+        # C:, D: or \\server\share on Windows
+        return drive.lower()
+    probe = path
+    while not os.path.exists(probe):
+        parent = os.path.dirname(probe)
+        if parent == probe:
+            break
+        probe = parent
+    try:
+        return f"dev:{os.stat(probe).st_dev}"
+    except OSError:
+        return probe
+
+
+def remove_files(paths, attempts=5, delay=1.0):
+    """Delete partially written backup files, ignoring ones already gone.
+
+    A killed BACKUP can hold its files open for a moment while the server
+    rolls it back, so removal is retried a few times.
+    """
+    for path in paths:
+        for attempt in range(1, attempts + 1):
+            if not os.path.exists(path):
+                break
+            try:
+                os.remove(path)
+                break
+            except OSError as e:
+                if attempt == attempts:
+                    logger.error("Could not remove %s: %s", path, e)
+                else:
+                    time.sleep(delay)
+
+
+def backup_history(cursor, backup_file):
+    """Return the LSN range msdb recorded for the backup written to ``backup_file``"""
+    try:
+        cursor.execute("""
+        SELECT TOP 1 bs.first_lsn, bs.last_lsn, bs.database_backup_lsn
+        FROM msdb.dbo.backupset bs
+        JOIN msdb.dbo.backupmediafamily mf ON mf.media_set_id = bs.media_set_id
+        WHERE mf.physical_device_name = ?
+        ORDER BY bs.backup_finish_date DESC
+        """, (backup_file,))
+        row = cursor.fetchone()
+        if not row:
+            return {}
+        return {"first_lsn": row[0], "last_lsn": row[1], "database_backup_lsn": row[2]}
+    except Exception as e:
+        logger.warning("Could not read backup history for %s: %s", backup_file, e)
+        return {}
+
+
+def kill_session(running, connections, grace=CANCEL_GRACE):
+    """Stop the BACKUP running in exactly the session the job recorded.
+
+    The statement is cancelled on its own connection first, which usually
+    takes effect at once. Only if the job has not let go of its session
+    within ``grace`` seconds is the session killed from a second connection.
+    """
+    cursor = running.cursor
+    if running.session_id is None:
+        # Not started yet; the job checks for cancellation before it starts
+        return
+    if cursor is not None and hasattr(cursor, "cancel"):
+        try:
+            cursor.cancel()
+        except Exception as e:
+            logger.warning("Could not cancel the statement of %s: %s", running.job.name, e)
+    if running.ended.wait(grace):
+        return
+
+    conn = None
+    healthy = False
+    try:
+        conn = connections.acquire(running.job, "master")
+        with running.lock:
+            if running.session_id is None:
+                healthy = True
+                return
+            cursor = conn.cursor()
+            cursor.execute(f"KILL {int(running.session_id)}")
+            cursor.close()
+            healthy = True
+            logger.info("Killed session %s running the backup of %s",
+                        running.session_id, running.job.name)
+    except Exception as e:
+        logger.error("Could not kill the backup session of %s: %s", running.job.name, e)
+    finally:
+        if conn:
+            connections.release(running.job, conn, healthy)
+
+
+class BackupJob:
+    """A single database to back up"""
+
+    def __init__(self, server, database, backup_path, trusted_connection="yes",
+                 username="", password="", retention=None, options=None, backup_type="full",
+                 max_duration=None, stall_timeout=None, window=None):
+        self.server = server
+        self.database = database
+        self.backup_path = backup_path
+        self.trusted_connection = trusted_connection
+        self.username = username
+        self.password = password
+        self.retention = retention or RetentionPolicy()
+        self.options = options or BackupOptions()
+        if backup_type not in BACKUP_TYPES:
+            raise ValueError(f"Unknown backup type: {backup_type}")
+        self.backup_type = backup_type
+        # Seconds; the watchdog aborts a BACKUP running longer or silent for longer
+        self.max_duration = max_duration
+        self.stall_timeout = stall_timeout
+        # The maintenance window the planner fits the job into, if any
+        self.window = DailyWindow(window) if isinstance(window, str) else window
+
+    @property
+    def name(self):
+        return f"{self.server}/{self.database}"
+
+    @property
+    def directories(self):
+        return self.options.directories(self.backup_path)
+
+    @property
+    def volumes(self):
+        """Every volume the job writes to; a striped set may span several"""
+        return frozenset(volume_of(d) for d in self.directories)
+
+    def connection_string(self):
+        return build_connection_string(self.server, self.database, self.trusted_connection,
+                                       self.username, self.password)
+
+    def __repr__(self):
+        return f"BackupJob({self.name!r}, {self.backup_type!r})"
+
+
+class JobResult:
+    """Outcome of one backup job"""
+
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, job, status, backup_files=None, error=None, started=None, finished=None,
+                 backup_type=None, bytes_processed=None):
+        self.job = job
+        self.status = status
+        self.backup_type = backup_type or job.backup_type
+        self.bytes_processed = bytes_processed
+        self.catalog_id = None
+        self.manifest = None
+        self.checksum = None
+        self.metrics = None
+        self.backup_files = list(backup_files or [])
+        self.error = error
+        self.started = started
+        self.finished = finished
+
+    @property
+    def backup_file(self):
+        """The first (or only) file of the backup set"""
+        return self.backup_files[0] if self.backup_files else None
+
+    @property
+    def ok(self):
+        return self.status == self.SUCCEEDED
+
+    @property
+    def duration(self):
+        if self.started and self.finished:
+            return (self.finished - self.started).total_seconds()
+        return None
+
+    def __repr__(self):
+        return f"JobResult({self.job.name!r}, {self.status!r})"
+
+
+def database_settings(config):
+    """Yield the effective settings of every configured database.
+
+    Entries in ``config["databases"]`` inherit any setting they leave out
+    from their server's entry in ``config["servers"]`` and then from the top
+    level, so a plain single-database config still yields one entry.
+    """
+    entries = config.get("databases") or []
+    if not entries and config.get("database"):
+        entries = [{}]
+
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"database": entry}
+        server = server_settings(config, entry.get("server", config.get("server", "localhost")))
+        settings = dict(server)
+        settings.update(entry)
+        if not settings.get("database"):
+            continue
+        for section in ("backup_options", "retention"):
+            settings[section] = dict(server.get(section) or {}, **(entry.get(section) or {}))
+        yield settings
+
+
+def server_settings(config, server):
+    """The top-level settings with the overrides of ``config["servers"][server]``"""
+    overrides = (config.get("servers") or {}).get(server) or {}
+    settings = dict(config, **overrides)
+    settings["server"] = server
+    for section in ("backup_options", "retention"):
+        settings[section] = dict(config.get(section) or {}, **(overrides.get(section) or {}))
+    return settings
+
+
+def jobs_from_config(config, backup_type="full", databases=None):
+    """Build backup jobs of one type from the JSON config.
+
+    ``databases`` limits the jobs to those database names. Raises
+    ValueError when databases of the same name on different servers would
+    write to the same directory, where their backup files are
+    indistinguishable.
+    """
+    jobs = []
+    for settings in database_settings(config):
+        jobs.append(BackupJob(
+            server=settings.get("server", "localhost"),
+            database=settings["database"],
+            backup_path=settings.get("backup_path", ""),
+            trusted_connection=settings.get("trusted_connection", "yes"),
+            username=settings.get("username", ""),
+            password=settings.get("password", ""),
+            retention=RetentionPolicy.from_settings(settings),
+            options=BackupOptions.from_dict(settings["backup_options"]),
+            backup_type=backup_type,
+            max_duration=_minutes(settings.get("max_backup_minutes")),
+            stall_timeout=_minutes(settings.get("stall_minutes")),
+            window=settings.get("maintenance_window"),
+        ))
+    _check_shared_directories(jobs)
+    if databases is not None:
+        jobs = [job for job in jobs if job.database in databases]
+    return jobs
+
+
+def _check_shared_directories(jobs):
+    owners = {}
+    for job in jobs:
+        for directory in job.directories:
+            key = (os.path.normcase(os.path.abspath(directory)), job.database.lower())
+            owner = owners.setdefault(key, job)
+            if owner.server != job.server:
+                raise ValueError(f"{owner.name} and {job.name} both back up to {directory}; "
+                                 "give each server its own backup_path")
+
+
+def _minutes(value):
+    return float(value) * 60 if value else None
+
+
+def schedule_groups(config):
+    """Group databases that share a schedule.
+
+    Returns ``(backup_type, spec, database_names)`` tuples, where ``spec`` is
+    a cron expression such as ``"*/15 * * * *"`` or a simpler schedule such
+    as ``"sunday 23:00"``, ``"daily 23:00"`` or ``"every 15 minutes"``.
+    Databases without a ``"schedule"`` get a daily full backup when their
+    ``maintenance_window`` opens, or else at ``backup_time``, matching the
+    behaviour before chains.
+    """
+    groups = {}
+    for settings in database_settings(config):
+        if settings.get("maintenance_window"):
+            default = DailyWindow(settings["maintenance_window"]).schedule
+        else:
+            default = f"daily {settings.get(LEGACY_SCHEDULE_KEY, '23:00')}"
+        schedule = settings.get("schedule") or {"full": default}
+        for backup_type, spec in schedule.items():
+            if backup_type not in BACKUP_TYPES:
+                raise ValueError(f"Unknown backup type in schedule: {backup_type}")
+            if spec:
+                groups.setdefault((backup_type, spec), []).append(settings["database"])
+    return [(backup_type, spec, names) for (backup_type, spec), names in groups.items()]
+
+
+def server_limits(config):
+    """{server: max_jobs_per_server} for the servers overriding the default"""
+    return {server: overrides["max_jobs_per_server"]
+            for server, overrides in (config.get("servers") or {}).items()
+            if overrides and overrides.get("max_jobs_per_server")}
+
+
+class BackupEngine:
+    """Run backup jobs through a bounded worker pool.
+
+    A job only starts when the pool has a free worker and neither its server
+    nor its destination volume is already at its concurrency limit, so a
+    long list of databases drains without piling onto one disk.
+
+    ``on_progress(job, report)`` receives a ``ProgressReport`` every time a
+    running backup reports another STATS percentage. With a ``catalog`` every
+    finished backup is recorded in it and retention works from it.
+
+    Connections come from ``connections``, a ``ConnectionManager`` that may
+    be shared with other engines so its pools and server metadata outlive
+    one run; without one the engine keeps its own for the length of a run.
+
+    ``stages`` run in order on every successful backup before retention.
+    A stage is any object with a ``name`` and a ``run(job, result)`` method;
+    if one raises, the job is reported as failed and retention is skipped
+    so nothing older is removed in favour of a suspect backup. A stage with
+    ``optional`` set only leaves its error on the result, for work that can
+    be caught up on later such as the offsite copy.
+
+    ``server_limits`` overrides ``max_jobs_per_server`` for single servers.
+    ``clock`` gives the start and finish times of jobs, which also name their
+    backup files.
+
+    Every job records the server session of its BACKUP, so a cancel, or the
+    watchdog enforcing a job's ``max_duration`` and ``stall_timeout``, stops
+    exactly that session and removes the stripes it had started writing.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS,
+                 max_jobs_per_server=DEFAULT_MAX_JOBS_PER_SERVER,
+                 max_jobs_per_volume=DEFAULT_MAX_JOBS_PER_VOLUME,
+                 on_job_start=None, on_job_done=None, on_progress=None, catalog=None,
+                 stages=(), connections=None, watchdog_interval=WATCHDOG_INTERVAL,
+                 server_limits=None, clock=datetime.datetime.now):
+        self.max_workers = max(1, int(max_workers))
+        self.max_jobs_per_server = max(1, int(max_jobs_per_server))
+        self.max_jobs_per_volume = max(1, int(max_jobs_per_volume))
+        self.server_limits = {server: max(1, int(limit))
+                              for server, limit in (server_limits or {}).items()}
+        self.on_job_start = on_job_start
+        self.on_job_done = on_job_done
+        self.on_progress = on_progress
+        self.catalog = catalog
+        self.stages = list(stages)
+        self.clock = clock
+        self._owns_connections = connections is None
+        self.connections = connections or ConnectionManager(self.max_jobs_per_server)
+        self.watchdog_interval = watchdog_interval
+
+        self._cond = threading.Condition()
+        self._running = 0
+        self._per_server = {}
+        self._per_volume = {}
+        self._cancel = threading.Event()
+        self._active = {}
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        return cls(
+            max_workers=config.get("max_workers", DEFAULT_MAX_WORKERS),
+            max_jobs_per_server=config.get("max_jobs_per_server", DEFAULT_MAX_JOBS_PER_SERVER),
+            max_jobs_per_volume=config.get("max_jobs_per_volume", DEFAULT_MAX_JOBS_PER_VOLUME),
+            server_limits=server_limits(config),
+            **kwargs
+        )
+
+    def server_limit(self, server):
+        return self.server_limits.get(server, self.max_jobs_per_server)
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        """Stop launching new jobs and kill the backups already running"""
+        self._cancel.set()
+        with self._cond:
+            active = list(self._active.values())
+            self._cond.notify_all()
+        killers = [threading.Thread(target=kill_session, args=(running, self.connections))
+                   for running in active]
+        for killer in killers:
+            killer.start()
+        for killer in killers:
+            killer.join()
+
+    def _abort(self, running, reason):
+        if running.abort_reason is None:
+            running.abort_reason = reason
+        kill_session(running, self.connections)
+
+    def _watchdog(self, stop):
+        while not stop.wait(self.watchdog_interval):
+            now = time.monotonic()
+            with self._cond:
+                active = list(self._active.values())
+            for running in active:
+                reason = running.abort_reason is None and running.overdue(now)
+                if reason:
+                    logger.error("%s, aborting it", reason)
+                    self._abort(running, reason)
+
+    def run(self, jobs):
+        """Run every job and return their results in submission order"""
+        self._cancel.clear()
+        jobs = list(jobs)
+        results = [None] * len(jobs)
+        pending = [(i, job, job.volumes) for i, job in enumerate(jobs)]
+
+        stop_watchdog = threading.Event()
+        watchdog = threading.Thread(target=self._watchdog, args=(stop_watchdog,),
+                                    name="backup-watchdog", daemon=True)
+        watchdog.start()
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix="backup") as pool:
+            with self._cond:
+                while pending:
+                    if self._cancel.is_set():
+                        break
+                    picked = self._next_runnable(pending)
+                    if picked is None:
+                        self._cond.wait()
+                        continue
+                    index, job, volumes = pending.pop(picked)
+                    self._claim(job.server, volumes)
+                    pool.submit(self._run_slot, index, job, volumes, results)
+        stop_watchdog.set()
+        watchdog.join()
+
+        for index, job, _ in pending:
+            results[index] = JobResult(job, JobResult.CANCELLED, error="Backup cancelled by user")
+        if self._owns_connections:
+            self.connections.close()
+        return results
+
+    def _next_runnable(self, pending):
+        if self._running >= self.max_workers:
+            return None
+        for position, (_, job, volumes) in enumerate(pending):
+            if (self._per_server.get(job.server, 0) < self.server_limit(job.server)
+                    and all(self._per_volume.get(v, 0) < self.max_jobs_per_volume
+                            for v in volumes)):
+                return position
+        return None
+
+    def _claim(self, server, volumes):
+        self._running += 1
+        self._per_server[server] = self._per_server.get(server, 0) + 1
+        for volume in volumes:
+            self._per_volume[volume] = self._per_volume.get(volume, 0) + 1
+
+    def _release(self, server, volumes):
+        with self._cond:
+            self._running -= 1
+            self._per_server[server] -= 1
+            for volume in volumes:
+                self._per_volume[volume] -= 1
+            self._cond.notify_all()
+
+    def _run_slot(self, index, job, volumes, results):
+        try:
+            if self.on_job_start:
+                self.on_job_start(job)
+            result = self.run_job(job)
+        except Exception as e:
+            result = JobResult(job, JobResult.FAILED, error=str(e))
+        finally:
+            self._release(job.server, volumes)
+        results[index] = result
+        if self.on_job_done:
+            try:
+                self.on_job_done(result)
+            except Exception as e:
+                logger.error("Job callback failed for %s: %s", job.name, e)
+
+    def _cancel_check(self, running):
+        def check_cancel():
+            if self._cancel.is_set() or running.abort_reason:
+                raise BackupCancelled(running.abort_reason or "Backup cancelled by user")
+        return check_cancel
+
+    def _progress_callback(self, running):
+        def report(progress):
+            running.touch()
+            if self.on_progress:
+                self.on_progress(running.job, progress)
+        return report
+
+    def _expected_size(self, job, backup_type, estimate):
+        """Bytes the backup will probably write: its estimate, or the last one of its kind if more.
+
+        That backup counts at its original size, not what compression or
+        dedup left of it, since the stripes are written whole first.
+        """
+        expected = estimate or 0
+        if self.catalog is not None:
+            previous = self.catalog.backups(database=job.database, server=job.server,
+                                            backup_type=backup_type)
+            if previous:
+                expected = max(expected, previous[-1].original_size or 0)
+        return expected
+
+    def _make_room(self, job, backup_type, estimate):
+        """Prune before the backup when the volume cannot hold it otherwise.
+
+        Returns the bytes reclaimed, or None when there was room already.
+        """
+        expected = self._expected_size(job, backup_type, estimate)
+        needed = expected + (job.retention.min_free_bytes or 0)
+        free = free_bytes(job.directories)
+        if free is None or free >= needed:
+            return None
+        logger.warning("Only %d bytes free for a backup of %s needing %d, pruning first",
+                       free, job.name, needed)
+        plan = prune_backups(job.directories, job.database, job.retention, self.catalog,
+                             required_bytes=expected, server=job.server)
+        return plan.reclaimed_bytes
+
+    def _backup_options(self, job, backup_type):
+        """Check the database against the cached server metadata and fit the options to the server"""
+        info = self.connections.server_info(job)
+        if not info.has_database(job.database):
+            # It may have been created since the metadata was fetched
+            info = self.connections.server_info(job, refresh=True)
+        if not info.has_database(job.database):
+            raise ValueError(f"Database {job.database} does not exist on {job.server}")
+        if not info.database_online(job.database):
+            raise ValueError(f"Database {job.database} is not online")
+        if backup_type == "log" and info.recovery_model(job.database) == "SIMPLE":
+            raise ValueError(f"{job.database} uses the SIMPLE recovery model, "
+                             "which has no log backups")
+
+        options = job.options
+        if options.compression and not info.supports_compression:
+            logger.warning("%s %s cannot compress backups, backing up %s uncompressed",
+                           info.edition, info.version, job.name)
+            options = BackupOptions.from_dict(dict(options.to_dict(), compression=None))
+        return options
+
+    def run_job(self, job):
+        """Back up one database and apply retention to its directories.
+
+        A differential or log backup is promoted to a full backup when no full
+        backup exists yet to base it on. The result carries the timing of
+        every phase in ``metrics``.
+        """
+        metrics = JobMetrics()
+        result = self._run_job(job, metrics)
+        result.metrics = metrics
+        return result
+
+    def _run_job(self, job, metrics):
+        started = self.clock()
+        running = RunningJob(job)
+        check_cancel = self._cancel_check(running)
+        with self._cond:
+            self._active[id(running)] = running
+        conn = None
+        healthy = False
+        backup_files = []
+        try:
+            check_cancel()
+
+            with metrics.phase("connect"):
+                conn = self.connections.acquire(job)
+                cursor = conn.cursor()
+
+            with metrics.phase("prepare") as phase:
+                backup_type = job.backup_type
+                if backup_type != "full" and not has_full_backup(job.directories, job.database,
+                                                                 self.catalog, job.server):
+                    logger.info("No full backup of %s yet, taking a full backup instead of %s",
+                                job.name, backup_type)
+                    backup_type = "full"
+                options = self._backup_options(job, backup_type)
+
+                timestamp = started.strftime("%Y%m%d_%H%M%S")
+                backup_files = options.stripe_files(job.backup_path, job.database, timestamp,
+                                                    backup_type)
+                for directory in job.directories:
+                    os.makedirs(directory, exist_ok=True)
+
+                estimate = estimate_backup_size(cursor, backup_type)
+                phase.bytes = self._make_room(job, backup_type, estimate)
+                tracker = ProgressTracker(job.name, estimate,
+                                          on_progress=self._progress_callback(running))
+
+            with metrics.phase("backup") as phase:
+                running.start_backup(session_id(cursor), cursor)
+                check_cancel()
+                logger.info("Starting %s backup of %s to %s", backup_type, job.name,
+                            ", ".join(backup_files))
+                cursor.execute(build_backup_query(job.database, backup_files, options,
+                                                  backup_type),
+                               backup_files)
+                follow_backup(cursor, tracker, check_cancel)
+                running.end_backup()
+                finished = self.clock()
+                healthy = True
+                phase.bytes = tracker.total_bytes
+
+            result = JobResult(job, JobResult.SUCCEEDED, backup_files=backup_files,
+                               backup_type=backup_type, bytes_processed=tracker.total_bytes,
+                               started=started, finished=finished)
+            if self.catalog is not None:
+                result.catalog_id = self.catalog.record_backup(
+                    job.server, job.database, backup_type, backup_files, started, finished,
+                    **backup_history(cursor, backup_files[0]))
+
+            for stage in self.stages:
+                check_cancel()
+                try:
+                    with metrics.phase(stage.name) as phase:
+                        # Stages return the bytes they processed, if they count them
+                        phase.bytes = stage.run(job, result)
+                except BackupCancelled:
+                    raise
+                except Exception as e:
+                    result.error = f"{stage.name} failed: {e}"
+                    if getattr(stage, "optional", False):
+                        # The backup itself is good; keep going so retention still runs
+                        logger.warning("%s stage failed for %s: %s", stage.name, job.name, e)
+                        continue
+                    logger.error("%s stage failed for %s: %s", stage.name, job.name, e)
+                    result.status = JobResult.FAILED
+                    return result
+
+            with metrics.phase("prune") as phase:
+                plan = prune_backups(job.directories, job.database, job.retention, self.catalog,
+                                     server=job.server)
+                phase.bytes = plan.reclaimed_bytes
+            logger.info("Backup of %s completed", job.name)
+            return result
+
+        except Exception as e:
+            # A killed session surfaces as a driver error, not as BackupCancelled
+            stopped = isinstance(e, BackupCancelled) or running.abort_reason or self._cancel.is_set()
+            if not stopped:
+                logger.error("Backup of %s failed: %s", job.name, e)
+            if not healthy:
+                # The stripes of a BACKUP that did not finish are unusable
+                remove_files(backup_files)
+            if stopped and not running.abort_reason:
+                return JobResult(job, JobResult.CANCELLED, backup_files=backup_files,
+                                 error="Backup cancelled by user",
+                                 started=started, finished=self.clock())
+            return JobResult(job, JobResult.FAILED, backup_files=backup_files,
+                             error=running.abort_reason or str(e),
+                             started=started, finished=self.clock())
+        finally:
+            running.end_backup()
+            with self._cond:
+                self._active.pop(id(running), None)
+            if conn:
+                self.connections.release(job, conn, healthy)
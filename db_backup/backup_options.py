@@ -0,0 +1,136 @@
+#BACKUP DATABASE option handling: striping, compression and transfer tuning
+import os
+import re
+
+STRIPE_PATTERN = re.compile(r"_(\d+)of(\d+)$")
+
+BACKUP_TYPES = ("full", "diff", "log")
+BACKUP_EXTENSIONS = {"full": ".bak", "diff": ".dif", "log": ".trn"}
+# Appended by client-side compression, e.g. Sales_20250101_230000.bak.zst
+COMPRESSED_SUFFIXES = (".gz", ".zst")
+# Pointer left in place of a backup moved into the deduplicating repository
+DEDUP_SUFFIX = ".dedup"
+# Suffixes of backups SQL Server cannot read as they are
+PACKED_SUFFIXES = COMPRESSED_SUFFIXES + (DEDUP_SUFFIX,)
+
+MAX_STRIPES = 64
+MAX_TRANSFER_UNIT = 65536
+MAX_TRANSFER_LIMIT = 4 * 1024 * 1024
+
+
+class BackupOptions:
+    """Per-database tuning for the BACKUP command.
+
+    ``None`` leaves a setting to the server default so that existing configs
+    keep producing the same ``WITH FORMAT, STATS = 10`` command as before.
+    """
+
+    FIELDS = ("stripes", "stripe_paths", "compression", "buffercount",
+              "maxtransfersize", "blocksize", "checksum", "stats")
+
+    def __init__(self, stripes=1, stripe_paths=None, compression=None, buffercount=None,
+                 maxtransfersize=None, blocksize=None, checksum=None, stats=10):
+        self.stripe_paths = list(stripe_paths or [])
+        self.stripes = max(int(stripes or 1), len(self.stripe_paths), 1)
+        self.compression = compression
+        self.buffercount = buffercount
+        self.maxtransfersize = maxtransfersize
+        self.blocksize = blocksize
+        self.checksum = checksum
+        self.stats = stats
+        self.validate()
+
+    @classmethod
+    def from_dict(cls, settings):
+        settings = settings or {}
+        return cls(**{k: settings[k] for k in cls.FIELDS if k in settings})
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.FIELDS}
+
+    def validate(self):
+        if self.stripes > MAX_STRIPES:
+            raise ValueError(f"A backup can be striped across at most {MAX_STRIPES} files")
+        if self.buffercount is not None and int(self.buffercount) < 1:
+            raise ValueError("BUFFERCOUNT must be a positive number")
+        if self.maxtransfersize is not None:
+            size = int(self.maxtransfersize)
+            if size % MAX_TRANSFER_UNIT or not MAX_TRANSFER_UNIT <= size <= MAX_TRANSFER_LIMIT:
+                raise ValueError("MAXTRANSFERSIZE must be a multiple of 64 KB up to 4 MB")
+        if self.blocksize is not None:
+            size = int(self.blocksize)
+            if size not in (512, 1024, 2048, 4096, 8192, 16384, 32768, 65536):
+                raise ValueError("BLOCKSIZE must be a power of two between 512 and 65536")
+        if self.stats is not None and not 1 <= int(self.stats) <= 100:
+            raise ValueError("STATS must be between 1 and 100")
+
+    def with_clause(self, backup_type="full"):
+        """Return the WITH options of the BACKUP command"""
+        parts = ["FORMAT"]
+        if backup_type == "diff":
+            parts.append("DIFFERENTIAL")
+        if self.compression is not None:
+            parts.append("COMPRESSION" if self.compression else "NO_COMPRESSION")
+        if self.checksum is not None:
+            parts.append("CHECKSUM" if self.checksum else "NO_CHECKSUM")
+        if self.buffercount is not None:
+            parts.append(f"BUFFERCOUNT = {int(self.buffercount)}")
+        if self.maxtransfersize is not None:
+            parts.append(f"MAXTRANSFERSIZE = {int(self.maxtransfersize)}")
+        if self.blocksize is not None:
+            parts.append(f"BLOCKSIZE = {int(self.blocksize)}")
+        if self.stats is not None:
+            parts.append(f"STATS = {int(self.stats)}")
+        return ", ".join(parts)
+
+    def stripe_files(self, backup_path, database, timestamp, backup_type="full"):
+        """Return the destination file of every stripe.
+
+        Stripes are spread round-robin over ``stripe_paths``; without any they
+        all go to ``backup_path``.
+        """
+        extension = BACKUP_EXTENSIONS[backup_type]
+        directories = self.stripe_paths or [backup_path]
+        base = f"{database}_{timestamp}"
+        if self.stripes == 1:
+            return [os.path.join(directories[0], base + extension)]
+        return [os.path.join(directories[i % len(directories)],
+                             f"{base}_{i + 1}of{self.stripes}{extension}")
+                for i in range(self.stripes)]
+
+    def directories(self, backup_path):
+        return self.stripe_paths or [backup_path]
+
+
+def build_backup_query(database, files, options, backup_type="full"):
+    """Build a BACKUP DATABASE or BACKUP LOG command writing to every file in ``files``.
+
+    The file names are passed as parameters, one ``?`` per stripe.
+    """
+    if backup_type not in BACKUP_TYPES:
+        raise ValueError(f"Unknown backup type: {backup_type}")
+    statement = "BACKUP LOG" if backup_type == "log" else "BACKUP DATABASE"
+    targets = ", ".join("DISK = ?" for _ in files)
+    return f"""
+            {statement} [{database}]
+            TO {targets}
+            WITH {options.with_clause(backup_type)}
+            """
+
+
+def split_backup_name(filename):
+    """Split a backup file name into (stem, backup extension, compression or dedup suffix)"""
+    name = os.path.basename(filename)
+    packed = ""
+    for suffix in PACKED_SUFFIXES:
+        if name.lower().endswith(suffix):
+            name, packed = name[:-len(suffix)], suffix
+            break
+    stem, extension = os.path.splitext(name)
+    return stem, extension, packed
+
+
+def backup_set_key(filename):
+    """Return the name shared by every stripe of a backup set"""
+    stem, _, _ = split_backup_name(filename)
+    return STRIPE_PATTERN.sub("", stem)
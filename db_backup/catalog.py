@@ -0,0 +1,303 @@
+#SQLite catalog of the backups taken, so retention never has to scan directories
+import datetime
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from backup_options import BACKUP_EXTENSIONS, STRIPE_PATTERN, backup_set_key, split_backup_name
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILE_NAME = "backup_catalog.db"
+
+TYPES_BY_EXTENSION = {ext: backup_type for backup_type, ext in BACKUP_EXTENSIONS.items()}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    server TEXT NOT NULL,
+    database TEXT NOT NULL,
+    backup_type TEXT NOT NULL,
+    set_key TEXT NOT NULL,
+    started TEXT NOT NULL,
+    finished TEXT,
+    duration REAL,
+    size INTEGER,
+    checksum TEXT,
+    first_lsn TEXT,
+    last_lsn TEXT,
+    database_backup_lsn TEXT,
+    verify_status TEXT,
+    verified TEXT,
+    verify_error TEXT,
+    original_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS backups_by_database ON backups (database, started);
+CREATE TABLE IF NOT EXISTS backup_files (
+    backup_id INTEGER NOT NULL REFERENCES backups (id) ON DELETE CASCADE,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS backup_files_by_backup ON backup_files (backup_id);
+"""
+
+# Columns added after the first release, created on catalogs that predate them
+ADDED_COLUMNS = {"verify_status": "TEXT", "verified": "TEXT", "verify_error": "TEXT",
+                 "original_size": "INTEGER"}
+
+RECORD_COLUMNS = """id, server, database, backup_type, set_key, started, finished, duration, size,
+                    checksum, first_lsn, last_lsn, database_backup_lsn, verify_status, verified,
+                    verify_error, original_size"""
+
+# verify_status values: queued by the verify stage, then the outcome
+VERIFY_QUEUED = "queued"
+VERIFY_PASSED = "passed"
+VERIFY_FAILED = "failed"
+VERIFY_SKIPPED = "skipped"
+
+
+def parse_backup_name(filename, database=None):
+    """Return (database, backup_type, set_key, taken) for a backup file name, or None.
+
+    With ``database`` given only that database's files match, so ``Sales``
+    does not pick up the backups of ``SalesArchive``.
+    """
+    backup_type = TYPES_BY_EXTENSION.get(split_backup_name(filename)[1].lower())
+    if not backup_type:
+        return None
+    key = backup_set_key(filename)
+    match = re.match(r"^(.+)_(\d{8}_\d{6})$", key)
+    if not match or (database is not None and match.group(1) != database):
+        return None
+    try:
+        taken = datetime.datetime.strptime(match.group(2), "%Y%m%d_%H%M%S")
+    except ValueError:
+        return None
+    return match.group(1), backup_type, key, taken
+
+
+class BackupRecord:
+    """One backup set as recorded in the catalog.
+
+    ``size`` is what its files take now, after any compression or dedup;
+    ``original_size`` is what the BACKUP statement wrote.
+    """
+
+    def __init__(self, id, server, database, backup_type, set_key, started, finished,
+                 duration, size, checksum, first_lsn, last_lsn, database_backup_lsn,
+                 verify_status=None, verified=None, verify_error=None, original_size=None,
+                 paths=()):
+        self.id = id
+        self.server = server
+        self.database = database
+        self.backup_type = backup_type
+        self.set_key = set_key
+        self.started = _parse_time(started)
+        self.finished = _parse_time(finished)
+        self.duration = duration
+        self.size = size
+        self.checksum = checksum
+        self.first_lsn = first_lsn
+        self.last_lsn = last_lsn
+        self.database_backup_lsn = database_backup_lsn
+        self.verify_status = verify_status
+        self.verified = _parse_time(verified)
+        self.verify_error = verify_error
+        self.original_size = original_size
+        self.paths = list(paths)
+
+    @property
+    def is_verified(self):
+        return self.verify_status == VERIFY_PASSED
+
+    def __repr__(self):
+        return f"BackupRecord({self.id}, {self.database!r}, {self.backup_type!r}, {self.started})"
+
+
+def _parse_time(value):
+    return datetime.datetime.fromisoformat(value) if value else None
+
+
+def _format_time(value):
+    return value.isoformat(sep=" ") if value else None
+
+
+def _stripe_number(path):
+    match = STRIPE_PATTERN.search(split_backup_name(path)[0])
+    return int(match.group(1)) if match else 0
+
+
+def _lsn(value):
+    return str(value) if value is not None else None
+
+
+class Catalog:
+    """Backups, their files, sizes, timings, checksums and LSN ranges.
+
+    One connection is shared by every thread of the process and serialised
+    with a lock; SQLite itself is far faster than the backups it records.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.executescript(SCHEMA)
+        self._add_missing_columns()
+
+    def _add_missing_columns(self):
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(backups)")}
+        with self._conn:
+            for column, kind in ADDED_COLUMNS.items():
+                if column not in existing:
+                    self._conn.execute(f"ALTER TABLE backups ADD COLUMN {column} {kind}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def record_backup(self, server, database, backup_type, files, started, finished=None,
+                      checksum=None, first_lsn=None, last_lsn=None, database_backup_lsn=None):
+        """Add a finished backup set and return its id; its files' sizes are its original size"""
+        sizes = [(path, os.path.getsize(path) if os.path.exists(path) else None) for path in files]
+        total = sum(size or 0 for _, size in sizes)
+        duration = (finished - started).total_seconds() if finished else None
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                """INSERT INTO backups (server, database, backup_type, set_key, started, finished,
+                                        duration, size, checksum, first_lsn, last_lsn,
+                                        database_backup_lsn, original_size)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (server, database, backup_type, backup_set_key(files[0]), _format_time(started),
+                 _format_time(finished), duration, total, checksum, _lsn(first_lsn),
+                 _lsn(last_lsn), _lsn(database_backup_lsn), total))
+            backup_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO backup_files (backup_id, path, size) VALUES (?, ?, ?)",
+                [(backup_id, path, size) for path, size in sizes])
+        return backup_id
+
+    def update(self, backup_id, **fields):
+        """Change recorded columns of a backup, e.g. its checksum"""
+        if not fields:
+            return
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE backups SET {columns} WHERE id = ?",
+                               list(fields.values()) + [backup_id])
+
+    def replace_files(self, backup_id, files):
+        """Point a backup at new files, e.g. after compression, and update its size.
+
+        The original size stays that of the files the backup wrote.
+        """
+        sizes = [(path, os.path.getsize(path) if os.path.exists(path) else None) for path in files]
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM backup_files WHERE backup_id = ?", (backup_id,))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO backup_files (backup_id, path, size) VALUES (?, ?, ?)",
+                [(backup_id, path, size) for path, size in sizes])
+            self._conn.execute("UPDATE backups SET size = ? WHERE id = ?",
+                               (sum(size or 0 for _, size in sizes), backup_id))
+
+    def backups(self, database=None, server=None, backup_type=None):
+        """Return recorded backups, oldest first"""
+        clauses, params = [], []
+        for column, value in (("database", database), ("server", server),
+                              ("backup_type", backup_type)):
+            if value is not None:
+                clauses.append(f"b.{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {RECORD_COLUMNS} FROM backups b {where} ORDER BY started, id",
+                params).fetchall()
+            files = {}
+            for backup_id, path in self._conn.execute(
+                    f"""SELECT f.backup_id, f.path FROM backup_files f
+                        JOIN backups b ON b.id = f.backup_id {where}
+                        ORDER BY f.rowid""", params):
+                files.setdefault(backup_id, []).append(path)
+        return [BackupRecord(*row, paths=files.get(row[0], [])) for row in rows]
+
+    def get(self, backup_id):
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {RECORD_COLUMNS} FROM backups WHERE id = ?", (backup_id,)).fetchone()
+            if not row:
+                return None
+            paths = [p for (p,) in self._conn.execute(
+                "SELECT path FROM backup_files WHERE backup_id = ? ORDER BY rowid", (backup_id,))]
+        return BackupRecord(*row, paths=paths)
+
+    def queued_for_verification(self, databases=None):
+        """Backups waiting to be verified, newest first"""
+        queued = [record for record in self.backups() if record.verify_status == VERIFY_QUEUED
+                  and (databases is None or record.database in databases)]
+        return queued[::-1]
+
+    def record_verification(self, backup_id, status, error=None, when=None):
+        self.update(backup_id, verify_status=status, verify_error=error,
+                    verified=_format_time(when or datetime.datetime.now()))
+
+    def find_by_path(self, path):
+        with self._lock:
+            row = self._conn.execute("SELECT backup_id FROM backup_files WHERE path = ?",
+                                     (path,)).fetchone()
+        return self.get(row[0]) if row else None
+
+    def databases(self, server=None):
+        query = "SELECT DISTINCT database FROM backups"
+        params = ()
+        if server is not None:
+            query += " WHERE server = ?"
+            params = (server,)
+        with self._lock:
+            return [name for (name,) in self._conn.execute(query + " ORDER BY database", params)]
+
+    def remove(self, backup_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM backups WHERE id = ?", (backup_id,))
+
+    def reconcile(self, directories, database, server="localhost"):
+        """Resync the catalog with what is actually on disk.
+
+        Drops records of ``database`` on ``server`` whose files are gone and
+        adds backup files of it the catalog does not know about. Returns the
+        number of records (added, removed).
+        """
+        removed = 0
+        for record in self.backups(database=database, server=server):
+            if not record.paths or not all(os.path.exists(p) for p in record.paths):
+                self.remove(record.id)
+                removed += 1
+
+        found = {}
+        for directory in dict.fromkeys(directories):
+            if not os.path.isdir(directory):
+                continue
+            for f in os.listdir(directory):
+                parsed = parse_backup_name(f, database)
+                if not parsed:
+                    continue
+                path = os.path.join(directory, f)
+                if self.find_by_path(path):
+                    continue
+                _, backup_type, key, taken = parsed
+                found.setdefault((key, backup_type, taken), []).append(path)
+
+        for (key, backup_type, taken), paths in found.items():
+            paths.sort(key=_stripe_number)
+            self.record_backup(server, database, backup_type, paths, taken)
+        if found or removed:
+            logger.info("Reconciled catalog for %s: %d added, %d removed",
+                        database, len(found), removed)
+        return len(found), removed
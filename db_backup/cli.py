@@ -0,0 +1,244 @@
+#Command line entry point: python -m db_backup <command>
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+
+from config import default_config_file, load_config
+
+logger = logging.getLogger("db_backup")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="db_backup",
+        description="Back up SQL Server databases without the GUI.")
+    parser.add_argument("--config", default=None,
+                        help="path to backup_config.json (default: the one in the app data folder)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log debug messages")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="back up now and exit")
+    run.add_argument("--db", action="append", dest="databases", metavar="NAME",
+                     help="database to back up; repeat for several (default: all configured)")
+    run.add_argument("--type", dest="backup_type", default="full", choices=("full", "diff", "log"),
+                     help="kind of backup (default: full)")
+
+    commands.add_parser("daemon", help="run the scheduler until stopped")
+
+    prune = commands.add_parser("prune", help="apply retention without backing up")
+    prune.add_argument("--db", action="append", dest="databases", metavar="NAME")
+    prune.add_argument("--dry-run", action="store_true",
+                       help="only report what would be deleted and the space reclaimed")
+
+    reconcile = commands.add_parser("reconcile", help="resync the backup catalog with the disk")
+    reconcile.add_argument("--db", action="append", dest="databases", metavar="NAME")
+
+    copy = commands.add_parser("copy", help="copy catalogued backups to the offsite targets, resuming partial copies")
+    copy.add_argument("--db", action="append", dest="databases", metavar="NAME")
+
+    decompress = commands.add_parser("decompress", help="restore the original .bak from a client-compressed file")
+    decompress.add_argument("path", help="the .gz or .zst file")
+    decompress.add_argument("--output", help="where to write it (default: next to the input)")
+
+    rehydrate = commands.add_parser("rehydrate", help="rebuild a backup from its .dedup pointer file")
+    rehydrate.add_argument("path", help="the .dedup file")
+    rehydrate.add_argument("--output", help="where to write it (default: next to the input)")
+
+    gc = commands.add_parser("gc", help="reclaim dedup repository space no backup uses any more")
+    gc.add_argument("--min-garbage", type=float, default=None, metavar="RATIO",
+                    help="rewrite packs at least this much garbage (default: dedup_garbage_ratio)")
+
+    verify = commands.add_parser("verify", help="verify the backups queued since the last run")
+    verify.add_argument("--db", action="append", dest="databases", metavar="NAME")
+    verify.add_argument("--limit", type=int, help="verify at most this many backups")
+
+    metrics = commands.add_parser("metrics", help="print the phase timings of the last run of every job")
+    metrics.add_argument("--format", choices=("prometheus", "json"), default="prometheus")
+
+    report = commands.add_parser("report", help="show the slowest jobs and phases getting slower")
+    report.add_argument("--db", dest="database", metavar="NAME")
+    report.add_argument("--limit", type=int, default=10, help="how many slow jobs to list (default: 10)")
+    report.add_argument("--window", type=int, default=7,
+                        help="runs per side when comparing recent with earlier runs (default: 7)")
+
+    plan = commands.add_parser("plan", help="project when each backup runs and whether it fits the window")
+    plan.add_argument("--db", action="append", dest="databases", metavar="NAME")
+    plan.add_argument("--type", dest="backup_type", default="full", choices=("full", "diff", "log"))
+    plan.add_argument("--no-sizes", action="store_true",
+                      help="plan from the history alone, without asking the servers for sizes")
+
+    history = commands.add_parser("list", help="list the backups recorded in the catalog")
+    history.add_argument("--db", dest="database", metavar="NAME")
+
+    return parser
+
+
+def make_service(config_file):
+    # Imported here so that parsing arguments and --help never load the driver
+    from service import BackupService
+
+    config = load_config(config_file)
+    return BackupService(config, os.path.dirname(config_file))
+
+
+def cmd_run(service, args):
+    results = service.backup(args.backup_type, args.databases)
+    if not results:
+        logger.error("No databases to back up")
+        return 1
+    for result in results:
+        line = f"{result.job.name}: {result.status}"
+        if result.error:
+            line += f" ({result.error})"
+        print(line)
+    return 0 if all(r.ok for r in results) else 1
+
+
+def cmd_daemon(service, args):
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info("Received signal %s, shutting down", signum)
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    service.start_scheduler()
+    logger.info("Scheduler running, next backup at %s", service.next_run())
+    try:
+        while not stop.is_set():
+            stop.wait(3600)
+    finally:
+        service.stop_scheduler()
+        service.cancel()
+    return 0
+
+
+def cmd_prune(service, args):
+    plans = service.prune(args.databases, dry_run=args.dry_run)
+    for plan in plans:
+        print(plan.describe())
+    if args.dry_run:
+        total = sum(plan.reclaimed_bytes for plan in plans)
+        print(f"Dry run: {total / (1024 * 1024):.1f} MB would be reclaimed")
+    return 0
+
+
+def cmd_reconcile(service, args):
+    for name, (added, removed) in service.reconcile(args.databases).items():
+        print(f"{name}: {added} added, {removed} removed")
+    return 0
+
+
+def cmd_copy(service, args):
+    return 1 if service.copy_offsite(args.databases) else 0
+
+
+def cmd_decompress(service, args):
+    from compress import decompress_file
+
+    output = args.output or os.path.splitext(args.path)[0]
+    print(decompress_file(args.path, output))
+    return 0
+
+
+def cmd_rehydrate(service, args):
+    from dedup import rehydrate
+
+    print(rehydrate(args.path, args.output))
+    return 0
+
+
+def cmd_gc(service, args):
+    stats = service.dedup_stats()
+    if stats is None:
+        logger.error("No dedup_repository configured")
+        return 1
+    reclaimed = service.collect_garbage(args.min_garbage)
+    stats = service.dedup_stats()
+    print(f"Reclaimed {reclaimed / (1024 * 1024):.1f} MB; {stats['files']} files, "
+          f"{stats['logical_bytes'] / (1024 * 1024):.1f} MB stored in "
+          f"{stats['stored_bytes'] / (1024 * 1024):.1f} MB ({stats['ratio']:.1f}x)")
+    return 0
+
+
+def cmd_verify(service, args):
+    outcomes = service.verify(args.databases, args.limit)
+    for backup_id, status in outcomes.items():
+        record = service.catalog.get(backup_id)
+        print(f"{record.set_key}: {status}" + (f" ({record.verify_error})" if record.verify_error else ""))
+    return 1 if "failed" in outcomes.values() else 0
+
+
+def cmd_metrics(service, args):
+    sys.stdout.write(service.export_metrics(args.format))
+    return 0
+
+
+def cmd_report(service, args):
+    print(service.metrics_report(args.database, args.limit, args.window))
+    return 0
+
+
+def cmd_plan(service, args):
+    plans = service.window_plans(args.backup_type, args.databases, sizes=not args.no_sizes)
+    if not plans:
+        # No maintenance window: show the order a run started now would take
+        plans = [(args.backup_type, "now",
+                  service.plan(args.backup_type, args.databases, sizes=not args.no_sizes))]
+    for backup_type, spec, plan in plans:
+        print(f"{backup_type} backups, {spec}:")
+        print(plan.describe())
+    return 0 if all(plan.fits for _, _, plan in plans) else 1
+
+
+def cmd_list(service, args):
+    for record in service.history(args.database):
+        size_mb = (record.size or 0) / (1024 * 1024)
+        print(f"{record.started:%Y-%m-%d %H:%M:%S}  {record.database:<30} {record.backup_type:<4} "
+              f"{size_mb:>12.1f} MB  {record.verify_status or '-':<8} {', '.join(record.paths)}")
+    return 0
+
+
+COMMANDS = {
+    "run": cmd_run,
+    "daemon": cmd_daemon,
+    "prune": cmd_prune,
+    "reconcile": cmd_reconcile,
+    "copy": cmd_copy,
+    "decompress": cmd_decompress,
+    "rehydrate": cmd_rehydrate,
+    "gc": cmd_gc,
+    "verify": cmd_verify,
+    "metrics": cmd_metrics,
+    "report": cmd_report,
+    "plan": cmd_plan,
+    "list": cmd_list,
+}
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    config_file = args.config or default_config_file()
+    service = None
+    try:
+        service = make_service(config_file)
+        return COMMANDS[args.command](service, args)
+    except Exception as e:
+        logger.error("%s failed: %s", args.command, e)
+        return 1
+    finally:
+        if service:
+            service.close()
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,94 @@
+#Location, defaults and persistence of backup_config.json
+import json
+import os
+
+APP_DIR_NAME = "SQLBackupTool"
+CONFIG_FILE_NAME = "backup_config.json"
+
+DEFAULT_CONFIG = {
+    "server": "localhost",
+    "database": "",
+    "username": "",
+    "password": "",
+    "trusted_connection": "yes",
+    "driver": "pyodbc",
+    "backup_path": os.path.expanduser("~/Desktop/backups"),
+    "backup_time": "23:00",
+    "maintenance_window": None,
+    "plan_throughput_mb": 50,
+    "plan_history_runs": 10,
+    "servers": {},
+    "auto_start": False,
+    "scheduler_active": False,
+    "databases": [],
+    "max_workers": 4,
+    "max_jobs_per_server": 2,
+    "max_jobs_per_volume": 1,
+    "backup_options": {},
+    "retention": {},
+    "write_manifest": True,
+    "hash_workers": 4,
+    "offsite_targets": [],
+    "copy_workers": 2,
+    "copy_bandwidth_limit": None,
+    "client_compression": None,
+    "dedup_repository": None,
+    "dedup_chunk_size": 1048576,
+    "dedup_compress": False,
+    "dedup_garbage_ratio": 0.2,
+    "connect_timeout": 10,
+    "connect_retries": 3,
+    "connection_pool_size": 4,
+    "server_info_ttl": 300,
+    "max_backup_minutes": None,
+    "stall_minutes": None,
+    "metrics_file": None,
+    "metrics_json_file": None,
+    "metrics_history_days": 90,
+    "verify_mode": None,
+    "verify_schedule": "daily 06:00",
+    "verify_window": None,
+    "verify_server": None,
+    "verify_workers": 1,
+    "verify_bandwidth_limit": None
+}
+
+
+def app_data_dir():
+    """Return the directory holding the config and state files.
+
+    ``SQLBACKUP_HOME`` overrides it; otherwise it is %APPDATA%\\SQLBackupTool
+    on Windows and ~/.config/SQLBackupTool elsewhere.
+    """
+    override = os.environ.get("SQLBACKUP_HOME")
+    if override:
+        return override
+    base = os.environ.get("APPDATA") or os.environ.get("XDG_CONFIG_HOME") \
+        or os.path.expanduser("~/.config")
+    return os.path.join(base, APP_DIR_NAME)
+
+
+def default_config_file():
+    return os.path.join(app_data_dir(), CONFIG_FILE_NAME)
+
+
+def default_config():
+    """Return a fresh copy of the defaults that callers may modify"""
+    return json.loads(json.dumps(DEFAULT_CONFIG))
+
+
+def load_config(config_file=None):
+    """Load the saved configuration on top of the defaults"""
+    config_file = config_file or default_config_file()
+    config = default_config()
+    if os.path.exists(config_file):
+        with open(config_file, 'r') as f:
+            config.update(json.load(f))
+    return config
+
+
+def save_config(config, config_file=None):
+    config_file = config_file or default_config_file()
+    os.makedirs(os.path.dirname(config_file), exist_ok=True)
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
@@ -0,0 +1,329 @@
+#Pooled SQL Server connections with retries and cached server metadata
+import importlib
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Modules speaking the pyodbc interface; any other name is imported as given
+DRIVERS = {"pyodbc": "pyodbc", "fake": "fake_pyodbc"}
+DRIVER_ENVIRONMENT_VARIABLE = "DB_BACKUP_DRIVER"
+
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_CONNECT_RETRIES = 3
+DEFAULT_POOL_SIZE = 4
+DEFAULT_SERVER_INFO_TTL = 300
+# A pooled connection idle for longer than this is pinged before it is handed out
+VALIDATE_AFTER = 30
+# ... and one idle for longer than this is closed instead of reused
+MAX_IDLE = 600
+
+# SQLSTATEs worth another attempt: the server was unreachable, the link dropped,
+# the login timed out or we lost a deadlock
+TRANSIENT_SQLSTATES = {"08001", "08S01", "08004", "HYT00", "HYT01", "40001"}
+
+SERVER_INFO_QUERY = """
+    SELECT CAST(SERVERPROPERTY('ProductVersion') AS NVARCHAR(128)),
+           CAST(SERVERPROPERTY('Edition') AS NVARCHAR(128)),
+           CAST(SERVERPROPERTY('EngineEdition') AS INT)
+    """
+DATABASES_QUERY = "SELECT name, state_desc, recovery_model_desc FROM sys.databases"
+
+# SERVERPROPERTY('EngineEdition') values
+ENGINE_EDITION_ENTERPRISE = 3
+ENGINE_EDITION_EXPRESS = 4
+
+
+def build_connection_string(server, database, trusted_connection="yes", username="", password=""):
+    """Generate connection string based on authentication type"""
+    if trusted_connection == "yes":
+        return f"DRIVER={{SQL Server}};SERVER={server};DATABASE={database};Trusted_Connection=yes;"
+    return f"DRIVER={{SQL Server}};SERVER={server};DATABASE={database};UID={username};PWD={password}"
+
+
+def load_driver(name=None):
+    """Import the DB-API driver to connect with.
+
+    ``name`` comes from the config; the DB_BACKUP_DRIVER environment variable
+    overrides it, so a benchmark or a dry run on Linux can switch to the
+    simulated server without touching the config.
+    """
+    name = os.environ.get(DRIVER_ENVIRONMENT_VARIABLE) or name or "pyodbc"
+    return importlib.import_module(DRIVERS.get(name, name))
+
+
+def is_transient(error):
+    """Whether a pyodbc error is worth retrying"""
+    state = error.args[0] if getattr(error, "args", None) else None
+    return isinstance(state, str) and state.upper() in TRANSIENT_SQLSTATES
+
+
+def retry(func, attempts=DEFAULT_CONNECT_RETRIES, base_delay=0.5, max_delay=10.0,
+          transient=is_transient):
+    """Call ``func`` until it succeeds, backing off exponentially with jitter.
+
+    Only errors ``transient`` accepts are retried; anything else, and the
+    last failure, is raised as is.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= attempts or not transient(e):
+                raise
+            delay = min(max_delay, base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            logger.warning("Attempt %d of %d failed (%s), retrying in %.1fs",
+                           attempt, attempts, e, delay)
+            time.sleep(delay)
+
+
+class ServerInfo:
+    """What a server is and what it can do, as of ``fetched``"""
+
+    def __init__(self, version, edition, engine_edition, databases, fetched=None):
+        self.version = version or ""
+        self.edition = edition or ""
+        self.engine_edition = engine_edition
+        # {name: (state, recovery model)}
+        self.databases = dict(databases)
+        self.fetched = time.monotonic() if fetched is None else fetched
+
+    @property
+    def major_version(self):
+        try:
+            return int(self.version.split(".")[0])
+        except ValueError:
+            return 0
+
+    @property
+    def supports_compression(self):
+        """BACKUP ... WITH COMPRESSION: Enterprise from 2008, every edition but Express from 2008 R2"""
+        if self.engine_edition == ENGINE_EDITION_EXPRESS:
+            return False
+        if self.major_version > 10 or self.version.startswith("10.5"):
+            return True
+        return self.major_version == 10 and self.engine_edition == ENGINE_EDITION_ENTERPRISE
+
+    def has_database(self, name):
+        return name in self.databases
+
+    def database_online(self, name):
+        state = self.databases.get(name)
+        return state is not None and state[0] == "ONLINE"
+
+    def recovery_model(self, name):
+        state = self.databases.get(name)
+        return state[1] if state else None
+
+    def __repr__(self):
+        return f"ServerInfo({self.version!r}, {self.edition!r})"
+
+
+class ConnectionPool:
+    """Idle connections to one server under one login"""
+
+    def __init__(self, connection_string, max_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_CONNECT_TIMEOUT, retries=DEFAULT_CONNECT_RETRIES, driver=None):
+        self.connection_string = connection_string
+        self.driver = driver or load_driver()
+        self.max_size = max(1, int(max_size))
+        self.timeout = timeout
+        self.retries = retries
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def _connect(self):
+        conn = retry(lambda: self.driver.connect(self.connection_string, autocommit=True,
+                                                 timeout=self.timeout),
+                     attempts=self.retries)
+        self.opened += 1
+        return conn
+
+    def acquire(self):
+        """Return a working connection, reusing an idle one when possible"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, released = self._idle.pop()
+            idle = time.monotonic() - released
+            if idle > MAX_IDLE:
+                _close(conn)
+                continue
+            if idle > VALIDATE_AFTER and not _ping(conn):
+                _close(conn)
+                continue
+            self.reused += 1
+            return conn
+        return self._connect()
+
+    def release(self, conn, healthy=True):
+        """Return a connection to the pool, or close it if it is suspect or surplus"""
+        if healthy:
+            with self._lock:
+                if len(self._idle) < self.max_size:
+                    self._idle.append((conn, time.monotonic()))
+                    return
+        _close(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn, _ in idle:
+            _close(conn)
+
+
+def _ping(conn):
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+        cursor.close()
+        return True
+    except Exception:
+        return False
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class ConnectionManager:
+    """Connection pools and server metadata shared by every job of a process.
+
+    Connections are pooled per server and login and always open on
+    ``master``; ``acquire`` switches to the job's database, so one pool
+    serves every database of a server. Server metadata (version, edition,
+    compression support, databases) is cached for ``server_info_ttl``
+    seconds so jobs can choose their options without extra round-trips.
+
+    ``driver`` is a module with the pyodbc interface, or the name of one
+    (see ``load_driver``). A name is only imported on the first connection,
+    so commands that never connect work without the driver installed.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_CONNECT_TIMEOUT,
+                 retries=DEFAULT_CONNECT_RETRIES, server_info_ttl=DEFAULT_SERVER_INFO_TTL,
+                 driver=None):
+        self._driver = driver
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.server_info_ttl = server_info_ttl
+        self._pools = {}
+        self._info = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(pool_size=config.get("connection_pool_size", DEFAULT_POOL_SIZE),
+                   timeout=config.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+                   retries=config.get("connect_retries", DEFAULT_CONNECT_RETRIES),
+                   server_info_ttl=config.get("server_info_ttl", DEFAULT_SERVER_INFO_TTL),
+                   driver=config.get("driver"))
+
+    @property
+    def driver(self):
+        if self._driver is None or isinstance(self._driver, str):
+            self._driver = load_driver(self._driver)
+        return self._driver
+
+    @staticmethod
+    def _key(job):
+        return (job.server, job.trusted_connection,
+                "" if job.trusted_connection == "yes" else job.username,
+                "" if job.trusted_connection == "yes" else job.password)
+
+    def pool(self, job):
+        """The pool of the job's server and login"""
+        key = self._key(job)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                server, trusted, username, password = key
+                pool = ConnectionPool(
+                    build_connection_string(server, "master", trusted, username, password),
+                    self.pool_size, self.timeout, self.retries, self.driver)
+                self._pools[key] = pool
+            return pool
+
+    def acquire(self, job, database=None):
+        """Return a connection using ``database`` (the job's by default).
+
+        A server that cannot be reached or a database that cannot be used
+        may have failed over, been upgraded or changed, so the cached
+        metadata of the server is dropped as well.
+        """
+        pool = self.pool(job)
+        try:
+            conn = pool.acquire()
+        except Exception:
+            self.invalidate(job)
+            raise
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"USE [{(database or job.database).replace(']', ']]')}]")
+            cursor.close()
+        except Exception:
+            pool.release(conn, healthy=False)
+            self.invalidate(job)
+            raise
+        return conn
+
+    def release(self, job, conn, healthy=True):
+        """Give a connection back; an unhealthy one is closed and the server metadata refetched"""
+        self.pool(job).release(conn, healthy)
+        if not healthy:
+            self.invalidate(job)
+
+    def server_info(self, job, refresh=False):
+        """Cached metadata of the job's server, fetched when missing or stale"""
+        key = self._key(job)
+        with self._lock:
+            info = self._info.get(key)
+        if (info is not None and not refresh
+                and time.monotonic() - info.fetched < self.server_info_ttl):
+            return info
+
+        conn = self.acquire(job, "master")
+        healthy = False
+        try:
+            cursor = conn.cursor()
+            cursor.execute(SERVER_INFO_QUERY)
+            version, edition, engine_edition = cursor.fetchone()
+            cursor.execute(DATABASES_QUERY)
+            databases = {name: (state, recovery) for name, state, recovery in cursor.fetchall()}
+            cursor.close()
+            healthy = True
+        finally:
+            self.release(job, conn, healthy)
+
+        info = ServerInfo(version, edition, engine_edition, databases)
+        with self._lock:
+            self._info[key] = info
+        logger.debug("Server %s is %s %s with %d databases", job.server, info.edition,
+                     info.version, len(info.databases))
+        return info
+
+    def invalidate(self, job=None):
+        """Forget cached metadata, of one server or of all of them"""
+        with self._lock:
+            if job is None:
+                self._info.clear()
+            else:
+                self._info.pop(self._key(job), None)
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
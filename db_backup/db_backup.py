@@ -1,16 +1,16 @@
 #Automate MSSQL database backup
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
-import pyodbc
 import datetime
+import multiprocessing
 import os
-import json
 import threading
-import schedule
-import time
-import winreg
 import sys
 
+from backup_engine import jobs_from_config
+from config import app_data_dir, default_config, load_config, save_config
+from service import BackupService
+
 class DatabaseBackupApp:
     def get_resource_path(self, relative_path):
         try:
@@ -24,16 +24,18 @@ class DatabaseBackupApp:
         self.root.title("Clarkeprint dbBackup Tool")
         self.root.geometry("600x550")
         
-        self.scheduler_thread = None
-        self.is_scheduler_running = False
-        self.backup_in_progress = False
-        self.stop_backup_flag = False
+        self.job_progress = {}
         
-        app_data = os.path.join(os.environ['APPDATA'], 'SQLBackupTool')
+        app_data = app_data_dir()
         os.makedirs(app_data, exist_ok=True)
         self.config_file = os.path.join(app_data, "backup_config.json")
         
         self.load_config()
+        self.service = BackupService(self.config, app_data,
+                                     on_job_done=self.on_job_done,
+                                     on_progress=self.on_job_progress,
+                                     on_status=self.show_status,
+                                     on_finished=self.on_backups_finished)
         self.create_gui()
         
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -41,26 +43,17 @@ class DatabaseBackupApp:
         if self.config.get("scheduler_active", False):
             self.start_scheduler()
             self.schedule_button.config(text="Stop Scheduler")
+
+    @property
+    def is_scheduler_running(self):
+        return self.service.scheduler_running
+
     def load_config(self):
         """Load saved database configurations"""
-        self.config = {
-            "server": "localhost",
-            "database": "",
-            "username": "",
-            "password": "",
-            "trusted_connection": "yes",
-            "backup_path": os.path.expanduser("~/Desktop/backups"),
-            "backup_time": "23:00",
-            "auto_start": False,
-            "scheduler_active": False
-        }
-        
         try:
-            if os.path.exists(self.config_file):
-                with open(self.config_file, 'r') as f:
-                    saved_config = json.load(f)
-                    self.config.update(saved_config)
+            self.config = load_config(self.config_file)
         except Exception as e:
+            self.config = default_config()
             messagebox.showerror("Error", f"Failed to load config: {str(e)}")
 
     def save_settings(self):
@@ -91,8 +84,7 @@ class DatabaseBackupApp:
             self.config["auto_start"] = self.auto_start_var.get()
             self.config["scheduler_active"] = self.is_scheduler_running
             
-            with open(self.config_file, 'w') as f:
-                json.dump(self.config, f)
+            save_config(self.config, self.config_file)
             messagebox.showinfo("Success", "Settings saved successfully!")
             return True
             
@@ -106,8 +98,7 @@ class DatabaseBackupApp:
     def save_config(self):
         """Save current configurations"""
         try:
-            with open(self.config_file, 'w') as f:
-                json.dump(self.config, f)
+            save_config(self.config, self.config_file)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save config: {str(e)}")
     
@@ -185,7 +176,7 @@ class DatabaseBackupApp:
         self.status_var = tk.StringVar(value="Ready")
         ttk.Label(self.root, textvariable=self.status_var).grid(row=3, column=0, columnspan=2, padx=5, pady=(5,0))
         
-        self.progress = ttk.Progressbar(self.root, mode='indeterminate')
+        self.progress = ttk.Progressbar(self.root, mode='determinate', maximum=100)
         self.progress.grid(row=4, column=0, columnspan=2, padx=10, pady=5, sticky="ew")
         self.progress.grid_remove()
         
@@ -212,6 +203,9 @@ class DatabaseBackupApp:
                                         command=self.toggle_scheduler)
         self.schedule_button.grid(row=0, column=4, padx=5)
         
+        ttk.Button(button_frame, text="View Backups", 
+                  command=self.show_backups).grid(row=1, column=0, columnspan=5, pady=(5, 0))
+        
         # Initial auth type setup
         self.toggle_auth()
 
@@ -226,6 +220,8 @@ class DatabaseBackupApp:
     def toggle_auto_start(self):
         """Toggle auto-start with Windows"""
         try:
+            import winreg
+
             key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, 
                             r"Software\Microsoft\Windows\CurrentVersion\Run", 
                             0, winreg.KEY_SET_VALUE)
@@ -255,19 +251,50 @@ class DatabaseBackupApp:
             self.backup_path.delete(0, tk.END)
             self.backup_path.insert(0, directory)
 
-    def get_connection_string(self):
-        """Generate connection string based on authentication type"""
-        if self.auth_type.get() == "windows":
-            return f"DRIVER={{SQL Server}};SERVER={self.server_entry.get()};DATABASE={self.db_entry.get()};Trusted_Connection=yes;"
-        else:
-            return f"DRIVER={{SQL Server}};SERVER={self.server_entry.get()};DATABASE={self.db_entry.get()};UID={self.user_entry.get()};PWD={self.pass_entry.get()}"
+    def show_backups(self):
+        """List the backups of the current database recorded in the catalog"""
+        window = tk.Toplevel(self.root)
+        window.title(f"Backups of {self.db_entry.get()}")
+        
+        columns = ("started", "type", "size", "duration", "verified", "files")
+        tree = ttk.Treeview(window, columns=columns, show="headings", height=15)
+        for column, width in zip(columns, (140, 50, 90, 70, 70, 400)):
+            tree.heading(column, text=column.title())
+            tree.column(column, width=width, anchor="w")
+        tree.grid(row=0, column=0, sticky="nsew", padx=5, pady=5)
+        window.grid_rowconfigure(0, weight=1)
+        window.grid_columnconfigure(0, weight=1)
+        
+        for record in reversed(self.service.history(self.db_entry.get())):
+            tree.insert("", tk.END, values=(
+                f"{record.started:%Y-%m-%d %H:%M}",
+                record.backup_type,
+                f"{(record.size or 0) / (1024 * 1024):.1f} MB",
+                f"{record.duration:.0f}s" if record.duration is not None else "",
+                record.verify_status or "",
+                ", ".join(record.paths),
+            ))
+
+    def current_settings(self):
+        """The config as currently entered in the form, for a one-off backup"""
+        settings = dict(self.config)
+        settings.update({
+            "server": self.server_entry.get(),
+            "database": self.db_entry.get(),
+            "trusted_connection": "yes" if self.auth_type.get() == "windows" else "no",
+            "username": self.user_entry.get(),
+            "password": self.pass_entry.get(),
+            "backup_path": self.backup_path.get(),
+            "databases": [],
+        })
+        return settings
 
     def test_connection(self):
         """Test database connection"""
         try:
-            conn = pyodbc.connect(self.get_connection_string(), autocommit=True, timeout=10)
-            conn.close()
-            messagebox.showinfo("Success", "Connection test successful!")
+            info = self.service.test_connection(jobs_from_config(self.current_settings())[0])
+            messagebox.showinfo("Success", f"Connection test successful!\n"
+                                           f"{info.edition} {info.version}")
         except Exception as e:
             messagebox.showerror("Error", f"Connection failed: {str(e)}")
 
@@ -280,195 +307,143 @@ class DatabaseBackupApp:
                 else:
                     return
 
-            if hasattr(self, 'stop_backup_flag') and self.stop_backup_flag:
+            if self.service.busy:
                 if messagebox.askokcancel("Quit", "Backup is in progress. Cancel it and exit?"):
                     self.stop_backup()
                 else:
                     return
                     
             self.save_settings()
-            self.root.destroy()
+            self.shutdown()
         except Exception as e:
             print(f"Error during cleanup: {str(e)}")
-            self.root.destroy()
+            self.shutdown()
 
-    def manage_backup_files(self, current_backup):
-        """Keep only the two most recent backups"""
+    def shutdown(self):
+        """Close the service once cancelled backups have stopped, then the window"""
+        if self.service.busy:
+            self.root.after(100, self.shutdown)
+            return
         try:
-            backup_dir = os.path.dirname(current_backup)
-            database_name = self.db_entry.get()
-            
-            backup_files = [f for f in os.listdir(backup_dir) 
-                        if f.startswith(database_name) and f.endswith('.bak')]
-            
-            backup_files.sort(key=lambda x: os.path.getctime(os.path.join(backup_dir, x)), 
-                            reverse=True)
-            
-            for old_backup in backup_files[2:]:
-                try:
-                    old_backup_path = os.path.join(backup_dir, old_backup)
-                    os.remove(old_backup_path)
-                    print(f"Removed old backup: {old_backup}")
-                except Exception as e:
-                    print(f"Error removing old backup {old_backup}: {str(e)}")
-        
-        except Exception as e:
-            print(f"Error managing backup files: {str(e)}")
-    
+            self.service.close()
+        finally:
+            self.root.destroy()
+
     def toggle_scheduler(self):
         if self.is_scheduler_running:
             self.stop_scheduler()
             self.schedule_button.config(text="Start Scheduler")
             self.scheduler_status_var.set("Scheduler: Stopped")
-        else:
-            self.start_scheduler()
+        elif self.start_scheduler():
             self.schedule_button.config(text="Stop Scheduler")
-            self.scheduler_status_var.set("Scheduler: Running")
 
     def start_scheduler(self):
-        if not self.is_scheduler_running:
-            try:
-                backup_time = self.backup_time.get()
-                datetime.datetime.strptime(backup_time, "%H:%M")
-                
-                self.is_scheduler_running = True
-                schedule.every().day.at(backup_time).do(self.start_backup)
-                
-                self.scheduler_thread = threading.Thread(target=self.run_scheduler, daemon=True)
-                self.scheduler_thread.start()
-                
-                self.scheduler_status_var.set(f"Scheduler: Running (Next: {backup_time})")
-            except ValueError:
-                messagebox.showerror("Error", "Invalid time format. Please use HH:MM format (24-hour)")
+        if self.is_scheduler_running:
+            return True
+        try:
+            backup_time = self.backup_time.get()
+            datetime.datetime.strptime(backup_time, "%H:%M")
+            self.config["backup_time"] = backup_time
+            # Scheduled backups use what is entered in the form, like one started by hand
+            self.service.config = self.current_settings()
+            self.service.start_scheduler()
+            self.scheduler_status_var.set(f"Scheduler: Running (Next: {self.service.next_run():%Y-%m-%d %H:%M})")
+            return True
+        except ValueError as e:
+            messagebox.showerror("Error", f"Invalid schedule: {str(e)}\nTimes must use HH:MM format (24-hour)")
+            return False
 
     def stop_scheduler(self):
-        self.is_scheduler_running = False
-        schedule.clear()
+        self.service.stop_scheduler()
 
-    def run_scheduler(self):
-        while self.is_scheduler_running:
-            schedule.run_pending()
-            time.sleep(60)
+    def run_on_ui(self, func, *args):
+        """Run func on the Tk thread; service callbacks arrive on worker threads"""
+        self.root.after(0, func, *args)
 
-    def start_backup(self):
+    def show_status(self, text):
+        self.run_on_ui(self.status_var.set, text)
+
+    def show_progress(self, name, percent, text):
+        self.job_progress[name] = percent
+        overall = sum(self.job_progress.values()) / len(self.job_progress)
         self.progress.grid()
-        self.progress.start()
-        
+        self.progress.config(value=overall)
+        self.status_var.set(f"{name}: {text}")
+
+    def on_job_done(self, result):
+        print(f"{result.job.name} ({result.backup_type}): {result.status}"
+              + (f" ({result.error})" if result.error else ""))
+
+    def on_job_progress(self, job, report):
+        self.run_on_ui(self.show_progress, job.name, report.percent, report.describe())
+
+    def on_backups_finished(self, backup_type, results):
+        def update():
+            if not self.service.busy:
+                self.job_progress.clear()
+                self.progress.grid_remove()
+        self.run_on_ui(update)
+
+    def backup_started(self):
+        self.job_progress.clear()
+        self.progress.grid()
+        self.progress.config(value=0)
         self.start_backup_button.config(state='disabled')
         self.stop_backup_button.grid()
         self.stop_backup_button.config(state='normal')
+
+    def backup_finished(self, results, error=None):
+        self.progress.grid_remove()
+        self.start_backup_button.config(state='normal')
+        self.stop_backup_button.grid_remove()
+        if error is not None:
+            self.status_var.set("Backup failed")
+            messagebox.showerror("Error", f"Backup failed: {error}")
+            return
+        if results is None:
+            self.status_var.set("Backup not started: backups are already running")
+            return
+        if not results:
+            self.status_var.set("Ready")
+            return
+        result = results[0]
+        if result.ok:
+            saved_to = "\n".join(result.backup_files)
+            messagebox.showinfo("Success", f"Backup completed successfully!\nSaved to: {saved_to}")
+        elif result.status == result.FAILED:
+            messagebox.showerror("Error", f"Backup failed: {result.error}")
+        self.status_var.set("Ready")
+
+    def start_backup(self):
+        """Back up the database entered in the form"""
+        try:
+            jobs = jobs_from_config(self.current_settings())
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        self.backup_started()
+        
+        def run():
+            results = error = None
+            try:
+                results = self.service.backup(jobs=jobs)
+            except Exception as e:
+                error = e
+            finally:
+                self.run_on_ui(self.backup_finished, results, error)
         
-        thread = threading.Thread(target=self.perform_backup)
+        thread = threading.Thread(target=run)
         thread.daemon = False
         thread.start()
 
     def stop_backup(self):
-        try:
-            self.stop_backup_flag = True
-            self.status_var.set("Cancelling backup...")
-            self.stop_backup_button.config(state='disabled')
-            
-            if hasattr(self, 'cancel_conn'):
-                try:
-                    cursor = self.cancel_conn.cursor()
-                    cursor.execute(f"""
-                    SELECT spid 
-                    FROM master..sysprocesses 
-                    WHERE dbid = DB_ID('{self.db_entry.get()}') 
-                    AND cmd = 'BACKUP DATABASE'
-                    """)
-                    
-                    row = cursor.fetchone()
-                    if row:
-                        cursor.execute(f"KILL {row[0]}")
-                    cursor.close()
-                except Exception as e:
-                    print(f"Error stopping backup: {str(e)}")
-        finally:
-            if hasattr(self, 'cancel_conn'):
-                try:
-                    self.cancel_conn.close()
-                except:
-                    pass
-
-    def perform_backup(self):
-        conn = None
-        backup_file = None
-        try:
-            self.stop_backup_flag = False
-            self.status_var.set("Connecting to database...")
-            conn = pyodbc.connect(self.get_connection_string(), autocommit=True, timeout=10)
-            
-            self.cancel_conn = pyodbc.connect(self.get_connection_string(), autocommit=True, timeout=10)
-            cursor = conn.cursor()
-            
-            if self.stop_backup_flag:
-                raise Exception("Backup cancelled by user")
-                
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_file = os.path.join(
-                self.backup_path.get(),
-                f"{self.db_entry.get()}_{timestamp}.bak"
-            )
-            
-            os.makedirs(os.path.dirname(backup_file), exist_ok=True)
-            
-            self.status_var.set("Starting backup process...")
-            
-            if self.stop_backup_flag:
-                raise Exception("Backup cancelled by user")
-                    
-            backup_query = f"""
-            BACKUP DATABASE [{self.db_entry.get()}]
-            TO DISK = ?
-            WITH FORMAT, STATS = 10
-            """
-            cursor.execute(backup_query, (backup_file,))
-            
-            while cursor.nextset():
-                if self.stop_backup_flag:
-                    raise Exception("Backup cancelled by user")
-                pass
-            
-            if not self.stop_backup_flag:
-                self.status_var.set("Backup completed successfully!")
-                self.manage_backup_files(backup_file)
-                
-                if not self.is_scheduler_running:
-                    messagebox.showinfo("Success", f"Backup completed successfully!\nSaved to: {backup_file}")
-            
-        except Exception as e:
-            self.status_var.set("Backup failed!" if not self.stop_backup_flag else "Backup cancelled")
-            error_msg = f"Backup failed: {str(e)}" if not self.stop_backup_flag else "Backup cancelled by user"
-            print(error_msg)
-            
-            if not self.is_scheduler_running and not self.stop_backup_flag:
-                messagebox.showerror("Error", error_msg)
-            
-            if self.stop_backup_flag and backup_file and os.path.exists(backup_file):
-                try:
-                    os.remove(backup_file)
-                except:
-                    pass
-        
-        finally:
-            self.progress.stop()
-            self.progress.grid_remove()
-            if conn:
-                try:
-                    conn.close()
-                except:
-                    pass
-            if hasattr(self, 'cancel_conn'):
-                try:
-                    self.cancel_conn.close()
-                except:
-                    pass
-            self.start_backup_button.config(state='normal')
-            self.stop_backup_button.grid_remove()
-            self.status_var.set("Ready")
+        self.status_var.set("Cancelling backup...")
+        self.stop_backup_button.config(state='disabled')
+        threading.Thread(target=self.service.cancel, daemon=True).start()
 
 if __name__ == "__main__":
+    # The compression stage's worker processes re-run this entry point when frozen
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = DatabaseBackupApp(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
@@ -0,0 +1,594 @@
+#Deduplicating repository of backup files: content-defined chunks stored once, files as chunk lists
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+from backup_options import DEDUP_SUFFIX
+from manifest import check_unchanged, read_manifest
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = "dedup_index.db"
+LOCK_FILE_NAME = "lock"
+LOCK_POLL_INTERVAL = 0.1
+PACK_DIRECTORY = "packs"
+PACK_PATTERN = re.compile(r"^pack-(\d+)\.dat$")
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# Half of all byte values, fixed forever: changing them would stop new
+# backups from sharing chunks with the ones already stored
+ANCHOR_BYTES = bytes(b for b in range(256) if hashlib.sha256(bytes([b])).digest()[0] & 1)
+ANCHOR_TABLE = bytes.maketrans(bytes(range(256)),
+                               bytes(1 if b in ANCHOR_BYTES else 0 for b in range(256)))
+READ_SIZE = 8 * 1024 * 1024
+MAX_PACK_SIZE = 1024 * 1024 * 1024
+DEFAULT_GARBAGE_RATIO = 0.2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    hash BLOB PRIMARY KEY,
+    pack INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    compressed INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS chunks_by_pack ON chunks (pack);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    stored TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS file_chunks (
+    file_id INTEGER NOT NULL REFERENCES files (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    hash BLOB NOT NULL,
+    PRIMARY KEY (file_id, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS file_chunks_by_hash ON file_chunks (hash);
+"""
+
+
+class DedupError(Exception):
+    pass
+
+
+class FileLock:
+    """An exclusive lock on a file, shared by every process that opens it"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        """Take the lock; without ``blocking`` return False if another process holds it"""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            locked = self._lock(fd, blocking)
+        except BaseException:
+            os.close(fd)
+            raise
+        if not locked:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    @staticmethod
+    def _lock(fd, blocking):
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                return True
+            except BlockingIOError:
+                return False
+        while True:
+            try:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(LOCK_POLL_INTERVAL)
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        try:
+            if fcntl is None:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            # Closing the descriptor also drops a flock
+            os.close(fd)
+
+
+class Chunker:
+    """Split a stream into chunks whose boundaries depend on their content only.
+
+    A chunk ends after the first run of ``window`` bytes that all belong to
+    ``ANCHOR_BYTES``, so a boundary depends on the bytes just before it and
+    nothing else: the same data splits the same way wherever it sits in a
+    file, and an insertion only changes the chunks around it. Translating
+    the buffer and searching it for the run both happen in C, which keeps
+    chunking far ahead of the disk. Chunks are between a quarter and four
+    times ``average`` bytes long.
+    """
+
+    def __init__(self, average=DEFAULT_CHUNK_SIZE, read_size=READ_SIZE):
+        average = max(64, int(average))
+        self.min_size = average // 4
+        self.max_size = average * 4
+        # A run of w matching bytes turns up about every 2 ** (w + 1) bytes
+        self.window = max(1, (average - self.min_size).bit_length() - 2)
+        self.anchor = b"\x01" * self.window
+        self.read_size = max(read_size, self.max_size)
+
+    def split(self, stream):
+        """Yield the chunks of ``stream`` as memoryviews, valid until the next one"""
+        buffer, start, eof = b"", 0, False
+        while True:
+            if not eof and len(buffer) - start < self.max_size:
+                data = stream.read(self.read_size)
+                eof = not data
+                buffer = buffer[start:] + data
+                start = 0
+                view = memoryview(buffer)
+                anchors = buffer.translate(ANCHOR_TABLE)
+                continue
+            if start >= len(buffer):
+                return
+            end = min(len(buffer), start + self.max_size)
+            found = anchors.find(self.anchor, start + self.min_size - self.window, end)
+            cut = end if found < 0 else found + self.window
+            yield view[start:cut]
+            start = cut
+
+
+class StoredFile:
+    """What storing one file added to the repository"""
+
+    def __init__(self, name, size, sha256, chunks, new_chunks, new_bytes):
+        self.name = name
+        self.size = size
+        self.sha256 = sha256
+        self.chunks = chunks
+        self.new_chunks = new_chunks
+        self.new_bytes = new_bytes
+
+    def __repr__(self):
+        return f"StoredFile({self.name!r}, {self.size}, {self.new_bytes} new bytes)"
+
+
+class DedupRepository:
+    """Files stored as lists of unique chunks.
+
+    Chunks are appended to pack files of up to ``MAX_PACK_SIZE`` bytes under
+    ``path/packs``, optionally zlib-compressed; a SQLite index beside them
+    maps every chunk hash to its place and every file to its chunks. Packs
+    are synced before the index commits, so the index never points at data
+    that is not on disk. Storing and restoring stream one chunk at a time.
+
+    Removing a file only drops its chunk list; ``collect_garbage`` deletes
+    chunks no file uses any more and rewrites packs that became mostly
+    garbage.
+
+    Several processes may open the same repository. While a process stores
+    or reads it holds the repository's lock file, so another process's
+    stores wait and its garbage collection skips until it is done.
+    """
+
+    def __init__(self, path, chunk_size=DEFAULT_CHUNK_SIZE, compress=False):
+        self.path = path
+        self.chunker = Chunker(chunk_size)
+        self.compress = compress
+        os.makedirs(os.path.join(path, PACK_DIRECTORY), exist_ok=True)
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(os.path.join(path, LOCK_FILE_NAME))
+        # Held while this process takes or gives up the lock file
+        self._gate = threading.Lock()
+        index = os.path.join(path, INDEX_FILE_NAME)
+        # Another process may be creating the same repository; once it exists
+        # opening it must not wait for stores that hold the lock file for long
+        creating = not os.path.exists(index) and self._file_lock.acquire()
+        try:
+            self._conn = sqlite3.connect(index, check_same_thread=False)
+            self._conn.execute("PRAGMA foreign_keys = ON")
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.executescript(SCHEMA)
+        finally:
+            if creating:
+                self._file_lock.release()
+        numbers = [int(m.group(1)) for m in map(PACK_PATTERN.match, os.listdir(self._pack_dir)) if m]
+        self._pack_number = max(numbers, default=0)
+        self._pack = None
+        self._unsynced = set()
+        # Stores and reads in progress; garbage collection waits for none
+        self._busy = 0
+
+    @property
+    def _pack_dir(self):
+        return os.path.join(self.path, PACK_DIRECTORY)
+
+    def pack_path(self, number):
+        return os.path.join(self._pack_dir, f"pack-{number:06d}.dat")
+
+    def close(self):
+        with self._lock:
+            self._close_pack()
+            self._conn.close()
+
+    def _close_pack(self):
+        if self._pack is not None:
+            self._pack.close()
+            self._pack = None
+
+    def _resume(self):
+        """Catch up with packs other processes added or removed; lock file held"""
+        self._close_pack()
+        numbers = [int(m.group(1)) for m in map(PACK_PATTERN.match, os.listdir(self._pack_dir)) if m]
+        self._pack_number = max(numbers, default=0)
+
+    def _append(self, data):
+        """Write a chunk to the current pack and return (pack, offset); both locks held"""
+        if self._pack is None or os.fstat(self._pack.fileno()).st_size >= MAX_PACK_SIZE:
+            self._sync()
+            self._close_pack()
+            if self._pack_number == 0 or os.path.exists(self.pack_path(self._pack_number)) \
+                    and os.path.getsize(self.pack_path(self._pack_number)) >= MAX_PACK_SIZE:
+                self._pack_number += 1
+            self._pack = open(self.pack_path(self._pack_number), 'ab')
+        # The real end of the file, whoever appended last
+        offset = os.fstat(self._pack.fileno()).st_size
+        self._pack.write(data)
+        self._pack.flush()
+        self._unsynced.add(self._pack_number)
+        return self._pack_number, offset
+
+    def _sync(self):
+        if self._pack is not None and self._unsynced:
+            self._pack.flush()
+            os.fsync(self._pack.fileno())
+        self._unsynced.clear()
+
+    def store(self, source, name=None):
+        """Add the file ``source`` under ``name`` (its absolute path by default)"""
+        name = name or os.path.abspath(source)
+        digest = hashlib.sha256()
+        hashes = []
+        new = {}
+        size = new_bytes = 0
+        with self._using(), open(source, 'rb') as f:
+            for chunk in self.chunker.split(f):
+                digest.update(chunk)
+                key = hashlib.sha256(chunk).digest()
+                hashes.append(key)
+                size += len(chunk)
+                if key in new:
+                    continue
+                with self._lock:
+                    if self._conn.execute("SELECT 1 FROM chunks WHERE hash = ?",
+                                          (key,)).fetchone():
+                        continue
+                    data = zlib.compress(chunk, 1) if self.compress else chunk
+                    compressed = self.compress and len(data) < len(chunk)
+                    if not compressed:
+                        data = chunk
+                    pack, offset = self._append(data)
+                new[key] = (pack, offset, len(data), len(chunk), int(compressed))
+                new_bytes += len(data)
+
+            self._commit(name, size, digest.hexdigest(), hashes, new)
+        return StoredFile(name, size, digest.hexdigest(), len(hashes), len(new), new_bytes)
+
+    def _commit(self, name, size, sha256, hashes, new):
+        with self._lock:
+            self._sync()
+            with self._conn:
+                if self._conn.execute("SELECT 1 FROM files WHERE name = ?", (name,)).fetchone():
+                    raise DedupError(f"{name} is already in the repository")
+                self._conn.executemany(
+                    """INSERT OR IGNORE INTO chunks (hash, pack, offset, length, size, compressed)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                    [(key,) + location for key, location in new.items()])
+                file_id = self._conn.execute(
+                    "INSERT INTO files (name, size, sha256, stored) VALUES (?, ?, ?, ?)",
+                    (name, size, sha256, datetime.datetime.now().isoformat(sep=" "))).lastrowid
+                self._conn.executemany(
+                    "INSERT INTO file_chunks (file_id, seq, hash) VALUES (?, ?, ?)",
+                    [(file_id, seq, key) for seq, key in enumerate(hashes)])
+
+    @contextlib.contextmanager
+    def _using(self):
+        # The first store or read of this process takes the lock file and
+        # the last one lets it go
+        with self._gate:
+            if not self._busy:
+                self._file_lock.acquire()
+                with self._lock:
+                    self._resume()
+            with self._lock:
+                self._busy += 1
+        try:
+            yield
+        finally:
+            with self._gate, self._lock:
+                self._busy -= 1
+                if not self._busy:
+                    self._sync()
+                    # Another process may rewrite or delete this pack next
+                    self._close_pack()
+                    self._file_lock.release()
+
+    def files(self):
+        """{name: (size, sha256)} of every stored file"""
+        with self._lock:
+            return {name: (size, sha256) for name, size, sha256 in
+                    self._conn.execute("SELECT name, size, sha256 FROM files ORDER BY id")}
+
+    def _file(self, name):
+        with self._lock:
+            row = self._conn.execute("SELECT id, size, sha256 FROM files WHERE name = ?",
+                                     (name,)).fetchone()
+        if not row:
+            raise DedupError(f"{name} is not in the repository")
+        return row
+
+    def read(self, name):
+        """Yield the contents of a stored file chunk by chunk"""
+        file_id, _, _ = self._file(name)
+        packs = {}
+        with self._using():
+            with self._lock:
+                locations = self._conn.execute(
+                    """SELECT c.pack, c.offset, c.length, c.compressed FROM file_chunks f
+                       JOIN chunks c ON c.hash = f.hash
+                       WHERE f.file_id = ? ORDER BY f.seq""", (file_id,)).fetchall()
+            try:
+                for pack, offset, length, compressed in locations:
+                    f = packs.get(pack)
+                    if f is None:
+                        f = packs[pack] = open(self.pack_path(pack), 'rb')
+                    f.seek(offset)
+                    data = f.read(length)
+                    yield zlib.decompress(data) if compressed else data
+            finally:
+                for f in packs.values():
+                    f.close()
+
+    def restore(self, name, destination):
+        """Reassemble a stored file at ``destination``, checking its size and SHA-256"""
+        _, size, sha256 = self._file(name)
+        digest = hashlib.sha256()
+        written = 0
+        temporary = destination + ".tmp"
+        try:
+            with open(temporary, 'wb') as f:
+                for data in self.read(name):
+                    digest.update(data)
+                    written += len(data)
+                    f.write(data)
+            if written != size or digest.hexdigest() != sha256:
+                raise DedupError(f"{name} restored as {written} bytes with SHA-256 "
+                                 f"{digest.hexdigest()}, expected {size} bytes and {sha256}")
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        os.replace(temporary, destination)
+        return destination
+
+    def remove(self, name):
+        """Forget a file; its chunks stay until the next garbage collection"""
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM files WHERE name = ?", (name,)).rowcount > 0
+
+    def stats(self):
+        """Logical size of the stored files against what the packs take on disk"""
+        with self._lock:
+            files, logical = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+            chunks, unique = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM chunks").fetchone()
+            self._sync()
+        stored = sum(os.path.getsize(os.path.join(self._pack_dir, f))
+                     for f in os.listdir(self._pack_dir) if PACK_PATTERN.match(f))
+        return {"files": files, "chunks": chunks, "logical_bytes": logical,
+                "unique_bytes": unique, "stored_bytes": stored,
+                "ratio": logical / stored if stored else 0.0}
+
+    def collect_garbage(self, min_garbage_ratio=DEFAULT_GARBAGE_RATIO):
+        """Drop unused chunks and rewrite packs at least ``min_garbage_ratio`` garbage.
+
+        Chunks only move while nothing is stored or read, so it does nothing
+        when the repository is in use, by this process or another one.
+        Returns the bytes reclaimed on disk.
+        """
+        with self._gate, self._lock:
+            if self._busy or not self._file_lock.acquire(blocking=False):
+                logger.info("Dedup repository in use, garbage collection skipped")
+                return 0
+            try:
+                self._resume()
+                reclaimed = self._collect_garbage(min_garbage_ratio)
+            finally:
+                self._close_pack()
+                self._file_lock.release()
+        return reclaimed
+
+    def _collect_garbage(self, min_garbage_ratio):
+        with self._lock:
+            with self._conn:
+                dropped = self._conn.execute(
+                    "DELETE FROM chunks WHERE hash NOT IN (SELECT hash FROM file_chunks)").rowcount
+            live = dict(self._conn.execute(
+                "SELECT pack, SUM(length) FROM chunks GROUP BY pack").fetchall())
+
+            rewrite = []
+            for f in os.listdir(self._pack_dir):
+                match = PACK_PATTERN.match(f)
+                if not match:
+                    continue
+                number = int(match.group(1))
+                size = os.path.getsize(self.pack_path(number))
+                if size and (size - live.get(number, 0)) / size >= min_garbage_ratio:
+                    rewrite.append((number, size))
+            if not rewrite:
+                logger.info("Dedup garbage collection dropped %d chunks, no pack to rewrite",
+                            dropped)
+                return 0
+
+            # Survivors go to fresh packs, never to one about to be deleted
+            self._pack_number = max(self._pack_number, max(n for n, _ in rewrite)) + 1
+            moved = []
+            for number, _ in rewrite:
+                rows = self._conn.execute(
+                    "SELECT hash, offset, length FROM chunks WHERE pack = ? ORDER BY offset",
+                    (number,)).fetchall()
+                if not rows:
+                    continue
+                with open(self.pack_path(number), 'rb') as f:
+                    for key, offset, length in rows:
+                        f.seek(offset)
+                        pack, new_offset = self._append(f.read(length))
+                        moved.append((pack, new_offset, key))
+            self._sync()
+            with self._conn:
+                self._conn.executemany("UPDATE chunks SET pack = ?, offset = ? WHERE hash = ?",
+                                       moved)
+            self._close_pack()
+
+            reclaimed = 0
+            for number, size in rewrite:
+                os.remove(self.pack_path(number))
+                reclaimed += size
+            reclaimed -= sum(live.get(number, 0) for number, _ in rewrite)
+        logger.info("Dedup garbage collection dropped %d chunks, rewrote %d packs "
+                    "and reclaimed %d bytes", dropped, len(rewrite), reclaimed)
+        return reclaimed
+
+
+_repositories = {}
+_repositories_lock = threading.Lock()
+
+
+def open_repository(path, chunk_size=DEFAULT_CHUNK_SIZE, compress=False):
+    """The process-wide repository at ``path``, opened on first use"""
+    key = os.path.abspath(path)
+    with _repositories_lock:
+        repository = _repositories.get(key)
+        if repository is None:
+            repository = _repositories[key] = DedupRepository(key, chunk_size, compress)
+        return repository
+
+
+def close_repositories():
+    with _repositories_lock:
+        repositories = list(_repositories.values())
+        _repositories.clear()
+    for repository in repositories:
+        repository.close()
+
+
+def pointer_path(path):
+    return path + DEDUP_SUFFIX
+
+
+def write_pointer(path, repository, stored):
+    """Leave a small file where a backup was, naming where its content went"""
+    pointer = pointer_path(path)
+    with open(pointer, 'w') as f:
+        json.dump({"repository": repository.path, "name": stored.name, "size": stored.size,
+                   "sha256": stored.sha256}, f, indent=2)
+    return pointer
+
+
+def read_pointer(pointer):
+    with open(pointer, 'r') as f:
+        return json.load(f)
+
+
+def rehydrate(pointer, destination=None):
+    """Rebuild the original backup a pointer file stands for; returns its path"""
+    details = read_pointer(pointer)
+    destination = destination or pointer[:-len(DEDUP_SUFFIX)]
+    return open_repository(details["repository"]).restore(details["name"], destination)
+
+
+def forget(pointer):
+    """Drop the file a pointer stands for from its repository"""
+    details = read_pointer(pointer)
+    open_repository(details["repository"]).remove(details["name"])
+
+
+class DedupStage:
+    """Post-backup stage moving every stripe into the deduplicating repository.
+
+    Each stripe is replaced by a pointer file (``.bak.dedup``) that the
+    catalog and retention track like any backup file; deleting it through
+    retention also drops the stripe from the repository. Stripes that
+    changed since the manifest stage hashed them are refused.
+    """
+
+    name = "dedup"
+
+    def __init__(self, repository, catalog=None):
+        self.repository = repository
+        self.catalog = catalog
+
+    def run(self, job, result):
+        started = datetime.datetime.now()
+        if result.manifest:
+            check_unchanged(read_manifest(result.manifest), result.backup_files)
+        stored = []
+        pointers = []
+        try:
+            for path in result.backup_files:
+                stored.append(self.repository.store(path))
+                pointers.append(write_pointer(path, self.repository, stored[-1]))
+        except BaseException:
+            for entry in stored:
+                self.repository.remove(entry.name)
+            for pointer in pointers:
+                os.remove(pointer)
+            raise
+
+        for path in result.backup_files:
+            os.remove(path)
+        result.backup_files = pointers
+        if self.catalog is not None and result.catalog_id is not None:
+            self.catalog.replace_files(result.catalog_id, pointers)
+
+        original = sum(entry.size for entry in stored)
+        added = sum(entry.new_bytes for entry in stored)
+        elapsed = (datetime.datetime.now() - started).total_seconds()
+        logger.info("Deduplicated %s: %d bytes stored as %d new bytes in %.1fs",
+                    job.name, original, added, elapsed)
+        return original
+
+
+def repository_from_config(config):
+    path = config.get("dedup_repository")
+    if not path:
+        return None
+    return open_repository(path, config.get("dedup_chunk_size", DEFAULT_CHUNK_SIZE),
+                           config.get("dedup_compress", False))
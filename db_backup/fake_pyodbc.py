@@ -0,0 +1,381 @@
+#Simulated SQL Server behind the pyodbc interface, for benchmarks and runs without a server
+"""A stand-in for ``pyodbc`` that answers the statements this tool sends.
+
+Select it with ``"driver": "fake"`` in the config or ``DB_BACKUP_DRIVER=fake``.
+Servers and databases named in a connection string or a ``USE`` are created
+on first sight with the defaults below; ``add_server`` sets them up
+explicitly. A BACKUP takes ``size / throughput * time_scale`` seconds,
+reports STATS percentages as result sets like the real driver, writes its
+stripes (``write_bytes`` of them, not the whole database) and can be made
+to fail or hang.
+"""
+import itertools
+import os
+import random
+import re
+import threading
+import time
+
+apilevel = "2.0"
+threadsafety = 1
+paramstyle = "qmark"
+
+DEFAULT_DATABASE_SIZE = 64 * 1024 * 1024
+DEFAULT_THROUGHPUT = 200 * 1024 * 1024
+DEFAULT_WRITE_BYTES = 64 * 1024
+PAGE_SIZE = 8192
+
+
+class Error(Exception):
+    pass
+
+
+class DatabaseError(Error):
+    pass
+
+
+class OperationalError(DatabaseError):
+    pass
+
+
+class ProgrammingError(DatabaseError):
+    pass
+
+
+class FakeDatabase:
+    def __init__(self, name, size=DEFAULT_DATABASE_SIZE, log_size=None, recovery_model="FULL",
+                 state="ONLINE"):
+        self.name = name
+        self.size = size
+        self.log_size = size // 10 if log_size is None else log_size
+        self.recovery_model = recovery_model
+        self.state = state
+        self.lsn = 1000
+
+
+class FakeServer:
+    """One simulated instance and what it is set up to do.
+
+    ``failure_rate`` is the chance a BACKUP fails part way, ``fail_databases``
+    always fail and ``hang_databases`` stop reporting until they are killed.
+    Backup files in ``corrupt_files`` fail RESTORE VERIFYONLY and test restores.
+    ``connect_failures`` connection attempts fail with a transient error
+    before connecting works again.
+    """
+
+    def __init__(self, name, version="16.0.1000.6", edition="Developer Edition (64-bit)",
+                 engine_edition=3, throughput=DEFAULT_THROUGHPUT, time_scale=1.0,
+                 connect_latency=0.0, write_bytes=DEFAULT_WRITE_BYTES, failure_rate=0.0,
+                 auto_create=True, seed=None):
+        self.name = name
+        self.version = version
+        self.edition = edition
+        self.engine_edition = engine_edition
+        self.throughput = throughput
+        self.time_scale = time_scale
+        self.connect_latency = connect_latency
+        self.write_bytes = write_bytes
+        self.failure_rate = failure_rate
+        self.auto_create = auto_create
+        self.connect_failures = 0
+        self.fail_databases = set()
+        self.hang_databases = set()
+        # Set once a backup of one of them is hanging
+        self.hanging = threading.Event()
+        self.corrupt_files = set()
+        self.databases = {}
+        # physical_device_name -> (first_lsn, last_lsn, database_backup_lsn)
+        self.history = {}
+        self.sessions = {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.add_database("master", recovery_model="SIMPLE")
+
+    def add_database(self, name, **settings):
+        database = FakeDatabase(name, **settings)
+        self.databases[name] = database
+        return database
+
+    def database(self, name):
+        with self.lock:
+            database = self.databases.get(name)
+            if database is None and self.auto_create:
+                database = self.add_database(name)
+        if database is None:
+            raise ProgrammingError("42000", f"Database '{name}' does not exist.")
+        return database
+
+
+servers = {}
+_servers_lock = threading.Lock()
+_session_ids = itertools.count(51)
+
+
+def add_server(name, **settings):
+    """Create (or replace) the simulated server ``name``"""
+    with _servers_lock:
+        servers[name.lower()] = server = FakeServer(name, **settings)
+    return server
+
+
+def get_server(name):
+    with _servers_lock:
+        server = servers.get(name.lower())
+        if server is None:
+            server = servers[name.lower()] = FakeServer(name)
+        return server
+
+
+def reset():
+    """Forget every simulated server"""
+    with _servers_lock:
+        servers.clear()
+
+
+def _parse_connection_string(text):
+    settings = {}
+    for part in text.split(";"):
+        if "=" in part:
+            key, value = part.split("=", 1)
+            settings[key.strip().upper()] = value.strip()
+    return settings
+
+
+def connect(connection_string, autocommit=False, timeout=0, **kwargs):
+    settings = _parse_connection_string(connection_string)
+    server = get_server(settings.get("SERVER", "localhost"))
+    if server.connect_latency:
+        time.sleep(server.connect_latency)
+    with server.lock:
+        if server.connect_failures:
+            server.connect_failures -= 1
+            raise OperationalError("08001", "[Fake] SQL Server does not exist or access denied.")
+    return Connection(server, settings.get("DATABASE", "master"), autocommit)
+
+
+class Connection:
+    def __init__(self, server, database, autocommit):
+        self.server = server
+        self.database = server.database(database).name
+        self.autocommit = autocommit
+        self.session_id = next(_session_ids)
+        self.killed = threading.Event()
+        self.closed = False
+        with server.lock:
+            server.sessions[self.session_id] = self
+
+    def cursor(self):
+        if self.closed:
+            raise ProgrammingError("HY000", "Attempt to use a closed connection.")
+        return Cursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+        with self.server.lock:
+            self.server.sessions.pop(self.session_id, None)
+
+
+class _Backup:
+    """A BACKUP in flight: the STATS steps still to report"""
+
+    def __init__(self, cursor, database, files, backup_type):
+        server = cursor.connection.server
+        self.cursor = cursor
+        self.server = server
+        self.database = database
+        self.files = files
+        self.backup_type = backup_type
+        self.size = database.log_size if backup_type == "log" else database.size
+        self.seconds = self.size / server.throughput * server.time_scale
+        self.started = time.monotonic()
+        stats = re.search(r"STATS\s*=\s*(\d+)", cursor.statement, re.IGNORECASE)
+        step = int(stats.group(1)) if stats else 100
+        self.percents = list(range(step, 100, step)) + [100]
+        self.fail_at = None
+        if (database.name in server.fail_databases
+                or server.random.random() < server.failure_rate):
+            self.fail_at = server.random.randrange(len(self.percents))
+        for path in files:
+            open(path, 'wb').close()
+
+    def advance(self):
+        """Wait for the next STATS step; returns its messages and whether more follow"""
+        if self.database.name in self.server.hang_databases:
+            self.server.hanging.set()
+            self._wait(None)
+        percent = self.percents.pop(0)
+        self._wait(self.started + self.seconds * percent / 100 - time.monotonic())
+        if self.fail_at is not None and len(self.percents) <= self.fail_at:
+            self._write(percent)
+            raise ProgrammingError("42000", f"BACKUP DATABASE is terminating abnormally. "
+                                            f"(simulated failure of {self.database.name})")
+        messages = [("[01000] (3211)", f"{percent} percent processed.")]
+        if self.percents:
+            return messages, True
+        self._write(100)
+        self._record()
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        pages = self.size // PAGE_SIZE
+        kind = "BACKUP LOG" if self.backup_type == "log" else "BACKUP DATABASE"
+        messages.append(("[01000] (3014)",
+                         f"{kind} successfully processed {pages} pages in {elapsed:.3f} seconds "
+                         f"({self.size / elapsed / 1024 / 1024:.3f} MB/sec)."))
+        return messages, False
+
+    def _wait(self, seconds):
+        """Sleep, but wake at once for a cancel or a KILL"""
+        connection = self.cursor.connection
+        deadline = None if seconds is None else time.monotonic() + max(seconds, 0)
+        while True:
+            if connection.killed.is_set():
+                raise OperationalError("08S01", "[Fake] Communication link failure")
+            if self.cursor.cancelled.is_set():
+                raise OperationalError("HY008", "[Fake] Operation canceled")
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return
+            connection.killed.wait(0.05 if remaining is None else min(remaining, 0.05))
+
+    def _write(self, percent):
+        size = self.server.write_bytes * percent // 100
+        per_file = max(1, size // len(self.files))
+        for path in self.files:
+            with open(path, 'wb') as f:
+                f.write(os.urandom(per_file))
+
+    def _record(self):
+        database = self.database
+        with self.server.lock:
+            first = database.lsn
+            database.lsn += 100
+            for path in self.files:
+                self.server.history[path] = (first, database.lsn, first)
+
+
+class Cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.messages = []
+        self.statement = ""
+        self.cancelled = threading.Event()
+        self._rows = []
+        self._backup = None
+
+    def execute(self, statement, *params):
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = tuple(params[0])
+        connection = self.connection
+        if connection.killed.is_set():
+            raise OperationalError("08S01", "[Fake] Communication link failure")
+        self.statement = statement
+        self.messages = []
+        self._rows = []
+        self._backup = None
+        self.cancelled.clear()
+        text = " ".join(statement.split())
+        upper = text.upper()
+        server = connection.server
+
+        if upper.startswith("USE "):
+            connection.database = server.database(text[4:].strip(" []")).name
+        elif upper == "SELECT 1":
+            self._rows = [(1,)]
+        elif upper == "SELECT @@SPID":
+            self._rows = [(connection.session_id,)]
+        elif "SERVERPROPERTY('PRODUCTVERSION')" in upper:
+            self._rows = [(server.version, server.edition, server.engine_edition)]
+        elif "FROM SYS.DATABASES" in upper:
+            self._rows = [(d.name, d.state, d.recovery_model) for d in server.databases.values()]
+        elif "FROM SYS.DATABASE_FILES" in upper:
+            self._rows = [(server.database(connection.database).size,)]
+        elif "DM_DB_LOG_SPACE_USAGE" in upper:
+            self._rows = [(server.database(connection.database).log_size,)]
+        elif "MSDB.DBO.BACKUPSET" in upper:
+            lsns = server.history.get(params[0]) if params else None
+            self._rows = [lsns] if lsns else []
+        elif upper.startswith("KILL "):
+            self._kill(int(upper.split()[1]))
+        elif upper.startswith("BACKUP "):
+            match = re.match(r"BACKUP (DATABASE|LOG) \[(.+?)\]", text, re.IGNORECASE)
+            database = server.database(match.group(2))
+            if database.state != "ONLINE":
+                raise ProgrammingError("42000", f"Database '{database.name}' is not online.")
+            if match.group(1).upper() == "LOG" and database.recovery_model == "SIMPLE":
+                raise ProgrammingError("42000", "The statement BACKUP LOG is not allowed while "
+                                                "the recovery model is SIMPLE.")
+            backup_type = "log" if match.group(1).upper() == "LOG" else (
+                "diff" if "DIFFERENTIAL" in upper else "full")
+            self._backup = _Backup(self, database, list(params), backup_type)
+            self.messages, more = self._backup.advance()
+            if not more:
+                self._backup = None
+        elif upper.startswith("RESTORE VERIFYONLY"):
+            self._verify(params)
+        elif upper.startswith("RESTORE FILELISTONLY"):
+            self._verify(params, read=False)
+            name = re.sub(r"_\d{8}_\d{6}.*$", "", os.path.basename(params[0]))
+            self._rows = [(name, f"D:\\Data\\{name}.mdf", "D"),
+                          (f"{name}_log", f"L:\\Logs\\{name}_log.ldf", "L")]
+        elif upper.startswith("RESTORE DATABASE"):
+            name = re.match(r"RESTORE DATABASE \[(.+?)\]", text, re.IGNORECASE).group(1)
+            disks = upper.split(" WITH ")[0].count("DISK = ?")
+            self._verify(params[:disks])
+            with server.lock:
+                server.add_database(name)
+        elif upper.startswith("DBCC CHECKDB"):
+            self.messages = []
+        elif "DROP DATABASE" in upper:
+            name = re.search(r"DROP DATABASE \[(.+?)\]", text, re.IGNORECASE).group(1)
+            with server.lock:
+                server.databases.pop(name, None)
+        else:
+            raise ProgrammingError("42000", f"[Fake] Statement not simulated: {text[:60]}")
+        return self
+
+    def _kill(self, session_id):
+        with self.connection.server.lock:
+            target = self.connection.server.sessions.get(session_id)
+        if target is None:
+            raise ProgrammingError("42000", f"Process ID {session_id} is not an active process ID.")
+        target.killed.set()
+
+    def _verify(self, params, read=True):
+        server = self.connection.server
+        total = 0
+        for path in params:
+            if not os.path.exists(path):
+                raise ProgrammingError("42000", f"Cannot open backup device '{path}'.")
+            if path in server.corrupt_files:
+                raise ProgrammingError("42000", f"The media family on device '{path}' is "
+                                                "incorrectly formed.")
+            total += os.path.getsize(path)
+        if read:
+            time.sleep(total / server.throughput * server.time_scale)
+        self.messages = [("[01000] (3262)", "The backup set on file 1 is valid.")]
+
+    def nextset(self):
+        if self._backup is None:
+            return False
+        self.messages, more = self._backup.advance()
+        if not more:
+            self._backup = None
+        return True
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        pass
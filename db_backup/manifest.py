@@ -0,0 +1,144 @@
+#SHA-256 manifests of finished backup sets
+import datetime
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from backup_options import STRIPE_PATTERN, split_backup_name
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 8 * 1024 * 1024
+MANIFEST_SUFFIX = ".manifest.json"
+DEFAULT_HASH_WORKERS = 4
+
+
+class ManifestError(Exception):
+    """A backup file does not match its manifest"""
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    """Stream a file through SHA-256 and return (hex digest, size).
+
+    Reads go into one reused buffer, and hashlib releases the GIL on large
+    updates, so several files hash in parallel on a thread pool.
+    """
+    digest = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    size = 0
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            digest.update(view[:count])
+            size += count
+    return digest.hexdigest(), size
+
+
+def set_digest(files):
+    """One checksum for a whole striped set, derived from its stripes' digests"""
+    digest = hashlib.sha256()
+    for entry in files:
+        digest.update(f"{entry['name']}:{entry['size']}:{entry['sha256']}\n".encode())
+    return digest.hexdigest()
+
+
+def manifest_path(backup_files):
+    """Where the manifest of a set lives: beside its first stripe.
+
+    The name keeps the backup extension, so a diff and a log of a database
+    taken in the same second get a manifest each.
+    """
+    first = backup_files[0]
+    stem, extension, _ = split_backup_name(first)
+    name = STRIPE_PATTERN.sub("", stem) + extension + MANIFEST_SUFFIX
+    return os.path.join(os.path.dirname(first), name)
+
+
+def build_manifest(backup_files, workers=DEFAULT_HASH_WORKERS, **details):
+    """Hash every stripe of a set in parallel and return the manifest dict"""
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(backup_files))),
+                            thread_name_prefix="hash") as pool:
+        hashes = list(pool.map(hash_file, backup_files))
+
+    files = []
+    for path, (sha256, size) in zip(backup_files, hashes):
+        files.append({
+            "name": os.path.basename(path),
+            "path": path,
+            "size": size,
+            "mtime": os.path.getmtime(path),
+            "sha256": sha256,
+        })
+    manifest = dict(details)
+    manifest.update({
+        "created": datetime.datetime.now().isoformat(),
+        "algorithm": "sha256",
+        "files": files,
+        "sha256": set_digest(files),
+    })
+    return manifest
+
+
+def write_manifest(manifest, path):
+    temporary = path + ".tmp"
+    with open(temporary, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temporary, path)
+
+
+def read_manifest(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def check_unchanged(manifest, paths=None):
+    """Cheaply confirm the files still match the manifest, without re-hashing.
+
+    Compares size and modification time, which is enough to know nothing
+    rewrote a file since it was hashed. ``paths`` limits the check to those
+    files. Raises ManifestError otherwise.
+    """
+    for entry in manifest["files"]:
+        path = entry["path"]
+        if paths is not None and path not in paths:
+            continue
+        if not os.path.exists(path):
+            raise ManifestError(f"{path} is missing")
+        stat = os.stat(path)
+        if stat.st_size != entry["size"] or abs(stat.st_mtime - entry["mtime"]) > 1e-3:
+            raise ManifestError(f"{path} changed since its manifest was written")
+
+
+class ManifestStage:
+    """Post-backup stage writing a SHA-256 manifest beside the backup set.
+
+    The set checksum also goes into the catalog, and the manifest path onto
+    the job result so later stages can validate against it.
+    """
+
+    name = "manifest"
+
+    def __init__(self, workers=DEFAULT_HASH_WORKERS, catalog=None):
+        self.workers = workers
+        self.catalog = catalog
+
+    def run(self, job, result):
+        started = datetime.datetime.now()
+        manifest = build_manifest(result.backup_files, self.workers,
+                                  server=job.server, database=job.database,
+                                  backup_type=result.backup_type)
+        path = manifest_path(result.backup_files)
+        write_manifest(manifest, path)
+        result.manifest = path
+        result.checksum = manifest["sha256"]
+        if self.catalog is not None and result.catalog_id is not None:
+            self.catalog.update(result.catalog_id, checksum=result.checksum)
+        elapsed = (datetime.datetime.now() - started).total_seconds()
+        total = sum(entry["size"] for entry in manifest["files"])
+        logger.info("Hashed %d bytes of %s in %.1fs", total, job.name, elapsed)
+        return total
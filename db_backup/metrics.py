@@ -0,0 +1,371 @@
+#Per-phase timings of backup jobs, their history, exports and trend reports
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+
+from progress import format_bytes, format_duration
+
+logger = logging.getLogger(__name__)
+
+METRICS_FILE_NAME = "backup_metrics.db"
+DEFAULT_HISTORY_DAYS = 90
+# A phase whose recent median is this much slower than before is flagged
+REGRESSION_THRESHOLD = 1.25
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS job_runs (
+    id INTEGER PRIMARY KEY,
+    server TEXT NOT NULL,
+    database TEXT NOT NULL,
+    backup_type TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started TEXT NOT NULL,
+    duration REAL,
+    bytes INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS job_runs_by_database ON job_runs (database, started);
+CREATE INDEX IF NOT EXISTS job_runs_by_job ON job_runs (server, database, backup_type);
+CREATE TABLE IF NOT EXISTS job_phases (
+    run_id INTEGER NOT NULL REFERENCES job_runs (id) ON DELETE CASCADE,
+    phase TEXT NOT NULL,
+    started TEXT NOT NULL,
+    duration REAL NOT NULL,
+    bytes INTEGER,
+    ok INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_phases_by_run ON job_phases (run_id);
+"""
+
+
+class Phase:
+    """How long one phase of a job took and how many bytes it moved"""
+
+    def __init__(self, name, started, duration=0.0, bytes=None, ok=True):
+        self.name = name
+        self.started = started
+        self.duration = duration
+        self.bytes = bytes
+        self.ok = ok
+
+    @property
+    def bytes_per_second(self):
+        if not self.bytes or not self.duration:
+            return None
+        return self.bytes / self.duration
+
+    def as_dict(self):
+        return {"phase": self.name, "started": self.started.isoformat(),
+                "duration": self.duration, "bytes": self.bytes,
+                "bytes_per_second": self.bytes_per_second, "ok": self.ok}
+
+    def __repr__(self):
+        return f"Phase({self.name!r}, {self.duration:.3f}s)"
+
+
+class JobMetrics:
+    """The phases of one job, in the order they ran.
+
+    ``with metrics.phase("backup") as phase:`` times a block; set
+    ``phase.bytes`` inside it. A phase left by an exception is kept and
+    marked as failed, so slow failures show up too.
+    """
+
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        record = Phase(name, datetime.datetime.now())
+        started = time.monotonic()
+        try:
+            yield record
+        except BaseException:
+            record.ok = False
+            raise
+        finally:
+            record.duration = time.monotonic() - started
+            self.phases.append(record)
+
+    def get(self, name):
+        for phase in self.phases:
+            if phase.name == name:
+                return phase
+        return None
+
+    @property
+    def duration(self):
+        return sum(phase.duration for phase in self.phases)
+
+
+class JobRun:
+    """One job as recorded in the metrics history"""
+
+    def __init__(self, id, server, database, backup_type, status, started, duration, bytes,
+                 error, phases=()):
+        self.id = id
+        self.server = server
+        self.database = database
+        self.backup_type = backup_type
+        self.status = status
+        self.started = datetime.datetime.fromisoformat(started)
+        self.duration = duration
+        self.bytes = bytes
+        self.error = error
+        self.phases = list(phases)
+
+    @property
+    def name(self):
+        return f"{self.server}/{self.database}"
+
+    def phase(self, name):
+        for phase in self.phases:
+            if phase.name == name:
+                return phase
+        return None
+
+    def as_dict(self):
+        return {"server": self.server, "database": self.database,
+                "backup_type": self.backup_type, "status": self.status,
+                "started": self.started.isoformat(), "duration": self.duration,
+                "bytes": self.bytes, "error": self.error,
+                "phases": [phase.as_dict() for phase in self.phases]}
+
+    def __repr__(self):
+        return f"JobRun({self.name!r}, {self.backup_type!r}, {self.status!r})"
+
+
+class MetricsHistory:
+    """Every job's phase timings, kept in SQLite beside the catalog"""
+
+    def __init__(self, path):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def record(self, result):
+        """Append a finished job and its phases; returns the run id"""
+        metrics = getattr(result, "metrics", None)
+        phases = metrics.phases if metrics else []
+        backup = metrics.get("backup") if metrics else None
+        started = result.started or (phases[0].started if phases else datetime.datetime.now())
+        duration = result.duration if result.duration is not None else (
+            metrics.duration if metrics else None)
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                """INSERT INTO job_runs (server, database, backup_type, status, started,
+                                         duration, bytes, error)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (result.job.server, result.job.database, result.backup_type, result.status,
+                 started.isoformat(sep=" "), duration, backup.bytes if backup else None,
+                 result.error))
+            run_id = cursor.lastrowid
+            self._conn.executemany(
+                """INSERT INTO job_phases (run_id, phase, started, duration, bytes, ok)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                [(run_id, p.name, p.started.isoformat(sep=" "), p.duration, p.bytes, int(p.ok))
+                 for p in phases])
+        return run_id
+
+    def runs(self, database=None, since=None, backup_type=None, status=None, last=None):
+        """Recorded runs, oldest first.
+
+        ``last`` keeps only the newest that many matching runs of every
+        server, database and backup type.
+        """
+        clauses, params = [], []
+        if database is not None:
+            clauses.append("r.database = ?")
+            params.append(database)
+        if backup_type is not None:
+            clauses.append("r.backup_type = ?")
+            params.append(backup_type)
+        if status is not None:
+            clauses.append("r.status = ?")
+            params.append(status)
+        if since is not None:
+            clauses.append("r.started >= ?")
+            params.append(since.isoformat(sep=" "))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        if last is not None:
+            clauses.append(f"""r.id IN (SELECT id FROM (
+                                   SELECT id, ROW_NUMBER() OVER (
+                                       PARTITION BY server, database, backup_type
+                                       ORDER BY id DESC) AS position
+                                   FROM job_runs r {where})
+                               WHERE position <= ?)""")
+            params = params + params + [int(last)]
+            where = f"WHERE {' AND '.join(clauses)}"
+        return self._select(where, params)
+
+    def latest(self):
+        """The last run of every server, database and backup type"""
+        return self._select("""WHERE r.id IN (SELECT MAX(id) FROM job_runs
+                                              GROUP BY server, database, backup_type)""", [])
+
+    def _select(self, where, params):
+        with self._lock:
+            rows = self._conn.execute(
+                f"""SELECT id, server, database, backup_type, status, started, duration, bytes,
+                           error
+                    FROM job_runs r {where} ORDER BY started, id""", params).fetchall()
+            phases = {}
+            for run_id, name, started, duration, size, ok in self._conn.execute(
+                    f"""SELECT p.run_id, p.phase, p.started, p.duration, p.bytes, p.ok
+                        FROM job_phases p JOIN job_runs r ON r.id = p.run_id {where}
+                        ORDER BY p.rowid""", params):
+                phases.setdefault(run_id, []).append(
+                    Phase(name, datetime.datetime.fromisoformat(started), duration, size,
+                          bool(ok)))
+        return [JobRun(*row, phases=phases.get(row[0], [])) for row in rows]
+
+    def forget_before(self, cutoff):
+        """Drop runs started before ``cutoff``; returns how many"""
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM job_runs WHERE started < ?",
+                                      (cutoff.isoformat(sep=" "),)).rowcount
+
+
+def slowest_jobs(runs, limit=10, phase=None):
+    """The ``limit`` slowest runs, overall or in one ``phase``"""
+    def duration(run):
+        if phase is None:
+            return run.duration or 0
+        record = run.phase(phase)
+        return record.duration if record else 0
+    return sorted(runs, key=duration, reverse=True)[:limit]
+
+
+def phase_trends(runs, window=7, threshold=REGRESSION_THRESHOLD):
+    """Compare every job's latest ``window`` runs with the ``window`` before.
+
+    Returns one dict per job and phase with both medians, their ratio and
+    whether the recent median crossed ``threshold`` times the earlier one.
+    Jobs without two full windows of successful runs are left out.
+    """
+    by_job = {}
+    for run in runs:
+        if run.status == "succeeded":
+            by_job.setdefault((run.server, run.database, run.backup_type), []).append(run)
+
+    trends = []
+    for (server, database, backup_type), job_runs in sorted(by_job.items()):
+        if len(job_runs) < 2 * window:
+            continue
+        recent, before = job_runs[-window:], job_runs[-2 * window:-window]
+        names = dict.fromkeys(p.name for run in recent for p in run.phases)
+        for name in ["total"] + list(names):
+            now = _median(recent, name)
+            then = _median(before, name)
+            if now is None or not then:
+                continue
+            ratio = now / then
+            trends.append({"server": server, "database": database,
+                           "backup_type": backup_type, "phase": name,
+                           "recent": now, "before": then, "ratio": ratio,
+                           "regressed": ratio >= threshold})
+    return trends
+
+
+def _median(runs, phase):
+    if phase == "total":
+        values = [run.duration for run in runs if run.duration is not None]
+    else:
+        values = [run.phase(phase).duration for run in runs if run.phase(phase)]
+    return statistics.median(values) if values else None
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(runs):
+    """The latest ``runs`` in the Prometheus text exposition format"""
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            rendered = ",".join(f'{k}="{_label(v)}"' for k, v in labels.items())
+            lines.append(f"{name}{{{rendered}}} {value}")
+
+    def labels(run, **extra):
+        return dict({"server": run.server, "database": run.database,
+                     "backup_type": run.backup_type}, **extra)
+
+    family("db_backup_last_run_timestamp_seconds", "gauge",
+           "Start of the last backup job, in seconds since the epoch",
+           [(labels(run), run.started.timestamp()) for run in runs])
+    family("db_backup_last_run_success", "gauge",
+           "1 when the last backup job succeeded, else 0",
+           [(labels(run), int(run.status == "succeeded")) for run in runs])
+    family("db_backup_last_run_duration_seconds", "gauge",
+           "Wall time of the last backup job",
+           [(labels(run), run.duration) for run in runs if run.duration is not None])
+    family("db_backup_last_run_bytes", "gauge",
+           "Bytes read by the BACKUP command of the last job",
+           [(labels(run), run.bytes) for run in runs if run.bytes is not None])
+    family("db_backup_phase_duration_seconds", "gauge",
+           "Wall time of every phase of the last backup job",
+           [(labels(run, phase=p.name), p.duration) for run in runs for p in run.phases])
+    family("db_backup_phase_bytes", "gauge",
+           "Bytes moved by every phase of the last backup job",
+           [(labels(run, phase=p.name), p.bytes) for run in runs for p in run.phases
+            if p.bytes is not None])
+    return "\n".join(lines) + "\n"
+
+
+def json_summary(runs):
+    return json.dumps({"generated": datetime.datetime.now().isoformat(),
+                       "jobs": [run.as_dict() for run in runs]}, indent=2)
+
+
+def write_atomically(path, text):
+    """Replace ``path`` in one step so a scraper never reads half a file"""
+    temporary = path + ".tmp"
+    with open(temporary, 'w') as f:
+        f.write(text)
+    os.replace(temporary, path)
+
+
+def format_report(runs, limit=10, window=7, threshold=REGRESSION_THRESHOLD):
+    """A plain-text report of the slowest jobs and of phases getting slower"""
+    lines = [f"Slowest of {len(runs)} jobs:"]
+    for run in slowest_jobs(runs, limit):
+        slowest = max(run.phases, key=lambda p: p.duration, default=None)
+        where = f", mostly {slowest.name} ({format_duration(slowest.duration)})" if slowest else ""
+        lines.append(f"  {run.started:%Y-%m-%d %H:%M}  {run.name:<40} {run.backup_type:<4} "
+                     f"{format_duration(run.duration or 0):>8}  "
+                     f"{format_bytes(run.bytes or 0):>10}  {run.status}{where}")
+
+    trends = phase_trends(runs, window, threshold)
+    regressions = [t for t in trends if t["regressed"]]
+    lines.append("")
+    if not trends:
+        lines.append(f"Not enough history for trends (needs {2 * window} runs per job)")
+    elif not regressions:
+        lines.append(f"No phase got more than {threshold - 1:.0%} slower over the last {window} runs")
+    else:
+        lines.append(f"Getting slower (median of the last {window} runs vs the {window} before):")
+        for t in sorted(regressions, key=lambda t: t["ratio"], reverse=True):
+            lines.append(f"  {t['server']}/{t['database']} {t['backup_type']} {t['phase']}: "
+                         f"{format_duration(t['before'])} -> {format_duration(t['recent'])} "
+                         f"({t['ratio'] - 1:+.0%})")
+    return "\n".join(lines)
@@ -0,0 +1,242 @@
+#Resumable, throttled copies of finished backups to secondary destinations
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backup_options import DEDUP_SUFFIX
+from compress import index_path
+from dedup import rehydrate
+from manifest import check_unchanged, manifest_path, read_manifest
+
+logger = logging.getLogger(__name__)
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_COPY_WORKERS = 2
+PART_SUFFIX = ".part"
+PART_INFO_SUFFIX = ".part.json"
+
+
+class CopyError(Exception):
+    """A copy could not be completed or does not match its source"""
+
+
+class RateLimiter:
+    """Token bucket shared by every copy thread to cap total bandwidth"""
+
+    def __init__(self, bytes_per_second, burst=None):
+        self.rate = float(bytes_per_second)
+        self.capacity = float(burst or bytes_per_second)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, count):
+        """Block until ``count`` bytes may be sent"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= count or self._tokens >= self.capacity:
+                    self._tokens -= count
+                    return
+                wait = (count - self._tokens) / self.rate
+            time.sleep(min(wait, 1.0))
+
+
+def _source_signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def copy_file(source, destination, limiter=None, chunk_size=COPY_CHUNK_SIZE, expected_sha256=None):
+    """Copy one file, resuming a partial copy left by an earlier attempt.
+
+    Data goes to ``destination + ".part"`` and is renamed into place only
+    once complete, so a destination file is never half written. A finished
+    copy takes the source's mtime, and a destination matching the source in
+    size and mtime is taken as copied already. A partial
+    copy is resumed only if the source still has the size and mtime it had
+    when the copy began. With ``expected_sha256`` (from the manifest) the
+    copy is hashed on the way and rejected if it does not match.
+    Returns the number of bytes transferred by this call.
+    """
+    signature = _source_signature(source)
+    if os.path.exists(destination) and _source_signature(destination) == signature:
+        return 0
+
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    part = destination + PART_SUFFIX
+    info = destination + PART_INFO_SUFFIX
+    digest = hashlib.sha256()
+    offset = 0
+
+    if os.path.exists(part) and os.path.exists(info):
+        try:
+            with open(info, 'r') as f:
+                resumable = json.load(f) == signature
+        except Exception:
+            resumable = False
+        if resumable:
+            offset = min(os.path.getsize(part), signature["size"])
+            # Hash what is already there so the final digest covers the whole file
+            with open(part, 'rb') as f:
+                remaining = offset
+                while remaining:
+                    block = f.read(min(chunk_size, remaining))
+                    if not block:
+                        break
+                    digest.update(block)
+                    remaining -= len(block)
+            logger.info("Resuming copy of %s at byte %d", source, offset)
+    if not offset:
+        with open(info, 'w') as f:
+            json.dump(signature, f)
+
+    transferred = 0
+    with open(source, 'rb') as src, open(part, 'r+b' if offset else 'wb') as dst:
+        src.seek(offset)
+        dst.seek(offset)
+        dst.truncate()
+        while True:
+            block = src.read(chunk_size)
+            if not block:
+                break
+            if limiter:
+                limiter.consume(len(block))
+            dst.write(block)
+            digest.update(block)
+            transferred += len(block)
+        dst.flush()
+        os.fsync(dst.fileno())
+
+    if os.path.getsize(part) != signature["size"]:
+        raise CopyError(f"{source} changed while it was being copied")
+    if expected_sha256 and digest.hexdigest() != expected_sha256:
+        os.remove(part)
+        os.remove(info)
+        raise CopyError(f"Copy of {source} does not match its manifest")
+    os.utime(part, (signature["mtime"], signature["mtime"]))
+    os.replace(part, destination)
+    os.remove(info)
+    return transferred
+
+
+class OffsiteCopier:
+    """Copy backup sets to every configured destination in parallel"""
+
+    def __init__(self, targets, workers=DEFAULT_COPY_WORKERS, bandwidth_limit=None,
+                 chunk_size=COPY_CHUNK_SIZE):
+        self.targets = list(targets)
+        self.workers = max(1, int(workers))
+        self.limiter = RateLimiter(bandwidth_limit) if bandwidth_limit else None
+        self.chunk_size = chunk_size
+
+    def copy_set(self, backup_files):
+        """Copy every stripe of a set, its compression indexes and its manifest to every target.
+
+        Raises CopyError naming the copies that failed; the ones that worked
+        are kept and skipped on the next attempt. A set that changed since
+        its manifest was written is refused with ManifestError. Stripes
+        already moved into the dedup repository are rehydrated for the copy
+        unless every target holds them already.
+        """
+        entries = {}
+        manifest = manifest_path(backup_files)
+        if os.path.exists(manifest):
+            details = read_manifest(manifest)
+            check_unchanged(details, backup_files)
+            entries = {entry["path"]: entry for entry in details["files"]}
+
+        rehydrated = []
+        try:
+            sources = []
+            for path in backup_files:
+                if not path.lower().endswith(DEDUP_SUFFIX):
+                    sources.append(path)
+                    continue
+                original = path[:-len(DEDUP_SUFFIX)]
+                entry = entries.get(original)
+                if not self._copied(original, entry):
+                    rehydrated.append(rehydrate(path, original))
+                    if entry is not None:
+                        # The same bytes as the stripe the manifest describes
+                        os.utime(original, (entry["mtime"], entry["mtime"]))
+                    sources.append(original)
+            total = self._copy_files(sources, entries)
+        finally:
+            for path in rehydrated:
+                os.remove(path)
+
+        # The manifest goes last, so its presence at a target marks a complete set
+        if os.path.exists(manifest):
+            for target in self.targets:
+                copy_file(manifest, os.path.join(target, os.path.basename(manifest)))
+        return total
+
+    def _copied(self, original, entry):
+        """Whether every target holds the stripe a manifest entry describes"""
+        if entry is None:
+            return False
+        expected = {"size": entry["size"], "mtime": entry["mtime"]}
+        for target in self.targets:
+            destination = os.path.join(target, os.path.basename(original))
+            if not os.path.exists(destination) or _source_signature(destination) != expected:
+                return False
+        return True
+
+    def _copy_files(self, sources, entries):
+        sources = sources + [index_path(p) for p in sources if os.path.exists(index_path(p))]
+        copies = [(source, os.path.join(target, os.path.basename(source)))
+                  for target in self.targets for source in sources]
+        started = time.monotonic()
+        failures = []
+        total = 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="copy") as pool:
+            futures = {pool.submit(copy_file, source, destination, self.limiter, self.chunk_size,
+                                   entries[source]["sha256"] if source in entries else None):
+                       destination
+                       for source, destination in copies}
+            for future, destination in futures.items():
+                try:
+                    total += future.result()
+                except Exception as e:
+                    logger.error("Copy to %s failed: %s", destination, e)
+                    failures.append(destination)
+        if failures:
+            raise CopyError(f"{len(failures)} copies failed: {', '.join(failures)}")
+
+        elapsed = time.monotonic() - started
+        logger.info("Copied %d bytes to %d targets in %.1fs", total, len(self.targets), elapsed)
+        return total
+
+
+class OffsiteCopyStage:
+    """Post-backup stage copying the new set to the secondary destinations.
+
+    Optional: an unreachable target does not fail a good backup, and the
+    ``copy`` command catches up on the sets that were missed.
+    """
+
+    name = "offsite copy"
+    optional = True
+
+    def __init__(self, copier):
+        self.copier = copier
+
+    def run(self, job, result):
+        result.copied_bytes = self.copier.copy_set(result.backup_files)
+        return result.copied_bytes
+
+
+def copier_from_config(config):
+    targets = config.get("offsite_targets") or []
+    if not targets:
+        return None
+    return OffsiteCopier(targets,
+                         workers=config.get("copy_workers", DEFAULT_COPY_WORKERS),
+                         bandwidth_limit=config.get("copy_bandwidth_limit"))
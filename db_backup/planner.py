@@ -0,0 +1,263 @@
+#Backup window planning: estimate every job's duration and order them to finish inside the window
+import datetime
+import heapq
+import logging
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from backup_engine import (DEFAULT_MAX_JOBS_PER_SERVER, DEFAULT_MAX_JOBS_PER_VOLUME,
+                           DEFAULT_MAX_WORKERS, server_limits, server_settings)
+from progress import estimate_backup_size, format_bytes, format_duration
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+DEFAULT_HISTORY_RUNS = 10
+# BACKUP speed assumed for a server nothing has been learnt about yet
+DEFAULT_THROUGHPUT_MB = 50
+# Seconds assumed for a job with neither history nor a size
+DEFAULT_DURATION = 600
+
+
+class Estimate:
+    """How long a job should take, and what the guess rests on"""
+
+    def __init__(self, seconds, size=None, source="default"):
+        self.seconds = seconds
+        self.size = size
+        self.source = source
+
+    def __repr__(self):
+        return f"Estimate({self.seconds:.0f}s, {self.source!r})"
+
+
+class DurationEstimator:
+    """Estimate job durations from past runs and current database sizes.
+
+    A full backup with a known size takes size / throughput, where the
+    throughput is the median of the job's recent BACKUP phases, plus the
+    median time of its other phases (connecting, stages, pruning). A job
+    without history of its own borrows the median throughput of its server,
+    then ``plan_throughput_mb`` from the server's settings. Differential and
+    log backups, whose size estimate is only an upper bound, go by their
+    recent durations first.
+    """
+
+    def __init__(self, runs, config=None, history_runs=DEFAULT_HISTORY_RUNS):
+        self.config = config or {}
+        self._runs = {}
+        self._server_throughput = {}
+        for run in runs:
+            if run.status == "succeeded" and run.duration:
+                self._runs.setdefault((run.server, run.database, run.backup_type), []).append(run)
+        for key, job_runs in self._runs.items():
+            del job_runs[:-history_runs]
+            self._server_throughput.setdefault(key[0], []).extend(
+                rate for rate in map(_throughput, job_runs) if rate)
+
+    def throughput(self, server):
+        """Bytes per second a BACKUP on ``server`` is expected to reach"""
+        rates = self._server_throughput.get(server)
+        if rates:
+            return statistics.median(rates)
+        settings = server_settings(self.config, server)
+        return float(settings.get("plan_throughput_mb") or DEFAULT_THROUGHPUT_MB) * MB
+
+    def estimate(self, job, size=None):
+        runs = self._runs.get((job.server, job.database, job.backup_type), [])
+        rates = [rate for rate in map(_throughput, runs) if rate]
+        overhead = _median([run.duration - run.phase("backup").duration
+                            for run in runs if run.phase("backup")]) or 0.0
+        if size and rates and job.backup_type == "full":
+            return Estimate(size / statistics.median(rates) + overhead, size, "size and history")
+        if runs:
+            return Estimate(statistics.median(run.duration for run in runs), size, "history")
+        if size:
+            return Estimate(size / self.throughput(job.server), size, "size")
+        return Estimate(DEFAULT_DURATION, size)
+
+
+def _throughput(run):
+    phase = run.phase("backup")
+    if phase and phase.bytes and phase.duration > 0:
+        return phase.bytes / phase.duration
+    return None
+
+
+def _median(values):
+    return statistics.median(values) if values else None
+
+
+def current_sizes(connections, jobs, workers=DEFAULT_MAX_WORKERS):
+    """{job name: bytes its backup will read} as the servers report them now"""
+    def size(job):
+        conn = None
+        healthy = False
+        try:
+            conn = connections.acquire(job)
+            estimate = estimate_backup_size(conn.cursor(), job.backup_type)
+            healthy = True
+            return estimate
+        except Exception as e:
+            logger.warning("Could not size %s for planning: %s", job.name, e)
+            return None
+        finally:
+            if conn:
+                connections.release(job, conn, healthy)
+
+    jobs = list(jobs)
+    if not jobs:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs))),
+                            thread_name_prefix="size") as pool:
+        estimates = list(pool.map(size, jobs))
+    return {job.name: estimate for job, estimate in zip(jobs, estimates) if estimate is not None}
+
+
+class PlannedJob:
+    """When a job is projected to run, and the end of its window"""
+
+    def __init__(self, job, estimate, start, finish, deadline=None):
+        self.job = job
+        self.estimate = estimate
+        self.start = start
+        self.finish = finish
+        self.deadline = deadline
+
+    @property
+    def late(self):
+        return self.deadline is not None and self.finish > self.deadline
+
+    def __repr__(self):
+        return f"PlannedJob({self.job.name!r}, {self.start:%H:%M}-{self.finish:%H:%M})"
+
+
+class WindowPlan:
+    """Projected start and finish of every job of a batch.
+
+    ``jobs`` is the order to hand the jobs to the engine in; dispatching
+    them in that order reproduces the projection.
+    """
+
+    def __init__(self, start, jobs, entries):
+        self.start = start
+        self.jobs = jobs
+        self.entries = entries
+
+    @property
+    def finish(self):
+        return max((entry.finish for entry in self.entries), default=self.start)
+
+    @property
+    def late(self):
+        return [entry for entry in self.entries if entry.late]
+
+    @property
+    def fits(self):
+        return not self.late
+
+    @property
+    def informed(self):
+        """Whether every estimate rests on history or a size rather than the default"""
+        return all(entry.estimate.source != "default" for entry in self.entries)
+
+    @property
+    def overrun(self):
+        """Seconds the latest job is projected to run past its window"""
+        return max([(entry.finish - entry.deadline).total_seconds() for entry in self.late],
+                   default=0.0)
+
+    def warning(self):
+        """A one-line warning when the plan does not fit, else None"""
+        if self.fits:
+            return None
+        late = self.late
+        names = ", ".join(entry.job.name for entry in late[:5])
+        if len(late) > 5:
+            names += f" and {len(late) - 5} more"
+        return (f"Backups projected to finish at {self.finish:%H:%M}, "
+                f"{format_duration(self.overrun)} past the maintenance window: {names}")
+
+    def describe(self):
+        lines = [f"Plan from {self.start:%Y-%m-%d %H:%M}, projected finish {self.finish:%H:%M}"]
+        for entry in self.entries:
+            size = format_bytes(entry.estimate.size) if entry.estimate.size else "size unknown"
+            deadline = f" (window ends {entry.deadline:%H:%M})" if entry.late else ""
+            lines.append(f"  {entry.start:%H:%M}-{entry.finish:%H:%M}  {entry.job.name:<40} "
+                         f"{format_duration(entry.estimate.seconds):>7}  {size}, "
+                         f"from {entry.estimate.source}{deadline}")
+        warning = self.warning()
+        if warning:
+            lines.append(warning)
+        return "\n".join(lines)
+
+
+def plan_jobs(jobs, estimates, start, max_workers=DEFAULT_MAX_WORKERS,
+              max_jobs_per_server=DEFAULT_MAX_JOBS_PER_SERVER,
+              max_jobs_per_volume=DEFAULT_MAX_JOBS_PER_VOLUME, server_limits=None,
+              longest_first=True):
+    """Order ``jobs`` longest first and project when each runs.
+
+    The projection follows the engine's rules: a job starts as soon as a
+    worker is free and neither its server nor any of its volumes is at its
+    limit, taking the first such job in order. ``estimates`` maps job names
+    to an ``Estimate``; a job's deadline is the end of its window's
+    occurrence at ``start``. Without ``longest_first`` the order is kept.
+    """
+    server_limits = server_limits or {}
+    order = list(jobs)
+    if longest_first:
+        order.sort(key=lambda job: estimates[job.name].seconds, reverse=True)
+    pending = list(order)
+    running = []
+    per_server = {}
+    per_volume = {}
+    entries = []
+    now = 0.0
+    # Resolving a volume looks at the file system, so do it once per job
+    volumes = {id(job): job.volumes for job in order}
+
+    def runnable(job):
+        return (per_server.get(job.server, 0) < server_limits.get(job.server, max_jobs_per_server)
+                and all(per_volume.get(v, 0) < max_jobs_per_volume for v in volumes[id(job)]))
+
+    while pending:
+        position = 0
+        while len(running) < max_workers and position < len(pending):
+            job = pending[position]
+            if not runnable(job):
+                position += 1
+                continue
+            pending.pop(position)
+            per_server[job.server] = per_server.get(job.server, 0) + 1
+            for volume in volumes[id(job)]:
+                per_volume[volume] = per_volume.get(volume, 0) + 1
+            seconds = estimates[job.name].seconds
+            heapq.heappush(running, (now + seconds, len(entries), job))
+            deadline = job.window.occurrence(start)[1] if job.window else None
+            entries.append(PlannedJob(job, estimates[job.name],
+                                      start + datetime.timedelta(seconds=now),
+                                      start + datetime.timedelta(seconds=now + seconds),
+                                      deadline))
+        if not running:
+            break
+        now, _, job = heapq.heappop(running)
+        per_server[job.server] -= 1
+        for volume in volumes[id(job)]:
+            per_volume[volume] -= 1
+    return WindowPlan(start, order, entries)
+
+
+def plan_from_config(config, jobs, runs, sizes=None, start=None):
+    """Plan ``jobs`` with the limits and tuning of ``config``"""
+    estimator = DurationEstimator(runs, config,
+                                  config.get("plan_history_runs", DEFAULT_HISTORY_RUNS))
+    sizes = sizes or {}
+    estimates = {job.name: estimator.estimate(job, sizes.get(job.name)) for job in jobs}
+    return plan_jobs(jobs, estimates, start or datetime.datetime.now(),
+                     max_workers=config.get("max_workers", DEFAULT_MAX_WORKERS),
+                     max_jobs_per_server=config.get("max_jobs_per_server",
+                                                    DEFAULT_MAX_JOBS_PER_SERVER),
+                     max_jobs_per_volume=config.get("max_jobs_per_volume",
+                                                    DEFAULT_MAX_JOBS_PER_VOLUME),
+                     server_limits=server_limits(config))
@@ -0,0 +1,173 @@
+#Progress and throughput of a running BACKUP from its STATS messages
+import datetime
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+PERCENT_PATTERN = re.compile(r"(\d+) percent processed", re.IGNORECASE)
+COMPLETED_PATTERN = re.compile(r"successfully processed (\d+) pages in ([\d.]+) seconds",
+                               re.IGNORECASE)
+PAGE_SIZE = 8192
+
+DATA_SIZE_QUERY = """
+    SELECT SUM(CAST(FILEPROPERTY(name, 'SpaceUsed') AS BIGINT)) * 8192
+    FROM sys.database_files
+    WHERE type = 0
+    """
+LOG_SIZE_QUERY = "SELECT used_log_space_in_bytes FROM sys.dm_db_log_space_usage"
+
+
+def estimate_backup_size(cursor, backup_type="full"):
+    """Return the bytes a backup of the connected database will read, or None.
+
+    Full and differential backups are sized from the used data pages (an upper
+    bound for a differential), log backups from the used log space.
+    """
+    try:
+        cursor.execute(LOG_SIZE_QUERY if backup_type == "log" else DATA_SIZE_QUERY)
+        row = cursor.fetchone()
+        return int(row[0]) if row and row[0] is not None else None
+    except Exception as e:
+        logger.warning("Could not estimate backup size: %s", e)
+        return None
+
+
+def read_messages(cursor):
+    """Return and clear the informational messages pyodbc collected so far"""
+    messages = getattr(cursor, "messages", None) or []
+    texts = [m[1] if isinstance(m, (tuple, list)) else str(m) for m in messages]
+    try:
+        messages.clear()
+    except AttributeError:
+        pass
+    return texts
+
+
+class ProgressReport:
+    """A snapshot of how far a backup has got"""
+
+    def __init__(self, percent, bytes_done, total_bytes, elapsed, finished=False):
+        self.percent = percent
+        self.bytes_done = bytes_done
+        self.total_bytes = total_bytes
+        self.elapsed = elapsed
+        self.finished = finished
+
+    @property
+    def bytes_per_second(self):
+        if self.bytes_done is None or self.elapsed <= 0:
+            return None
+        return self.bytes_done / self.elapsed
+
+    @property
+    def eta(self):
+        """Seconds left, extrapolated from the progress so far"""
+        if self.finished:
+            return 0.0
+        if not self.percent or self.elapsed <= 0:
+            return None
+        return self.elapsed * (100 - self.percent) / self.percent
+
+    def describe(self):
+        text = f"{self.percent}% in {format_duration(self.elapsed)}"
+        if self.bytes_per_second:
+            text += f", {format_bytes(self.bytes_per_second)}/s"
+        if self.eta is not None and not self.finished:
+            text += f", ETA {format_duration(self.eta)}"
+        return text
+
+    def as_dict(self):
+        return {
+            "percent": self.percent,
+            "bytes_done": self.bytes_done,
+            "total_bytes": self.total_bytes,
+            "elapsed": self.elapsed,
+            "bytes_per_second": self.bytes_per_second,
+            "eta": self.eta,
+            "finished": self.finished,
+        }
+
+
+class ProgressTracker:
+    """Turn STATS messages of one backup into progress reports.
+
+    Every report is logged and handed to ``on_progress``, so the same data
+    drives a progress bar, a log file or anything else listening.
+    """
+
+    def __init__(self, name, total_bytes=None, on_progress=None, clock=datetime.datetime.now):
+        self.name = name
+        self.total_bytes = total_bytes
+        self.on_progress = on_progress
+        self.clock = clock
+        self.started = clock()
+        self.last_report = None
+
+    def _elapsed(self):
+        return (self.clock() - self.started).total_seconds()
+
+    def _emit(self, report):
+        self.last_report = report
+        logger.info("Backup of %s: %s", self.name, report.describe())
+        if self.on_progress:
+            try:
+                self.on_progress(report)
+            except Exception as e:
+                logger.error("Progress callback failed for %s: %s", self.name, e)
+
+    def update(self, percent):
+        bytes_done = self.total_bytes * percent // 100 if self.total_bytes else None
+        self._emit(ProgressReport(percent, bytes_done, self.total_bytes, self._elapsed()))
+
+    def feed(self, messages):
+        """Process server messages, reporting every new percentage"""
+        for message in messages:
+            match = PERCENT_PATTERN.search(message)
+            if match:
+                self.update(min(int(match.group(1)), 100))
+                continue
+            match = COMPLETED_PATTERN.search(message)
+            if match:
+                # The server's own page count is exact, unlike our estimate
+                self.total_bytes = int(match.group(1)) * PAGE_SIZE
+
+    def finish(self):
+        self._emit(ProgressReport(100, self.total_bytes, self.total_bytes, self._elapsed(),
+                                  finished=True))
+
+
+def follow_backup(cursor, tracker=None, check_cancel=None):
+    """Drain the result sets of a running BACKUP command.
+
+    ``check_cancel`` is called between result sets and should raise to abort.
+    """
+    while True:
+        if tracker:
+            tracker.feed(read_messages(cursor))
+        if check_cancel:
+            check_cancel()
+        if not cursor.nextset():
+            break
+    if tracker:
+        tracker.feed(read_messages(cursor))
+        tracker.finish()
+
+
+def format_bytes(count):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(count) < 1024:
+            return f"{count:.1f} {unit}"
+        count /= 1024
+    return f"{count:.1f} TB"
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m"
+    if minutes:
+        return f"{minutes}m{seconds:02d}s"
+    return f"{seconds}s"
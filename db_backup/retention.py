@@ -0,0 +1,341 @@
+#Chain-aware, grandfather-father-son retention of full, differential and log backups
+import logging
+import os
+import shutil
+
+from backup_options import DEDUP_SUFFIX
+from catalog import parse_backup_name
+from compress import index_path
+from dedup import forget
+from manifest import manifest_path
+
+logger = logging.getLogger(__name__)
+
+
+class BackupSet:
+    """Every stripe of one backup, kept or removed as a unit"""
+
+    def __init__(self, key, backup_type, paths, taken, record=None):
+        self.key = key
+        self.backup_type = backup_type
+        self.paths = paths
+        self.taken = taken
+        self.record = record
+
+    @property
+    def is_full(self):
+        return self.backup_type == "full"
+
+    @property
+    def verified(self):
+        """Whether a test restore or RESTORE VERIFYONLY passed for this set"""
+        return self.record is not None and self.record.is_verified
+
+    @property
+    def size(self):
+        if self.record is not None and self.record.size is not None:
+            return self.record.size
+        return sum(os.path.getsize(p) for p in self.paths if os.path.exists(p))
+
+    def __repr__(self):
+        return f"BackupSet({self.key!r}, {self.backup_type!r})"
+
+
+class RetentionPolicy:
+    """How many backup chains of a database to keep.
+
+    The newest ``keep_last`` chains are kept whole. On top of that the newest
+    full backup of each of the last ``keep_daily`` days, ``keep_weekly``
+    weeks and ``keep_monthly`` months is kept; for those older chains only
+    the full backup survives, their differentials and logs are dropped.
+
+    ``max_total_bytes`` caps the space a database's backups may take and
+    ``min_free_bytes`` the free space to leave on the backup volume; both
+    are met by removing the oldest chains first, but never the newest one.
+
+    With ``prefer_verified`` a daily, weekly or monthly slot goes to the
+    newest verified full backup of its period when there is one, and the
+    newest verified full backup is always kept, so pruning never leaves a
+    database without a backup known to restore.
+    """
+
+    FIELDS = ("keep_last", "keep_daily", "keep_weekly", "keep_monthly",
+              "max_total_bytes", "min_free_bytes", "prefer_verified")
+
+    def __init__(self, keep_last=2, keep_daily=0, keep_weekly=0, keep_monthly=0,
+                 max_total_bytes=None, min_free_bytes=None, prefer_verified=True):
+        self.keep_last = max(1, int(keep_last))
+        self.keep_daily = max(0, int(keep_daily))
+        self.keep_weekly = max(0, int(keep_weekly))
+        self.keep_monthly = max(0, int(keep_monthly))
+        self.max_total_bytes = max_total_bytes
+        self.min_free_bytes = min_free_bytes
+        self.prefer_verified = bool(prefer_verified)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Build the policy of a database from its merged config settings.
+
+        The old ``keep_backups`` setting is still honoured as ``keep_last``.
+        """
+        rules = dict(settings.get("retention") or {})
+        if "keep_last" not in rules and "keep_backups" in settings:
+            rules["keep_last"] = settings["keep_backups"]
+        return cls(**{k: rules[k] for k in cls.FIELDS if k in rules})
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.FIELDS}
+
+
+class RetentionPlan:
+    """What a retention run deletes, and why"""
+
+    def __init__(self, database):
+        self.database = database
+        self.deletions = []
+
+    def add(self, backup_set, reason):
+        self.deletions.append((backup_set, reason))
+
+    @property
+    def sets(self):
+        return [backup_set for backup_set, _ in self.deletions]
+
+    @property
+    def reclaimed_bytes(self):
+        return sum(backup_set.size for backup_set in self.sets)
+
+    def describe(self):
+        lines = [f"{self.database}: {len(self.deletions)} backup sets, "
+                 f"{self.reclaimed_bytes / (1024 * 1024):.1f} MB reclaimed"]
+        for backup_set, reason in self.deletions:
+            lines.append(f"  {backup_set.key} ({backup_set.backup_type}): {reason}")
+        return "\n".join(lines)
+
+
+def scan_backup_sets(backup_dirs, database_name):
+    """Group the backup files of a database into sets, oldest first"""
+    if isinstance(backup_dirs, str):
+        backup_dirs = [backup_dirs]
+
+    found = {}
+    for backup_dir in dict.fromkeys(backup_dirs):
+        if not os.path.isdir(backup_dir):
+            continue
+        for f in os.listdir(backup_dir):
+            parsed = parse_backup_name(f, database_name)
+            if parsed:
+                _, backup_type, key, taken = parsed
+                found.setdefault((key, backup_type, taken), []).append(os.path.join(backup_dir, f))
+
+    sets = [BackupSet(key, backup_type, paths, taken)
+            for (key, backup_type, taken), paths in found.items()]
+    sets.sort(key=lambda s: (s.taken, s.key))
+    return sets
+
+
+def catalog_backup_sets(catalog, database_name, server=None):
+    """The backup sets of a database as recorded in the catalog, oldest first"""
+    return [BackupSet(r.set_key, r.backup_type, r.paths, r.started, record=r)
+            for r in catalog.backups(database=database_name, server=server)]
+
+
+def backup_sets(backup_dirs, database_name, catalog=None, server=None):
+    if catalog is not None:
+        return catalog_backup_sets(catalog, database_name, server)
+    return scan_backup_sets(backup_dirs, database_name)
+
+
+def split_chains(sets):
+    """Split sets (oldest first) into chains that each start with a full backup.
+
+    Differential and log backups taken before the first full backup cannot
+    be restored from anything we hold and are returned as the orphans.
+    """
+    orphans = []
+    chains = []
+    for backup_set in sets:
+        if backup_set.is_full:
+            chains.append([backup_set])
+        elif chains:
+            chains[-1].append(backup_set)
+        else:
+            orphans.append(backup_set)
+    return chains, orphans
+
+
+def _gfs_keepers(chains, count, period, prefer_verified=False):
+    """Indexes of the newest chain in each of the newest ``count`` periods.
+
+    With ``prefer_verified`` the newest verified chain of a period wins over
+    newer unverified ones.
+    """
+    buckets = {}
+    for index in range(len(chains) - 1, -1, -1):
+        bucket = period(chains[index][0].taken)
+        if bucket not in buckets:
+            if len(buckets) >= count:
+                break
+            buckets[bucket] = index
+        elif (prefer_verified and chains[index][0].verified
+              and not chains[buckets[bucket]][0].verified):
+            buckets[bucket] = index
+    return set(buckets.values())
+
+
+def _oldest_removable(kept, protected):
+    for position, (index, _) in enumerate(kept):
+        if index not in protected:
+            return position
+    return None
+
+
+def free_bytes(directories):
+    """Free space on the fullest of the volumes holding ``directories``"""
+    free = None
+    for directory in dict.fromkeys(directories):
+        probe = directory
+        while probe and not os.path.exists(probe):
+            parent = os.path.dirname(probe)
+            if parent == probe:
+                break
+            probe = parent
+        try:
+            available = shutil.disk_usage(probe).free
+        except OSError:
+            continue
+        free = available if free is None else min(free, available)
+    return free
+
+
+def plan_retention(sets, policy, database="", free=None, required_bytes=0):
+    """Work out which sets (oldest first) to delete under ``policy``.
+
+    A full backup is only removed together with every differential and log
+    backup that depends on it, so a retained backup is always restorable.
+    ``free`` is the current free space of the backup volume; together with
+    ``required_bytes`` for an upcoming backup it drives the free-space rule.
+    """
+    if not isinstance(policy, RetentionPolicy):
+        policy = RetentionPolicy(keep_last=policy)
+    plan = RetentionPlan(database)
+    chains, orphans = split_chains(sets)
+    if not chains:
+        return plan
+    for orphan in orphans:
+        plan.add(orphan, "precedes every full backup")
+
+    protected = {len(chains) - 1}
+    prefer = policy.prefer_verified
+    whole = set(range(max(0, len(chains) - policy.keep_last), len(chains)))
+    full_only = (_gfs_keepers(chains, policy.keep_daily, lambda t: t.date(), prefer)
+                 | _gfs_keepers(chains, policy.keep_weekly, lambda t: t.isocalendar()[:2], prefer)
+                 | _gfs_keepers(chains, policy.keep_monthly, lambda t: (t.year, t.month), prefer))
+    if prefer:
+        verified = [index for index, chain in enumerate(chains) if chain[0].verified]
+        if verified:
+            protected.add(verified[-1])
+            if verified[-1] not in whole:
+                full_only.add(verified[-1])
+    full_only -= whole
+
+    kept = []
+    for index, chain in enumerate(chains):
+        if index in whole:
+            kept.append((index, chain))
+        elif index in full_only:
+            kept.append((index, chain[:1]))
+            for dependent in chain[1:]:
+                plan.add(dependent, "chain kept for its full backup only")
+        else:
+            for backup_set in chain:
+                plan.add(backup_set, "outside the retention policy")
+
+    sizes = {index: sum(s.size for s in chain) for index, chain in kept}
+
+    if policy.max_total_bytes is not None:
+        total = sum(sizes.values())
+        while total > policy.max_total_bytes:
+            position = _oldest_removable(kept, protected)
+            if position is None:
+                break
+            index, chain = kept.pop(position)
+            total -= sizes[index]
+            for backup_set in chain:
+                plan.add(backup_set, "over the size limit")
+
+    needed = (policy.min_free_bytes or 0) + required_bytes
+    if free is not None and needed:
+        available = free + plan.reclaimed_bytes
+        while available < needed:
+            position = _oldest_removable(kept, protected)
+            if position is None:
+                break
+            index, chain = kept.pop(position)
+            available += sizes[index]
+            for backup_set in chain:
+                plan.add(backup_set, "not enough free space")
+
+    return plan
+
+
+def has_full_backup(backup_dirs, database_name, catalog=None, server=None):
+    return any(s.is_full for s in backup_sets(backup_dirs, database_name, catalog, server))
+
+
+def delete_backup_set(backup_set, catalog=None):
+    """Remove every file of a set, and its catalog record once they are gone"""
+    remaining = 0
+    for old_backup in backup_set.paths:
+        try:
+            if os.path.exists(old_backup):
+                if old_backup.lower().endswith(DEDUP_SUFFIX):
+                    forget(old_backup)
+                os.remove(old_backup)
+            if os.path.exists(index_path(old_backup)):
+                os.remove(index_path(old_backup))
+            logger.info("Removed old backup: %s", os.path.basename(old_backup))
+        except Exception as e:
+            remaining += 1
+            logger.error("Error removing old backup %s: %s", old_backup, e)
+    if backup_set.paths and not remaining:
+        manifest = manifest_path(backup_set.paths)
+        if os.path.exists(manifest):
+            try:
+                os.remove(manifest)
+            except OSError as e:
+                logger.error("Error removing manifest %s: %s", manifest, e)
+    if catalog is not None and backup_set.record is not None and not remaining:
+        catalog.remove(backup_set.record.id)
+
+
+def prune_backups(backup_dirs, database_name, policy=None, catalog=None, dry_run=False,
+                  required_bytes=0, server=None):
+    """Apply a retention policy to the backups of a database.
+
+    ``backup_dirs`` may be one directory or every directory a striped set is
+    spread over; all stripes of a set are kept or removed together. With a
+    ``catalog`` the sets come from it instead of from listing the directories,
+    limited to those of ``server`` when given: two servers may each have a
+    database of the same name. ``required_bytes`` makes room for a backup
+    about to start. Returns the plan, which with ``dry_run`` is only reported
+    and not carried out.
+    """
+    if isinstance(backup_dirs, str):
+        backup_dirs = [backup_dirs]
+    policy = policy or RetentionPolicy()
+    plan = RetentionPlan(database_name)
+    try:
+        sets = backup_sets(backup_dirs, database_name, catalog, server)
+        free = None
+        if policy.min_free_bytes or required_bytes:
+            free = free_bytes(backup_dirs)
+        plan = plan_retention(sets, policy, database_name, free, required_bytes)
+        if dry_run:
+            return plan
+        for old_set in plan.sets:
+            delete_backup_set(old_set, catalog)
+
+    except Exception as e:
+        logger.error("Error managing backup files: %s", e)
+    return plan
@@ -0,0 +1,328 @@
+#Event-driven job scheduler with cron-style expressions
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = ("sunday", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday")
+
+# Upper bound on a single wait so a wall-clock change (DST, NTP step) is
+# noticed within a reasonable time even when no job is due for days.
+MAX_WAIT = 3600
+
+
+class CronExpression:
+    """A five-field cron expression: minute hour day-of-month month day-of-week.
+
+    Fields accept ``*``, lists, ranges and steps (``*/15``, ``1-5``, ``0,30``).
+    Day of week runs from 0 (Sunday) to 6, with 7 also meaning Sunday. As in
+    cron, when both day fields are restricted a day matching either one is due.
+    The simpler specs used in the config (``"daily 23:00"``,
+    ``"sunday 23:00"``, ``"every 15 minutes"``) are accepted as well; an
+    interval has to divide the hour (or the day) so the runs stay evenly spaced.
+    """
+
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = self._translate(expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression needs five fields: '{expression}'")
+        parsed = [self._parse_field(f, lo, hi) for f, (lo, hi) in zip(fields, self.RANGES)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays = {d % 7 for d in weekdays}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def __repr__(self):
+        return f"CronExpression({self.expression!r})"
+
+    @staticmethod
+    def _translate(spec):
+        words = spec.strip().lower().split()
+        if len(words) == 3 and words[0] == "every" and words[2] in ("minute", "minutes"):
+            return f"*/{CronExpression._interval(spec, words[1], 60)} * * * *"
+        if len(words) == 3 and words[0] == "every" and words[2] in ("hour", "hours"):
+            return f"0 */{CronExpression._interval(spec, words[1], 24)} * * *"
+        if len(words) == 2 and (words[0] == "daily" or words[0] in WEEKDAYS):
+            at = datetime.datetime.strptime(words[1], "%H:%M")
+            day = "*" if words[0] == "daily" else WEEKDAYS.index(words[0])
+            return f"{at.minute} {at.hour} * * {day}"
+        return spec
+
+    @staticmethod
+    def _interval(spec, value, cycle):
+        # A cron step restarts every hour (or day), so only divisors of it
+        # keep the gaps even: "every 45 minutes" would fire at :00 and :45
+        interval = int(value)
+        if interval < 1 or cycle % interval:
+            divisors = ", ".join(str(n) for n in range(1, cycle + 1) if cycle % n == 0)
+            raise ValueError(f"Invalid schedule '{spec}': the interval must be one of {divisors}")
+        return interval
+
+    @staticmethod
+    def _parse_field(field, lo, hi):
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/", 1)
+                step = int(step)
+                if step < 1:
+                    raise ValueError(f"Invalid step in cron field '{field}'")
+            if part == "*":
+                start, end = lo, hi
+            elif "-" in part:
+                start, end = (int(v) for v in part.split("-", 1))
+            else:
+                start = int(part)
+                end = hi if step > 1 else start
+            if not lo <= start <= end <= hi:
+                raise ValueError(f"Cron field '{field}' is out of range {lo}-{hi}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment):
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.isoweekday() % 7) in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, moment):
+        """Return the first due time strictly after ``moment``"""
+        candidate = moment.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = candidate + datetime.timedelta(days=366 * 5)
+        while candidate < limit:
+            if candidate.month not in self.months:
+                year, month = divmod(candidate.month, 12)
+                candidate = candidate.replace(year=candidate.year + year, month=month + 1,
+                                              day=1, hour=0, minute=0)
+                continue
+            if not self._day_matches(candidate):
+                candidate = (candidate + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if candidate.hour not in self.hours:
+                candidate = (candidate + datetime.timedelta(hours=1)).replace(minute=0)
+                continue
+            if candidate.minute not in self.minutes:
+                candidate += datetime.timedelta(minutes=1)
+                continue
+            return candidate
+        raise ValueError(f"Cron expression never fires: '{self.expression}'")
+
+
+class DailyWindow:
+    """A daily period such as ``01:00-05:00``; it may run past midnight"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        try:
+            start, end = spec.split("-")
+            self.start = datetime.datetime.strptime(start.strip(), "%H:%M").time()
+            self.end = datetime.datetime.strptime(end.strip(), "%H:%M").time()
+        except ValueError:
+            raise ValueError(f"Invalid window {spec!r}, expected HH:MM-HH:MM")
+
+    def __contains__(self, moment):
+        now = moment.time()
+        if self.start <= self.end:
+            return self.start <= now < self.end
+        return now >= self.start or now < self.end
+
+    @property
+    def length(self):
+        start = datetime.datetime.combine(datetime.date.min, self.start)
+        end = datetime.datetime.combine(datetime.date.min, self.end)
+        return end - start if end > start else end - start + datetime.timedelta(days=1)
+
+    @property
+    def schedule(self):
+        """A schedule spec firing when the window opens"""
+        return f"daily {self.start:%H:%M}"
+
+    def occurrence(self, moment):
+        """(start, end) of the window ``moment`` falls in, or else of the next one"""
+        start = datetime.datetime.combine(moment.date(), self.start)
+        if moment in self:
+            if start > moment:
+                start -= datetime.timedelta(days=1)
+        elif start <= moment:
+            start += datetime.timedelta(days=1)
+        return start, start + self.length
+
+    def __repr__(self):
+        return f"DailyWindow({self.spec!r})"
+
+
+class ScheduledJob:
+    """A callable registered with the scheduler under a unique name"""
+
+    def __init__(self, name, expression, func, args=(), skip_if_running=True, catch_up=True):
+        self.name = name
+        self.cron = expression if isinstance(expression, CronExpression) else CronExpression(expression)
+        self.func = func
+        self.args = args
+        self.skip_if_running = skip_if_running
+        self.catch_up = catch_up
+        self.next_run = None
+        self.last_run = None
+        self.running = 0
+
+    def __repr__(self):
+        return f"ScheduledJob({self.name!r}, {self.cron.expression!r}, next={self.next_run})"
+
+
+class Scheduler:
+    """Run jobs at the times given by their cron expressions.
+
+    The scheduler thread keeps the next run of every job in a heap and sleeps
+    on a condition variable until the earliest one is due, so jobs fire on
+    time and ``stop()``, ``add_job()`` or ``remove_job()`` take effect at once.
+    Each run happens on its own thread. A job still running when it is due
+    again is skipped unless it was added with ``skip_if_running=False``.
+
+    With a ``state_file`` the last run of every job survives restarts, and a
+    job with ``catch_up`` that missed a run while the scheduler was down runs
+    once as soon as it is added again.
+    """
+
+    def __init__(self, state_file=None, clock=datetime.datetime.now):
+        self.state_file = state_file
+        self.clock = clock
+        self._jobs = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._state = self._load_state()
+
+    def _load_state(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, 'r') as f:
+                return {name: datetime.datetime.fromisoformat(value)
+                        for name, value in json.load(f).items()}
+        except Exception as e:
+            logger.error("Failed to load scheduler state: %s", e)
+            return {}
+
+    def _save_state(self):
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file, 'w') as f:
+                json.dump({name: moment.isoformat() for name, moment in self._state.items()}, f)
+        except Exception as e:
+            logger.error("Failed to save scheduler state: %s", e)
+
+    @property
+    def running(self):
+        return self._running
+
+    def add_job(self, name, expression, func, *args, skip_if_running=True, catch_up=True):
+        """Register ``func(*args)`` to run whenever ``expression`` is due"""
+        job = ScheduledJob(name, expression, func, args, skip_if_running, catch_up)
+        now = self.clock()
+        with self._cond:
+            job.last_run = self._state.get(name)
+            if catch_up and job.last_run and job.cron.next_after(job.last_run) <= now:
+                logger.info("Job %s missed a run since %s, catching up", name, job.last_run)
+                job.next_run = now
+            else:
+                job.next_run = job.cron.next_after(now)
+            self._jobs[name] = job
+            heapq.heappush(self._heap, (job.next_run, next(self._sequence), job))
+            self._cond.notify_all()
+        return job
+
+    def remove_job(self, name):
+        with self._cond:
+            self._jobs.pop(name, None)
+            self._cond.notify_all()
+
+    def clear(self):
+        """Remove every job registered with this scheduler"""
+        with self._cond:
+            self._jobs.clear()
+            self._heap.clear()
+            self._cond.notify_all()
+
+    def jobs(self):
+        with self._cond:
+            return list(self._jobs.values())
+
+    def next_run(self):
+        """Return the earliest upcoming run, or None without jobs"""
+        with self._cond:
+            runs = [job.next_run for job in self._jobs.values()]
+        return min(runs) if runs else None
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """Stop dispatching jobs; runs already started are left to finish"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if wait and self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _loop(self):
+        with self._cond:
+            while self._running:
+                # Drop heap entries of removed or rescheduled jobs
+                while self._heap and self._jobs.get(self._heap[0][2].name) is not self._heap[0][2]:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait(MAX_WAIT)
+                    continue
+
+                due, _, job = self._heap[0]
+                delay = (due - self.clock()).total_seconds()
+                if delay > 0:
+                    self._cond.wait(min(delay, MAX_WAIT))
+                    continue
+
+                heapq.heappop(self._heap)
+                if job.next_run != due:
+                    continue
+                now = self.clock()
+                job.next_run = job.cron.next_after(max(due, now))
+                heapq.heappush(self._heap, (job.next_run, next(self._sequence), job))
+                self._dispatch(job, due)
+
+    def _dispatch(self, job, due):
+        if job.running and job.skip_if_running:
+            logger.warning("Skipping %s at %s, previous run still in progress", job.name, due)
+            return
+        job.running += 1
+        job.last_run = due
+        self._state[job.name] = due
+        self._save_state()
+        threading.Thread(target=self._run_job, args=(job,), name=f"job-{job.name}",
+                         daemon=True).start()
+
+    def _run_job(self, job):
+        try:
+            job.func(*job.args)
+        except Exception as e:
+            logger.error("Scheduled job %s failed: %s", job.name, e)
+        finally:
+            with self._cond:
+                job.running -= 1
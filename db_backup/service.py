@@ -0,0 +1,471 @@
+#GUI-free backup service shared by the Tk app and the command line
+import datetime
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from backup_engine import (DEFAULT_MAX_WORKERS, BackupEngine, BackupJob, jobs_from_config,
+                           schedule_groups)
+from catalog import CATALOG_FILE_NAME, Catalog
+from connections import ConnectionManager
+from compress import DEFAULT_BLOCK_SIZE, DEFAULT_COMPRESSION_WORKERS, CompressionStage
+from dedup import DEFAULT_GARBAGE_RATIO, DedupStage, close_repositories, repository_from_config
+from manifest import DEFAULT_HASH_WORKERS, ManifestStage
+from metrics import (DEFAULT_HISTORY_DAYS, METRICS_FILE_NAME, MetricsHistory, format_report,
+                     json_summary, prometheus_text, write_atomically)
+from offsite import OffsiteCopyStage, copier_from_config
+from planner import DEFAULT_HISTORY_RUNS, current_sizes, plan_from_config
+from retention import prune_backups
+from scheduler import CronExpression, Scheduler
+from verify import VerifyQueueStage, verifier_from_config
+
+logger = logging.getLogger(__name__)
+
+
+class BackupService:
+    """Backups, retention and scheduling for one configuration.
+
+    The service never touches a user interface; front ends pass callbacks:
+
+    * ``on_job_done(result)`` after every backup job
+    * ``on_progress(job, report)`` for every STATS report of a running job
+    * ``on_status(text)`` for one-line status messages
+    * ``on_finished(backup_type, results)`` once a batch of backups is over
+
+    Callbacks run on worker threads, so a GUI has to marshal them onto its
+    own event loop. ``clock`` tells the scheduler and the backups the time.
+    """
+
+    def __init__(self, config, state_dir, on_job_done=None, on_progress=None, on_status=None,
+                 on_finished=None, clock=datetime.datetime.now):
+        self.config = config
+        self.state_dir = state_dir
+        self.on_job_done = on_job_done
+        self.on_progress = on_progress
+        self.on_status = on_status
+        self.on_finished = on_finished
+        self.clock = clock
+        self.scheduler = Scheduler(state_file=os.path.join(state_dir, "scheduler_state.json"),
+                                   clock=clock)
+        self.catalog = Catalog(os.path.join(state_dir, CATALOG_FILE_NAME))
+        # Shared by every run, so scheduled backups reuse connections and server metadata
+        self.connections = ConnectionManager.from_config(config)
+        self.metrics = MetricsHistory(os.path.join(state_dir, METRICS_FILE_NAME))
+        self._lock = threading.Lock()
+        self._engines = {}
+        # {job name: backup type} of the full and differential backups running
+        self._claims = {}
+        self._claims_released = threading.Condition(self._lock)
+        self._verifiers = set()
+        self._compression_pool = None
+
+    def _notify(self, callback, *args):
+        if callback:
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.error("Service callback failed: %s", e)
+
+    def _status(self, text):
+        logger.info(text)
+        self._notify(self.on_status, text)
+
+    @property
+    def busy(self):
+        with self._lock:
+            return bool(self._engines)
+
+    def backup(self, backup_type="full", databases=None, jobs=None):
+        """Run backups and block until they finish.
+
+        Backs up the configured ``databases`` (all of them by default), or
+        exactly ``jobs`` when given. Returns the job results, or None when
+        backups of this type are already running.
+        """
+        if jobs is None:
+            jobs = jobs_from_config(self.config, backup_type, databases)
+        # Log backups are short and frequent; ordering them is not worth a plan
+        if backup_type != "log" and any(job.window for job in jobs):
+            jobs = self._planned_order(jobs)
+        self._adopt_existing_backups(jobs)
+        engine = BackupEngine.from_config(self.config, on_job_done=self._job_done,
+                                          on_progress=self.on_progress, catalog=self.catalog,
+                                          stages=self.post_backup_stages(),
+                                          connections=self.connections, clock=self.clock)
+        with self._lock:
+            if backup_type in self._engines:
+                logger.warning("%s backups already running, skipping", backup_type)
+                return None
+            self._engines[backup_type] = engine
+            jobs = self._claim(backup_type, jobs)
+
+        results = None
+        try:
+            self._status(f"Running {len(jobs)} {backup_type} backups...")
+            results = engine.run(jobs)
+            failed = [r for r in results if not r.ok]
+            if engine.cancelled:
+                self._status("Backup cancelled")
+            elif failed:
+                self._status(f"{len(results) - len(failed)} of {len(results)} backups succeeded")
+            else:
+                self._status(f"All {len(results)} backups completed successfully!")
+            return results
+        finally:
+            with self._lock:
+                self._engines.pop(backup_type, None)
+                self._release(backup_type, jobs)
+            self._write_metrics()
+            self.collect_garbage()
+            self._notify(self.on_finished, backup_type, results)
+
+    def _claim(self, backup_type, jobs):
+        """Reserve the databases of ``jobs`` and return the jobs that may run.
+
+        A differential of a database whose full backup is running fails on SQL
+        Server and would be superseded anyway, so such jobs are dropped; a full
+        waits for differentials of its databases to finish. Called with
+        ``self._lock`` held.
+        """
+        if backup_type == "diff":
+            busy = {job.name for job in jobs if self._claims.get(job.name) == "full"}
+            if busy:
+                logger.warning("Skipping diff backups of %s, full backups running",
+                               ", ".join(sorted(busy)))
+            jobs = [job for job in jobs if job.name not in busy]
+        elif backup_type == "full":
+            while any(self._claims.get(job.name) == "diff" for job in jobs):
+                self._claims_released.wait()
+        else:
+            return jobs
+        for job in jobs:
+            self._claims[job.name] = backup_type
+        return jobs
+
+    def _release(self, backup_type, jobs):
+        for job in jobs:
+            if self._claims.get(job.name) == backup_type:
+                del self._claims[job.name]
+        self._claims_released.notify_all()
+
+    def _scheduled_backup(self, backup_type, databases):
+        """Run a scheduled batch, leaving out diffs whose full is due in the same minute"""
+        if backup_type == "diff":
+            minute = self.clock().replace(second=0, microsecond=0)
+            previous = minute - datetime.timedelta(minutes=1)
+            full = {name for group_type, spec, names in schedule_groups(self.config)
+                    if group_type == "full" and CronExpression(spec).next_after(previous) == minute
+                    for name in names}
+            if full & set(databases):
+                logger.info("Full backups of %s are due, skipping their diff backups",
+                            ", ".join(sorted(full & set(databases))))
+                databases = [name for name in databases if name not in full]
+                if not databases:
+                    return None
+        return self.backup(backup_type, databases)
+
+    def plan(self, backup_type="full", databases=None, jobs=None, start=None, sizes=True):
+        """Project when every job would run, longest first, and whether it fits its window.
+
+        ``start`` defaults to now; with ``sizes`` the servers are asked for
+        current database sizes, otherwise only the history is used.
+        """
+        if jobs is None:
+            jobs = jobs_from_config(self.config, backup_type, databases)
+        measured = {}
+        if sizes:
+            measured = current_sizes(self.connections, jobs,
+                                     self.config.get("max_workers", DEFAULT_MAX_WORKERS))
+        # Only what the estimator looks at: the recent good runs of these types
+        runs = []
+        for run_type in sorted({job.backup_type for job in jobs}):
+            runs += self.metrics.runs(backup_type=run_type, status="succeeded",
+                                      last=self.config.get("plan_history_runs",
+                                                           DEFAULT_HISTORY_RUNS))
+        return plan_from_config(self.config, jobs, runs, measured, start)
+
+    def _planned_order(self, jobs):
+        try:
+            plan = self.plan(jobs=jobs)
+        except Exception as e:
+            logger.error("Could not plan the backup window: %s", e)
+            return jobs
+        warning = plan.warning()
+        if warning:
+            logger.warning(warning)
+            self._notify(self.on_status, warning)
+        return plan.jobs
+
+    def window_plans(self, backup_type=None, databases=None, sizes=True):
+        """Plan the next run of every scheduled batch that has a maintenance window.
+
+        Returns ``(backup_type, spec, plan)`` tuples, each plan starting when
+        its window next opens. Log batches are left out unless asked for.
+        """
+        plans = []
+        for group_type, spec, names in schedule_groups(self.config):
+            if group_type != backup_type and (backup_type is not None or group_type == "log"):
+                continue
+            if databases is not None:
+                names = [name for name in names if name in databases]
+            jobs = [job for job in jobs_from_config(self.config, group_type, names) if job.window]
+            if jobs:
+                start, _ = jobs[0].window.occurrence(self.clock())
+                plans.append((group_type, spec, self.plan(jobs=jobs, start=start, sizes=sizes)))
+        return plans
+
+    def _check_windows(self):
+        """Warn at start-up about scheduled batches projected to overrun their window"""
+        try:
+            plans = self.window_plans(sizes=False)
+        except Exception as e:
+            logger.error("Could not plan the backup windows: %s", e)
+            return
+        for backup_type, spec, plan in plans:
+            if not plan.informed:
+                logger.info("No history yet to project the %s backups at %s", backup_type, spec)
+                continue
+            warning = plan.warning()
+            if warning:
+                logger.warning("%s (%s %s)", warning, backup_type, spec)
+                self._notify(self.on_status, warning)
+
+    def _job_done(self, result):
+        try:
+            self.metrics.record(result)
+        except Exception as e:
+            logger.error("Could not record metrics of %s: %s", result.job.name, e)
+        self._notify(self.on_job_done, result)
+
+    def _write_metrics(self):
+        """Refresh the configured export files and drop expired history"""
+        try:
+            days = self.config.get("metrics_history_days", DEFAULT_HISTORY_DAYS)
+            if days:
+                self.metrics.forget_before(self.clock() - datetime.timedelta(days=days))
+            if self.config.get("metrics_file"):
+                write_atomically(self.config["metrics_file"], self.export_metrics("prometheus"))
+            if self.config.get("metrics_json_file"):
+                write_atomically(self.config["metrics_json_file"], self.export_metrics("json"))
+        except Exception as e:
+            logger.error("Could not write metrics: %s", e)
+
+    def export_metrics(self, format="prometheus"):
+        """The last run of every job as Prometheus text or JSON"""
+        runs = self.metrics.latest()
+        return json_summary(runs) if format == "json" else prometheus_text(runs)
+
+    def metrics_report(self, database=None, limit=10, window=7):
+        """Slowest jobs and phases getting slower, as text"""
+        return format_report(self.metrics.runs(database=database), limit, window)
+
+    def post_backup_stages(self):
+        """The stages every successful backup goes through, in order"""
+        stages = []
+        repository = repository_from_config(self.config)
+        codec = self.config.get("client_compression")
+        if codec and repository:
+            # Compressed output hardly deduplicates; dedup_compress packs the chunks instead
+            logger.warning("client_compression is ignored while dedup_repository is set")
+        elif codec:
+            workers = self.config.get("compression_workers", DEFAULT_COMPRESSION_WORKERS)
+            stages.append(CompressionStage(
+                codec,
+                level=self.config.get("compression_level"),
+                block_size=self.config.get("compression_block_size", DEFAULT_BLOCK_SIZE),
+                workers=workers,
+                catalog=self.catalog,
+                pool=self._shared_compression_pool(workers)))
+        if self.config.get("write_manifest", True):
+            stages.append(ManifestStage(self.config.get("hash_workers", DEFAULT_HASH_WORKERS),
+                                        self.catalog))
+        copier = copier_from_config(self.config)
+        if copier:
+            stages.append(OffsiteCopyStage(copier))
+        if repository:
+            # After the manifest and offsite copies, which still see the plain files
+            stages.append(DedupStage(repository, self.catalog))
+        if self.config.get("verify_mode"):
+            stages.append(VerifyQueueStage(self.catalog))
+        return stages
+
+    def _shared_compression_pool(self, workers):
+        # One pool for every job and run: a pool per job would start
+        # cpu_count - 1 processes for each backup compressing in parallel
+        with self._lock:
+            if self._compression_pool is None:
+                self._compression_pool = ProcessPoolExecutor(max_workers=workers)
+            return self._compression_pool
+
+    def _adopt_existing_backups(self, jobs):
+        # Backups taken before the catalog existed would otherwise never be
+        # seen by retention again
+        known = {}
+        for job in jobs:
+            if job.server not in known:
+                known[job.server] = set(self.catalog.databases(job.server))
+            if job.database not in known[job.server]:
+                self.catalog.reconcile(job.directories, job.database, job.server)
+
+    def cancel(self):
+        """Cancel every backup that is running"""
+        with self._lock:
+            engines = list(self._engines.values())
+            verifiers = list(self._verifiers)
+        for engine in engines:
+            engine.cancel()
+        for verifier in verifiers:
+            verifier.stop()
+
+    def prune(self, databases=None, dry_run=False):
+        """Apply retention to the configured databases without backing up.
+
+        Returns the retention plan of every database; with ``dry_run``
+        nothing is deleted.
+        """
+        plans = [prune_backups(job.directories, job.database, job.retention, self.catalog,
+                               dry_run=dry_run, server=job.server)
+                 for job in jobs_from_config(self.config, databases=databases)]
+        if not dry_run:
+            self.collect_garbage()
+        return plans
+
+    def collect_garbage(self, min_garbage_ratio=None):
+        """Reclaim dedup chunks that retention left unused; returns the bytes freed"""
+        repository = repository_from_config(self.config)
+        if repository is None:
+            return 0
+        if min_garbage_ratio is None:
+            min_garbage_ratio = self.config.get("dedup_garbage_ratio", DEFAULT_GARBAGE_RATIO)
+        try:
+            return repository.collect_garbage(min_garbage_ratio)
+        except Exception as e:
+            logger.error("Dedup garbage collection failed: %s", e)
+            return 0
+
+    def dedup_stats(self):
+        """Size of the dedup repository against the backups it holds, or None"""
+        repository = repository_from_config(self.config)
+        return repository.stats() if repository else None
+
+    def reconcile(self, databases=None):
+        """Resync the catalog with the backup files on disk.
+
+        Returns {job name: (added, removed)}.
+        """
+        return {job.name: self.catalog.reconcile(job.directories, job.database, job.server)
+                for job in jobs_from_config(self.config, databases=databases)}
+
+    def copy_offsite(self, databases=None):
+        """Copy every catalogued backup to the offsite targets.
+
+        Finished copies are skipped and partial ones resumed, so this catches
+        up after a target was unreachable. Returns the number of failed sets.
+        """
+        copier = copier_from_config(self.config)
+        if not copier:
+            raise ValueError("No offsite_targets configured")
+        failed = 0
+        for job in jobs_from_config(self.config, databases=databases):
+            for record in self.catalog.backups(database=job.database, server=job.server):
+                try:
+                    copier.copy_set(record.paths)
+                except Exception as e:
+                    logger.error("Offsite copy of %s failed: %s", record.set_key, e)
+                    failed += 1
+        return failed
+
+    def test_connection(self, job):
+        """Connect as ``job`` would and return fresh metadata of its server.
+
+        Raises whatever the driver raises when the server cannot be reached.
+        """
+        info = self.connections.server_info(job, refresh=True)
+        if not info.has_database(job.database):
+            raise ValueError(f"Database {job.database} does not exist on {job.server}")
+        return info
+
+    def _verify_target(self, record):
+        """The server and login to verify ``record`` with"""
+        target = self.config.get("verify_server")
+        if isinstance(target, str):
+            target = {"server": target}
+        if target:
+            settings = dict(self.config, **target)
+            return BackupJob(settings["server"], "master", "",
+                             settings.get("trusted_connection", "yes"),
+                             settings.get("username", ""), settings.get("password", ""))
+        for job in jobs_from_config(self.config, databases=[record.database]):
+            if job.server == record.server:
+                return job
+        return BackupJob(record.server, "master", "",
+                         self.config.get("trusted_connection", "yes"),
+                         self.config.get("username", ""), self.config.get("password", ""))
+
+    def verify(self, databases=None, limit=None):
+        """Verify the backups queued since the last run.
+
+        Returns {backup id: status}; raises ValueError without a verify_mode.
+        """
+        verifier = verifier_from_config(self.config, self.catalog, self.connections,
+                                        self._verify_target)
+        if verifier is None:
+            raise ValueError("No verify_mode configured")
+        with self._lock:
+            self._verifiers.add(verifier)
+        try:
+            outcomes = verifier.run(databases, limit)
+        finally:
+            with self._lock:
+                self._verifiers.discard(verifier)
+        failed = sum(status == "failed" for status in outcomes.values())
+        if outcomes:
+            self._status(f"Verified {len(outcomes)} backups, {failed} failed")
+        return outcomes
+
+    def history(self, database=None):
+        """Backups recorded in the catalog, oldest first"""
+        return self.catalog.backups(database=database)
+
+    @property
+    def scheduler_running(self):
+        return self.scheduler.running
+
+    def start_scheduler(self):
+        """Schedule every database from the config and start dispatching.
+
+        Raises ValueError for a schedule that cannot be parsed, leaving the
+        scheduler stopped.
+        """
+        self.scheduler.clear()
+        try:
+            for backup_type, spec, databases in schedule_groups(self.config):
+                self.scheduler.add_job(f"{backup_type}:{spec}", spec,
+                                       self._scheduled_backup, backup_type, databases)
+            if self.config.get("verify_mode") and self.config.get("verify_schedule"):
+                spec = self.config["verify_schedule"]
+                self.scheduler.add_job(f"verify:{spec}", spec, self.verify)
+        except ValueError:
+            self.scheduler.clear()
+            raise
+        self._check_windows()
+        self.scheduler.start()
+
+    def stop_scheduler(self):
+        self.scheduler.stop()
+        self.scheduler.clear()
+
+    def close(self):
+        """Close pooled connections, the compression pool, the dedup repositories and the catalog"""
+        self.connections.close()
+        with self._lock:
+            pool, self._compression_pool = self._compression_pool, None
+        if pool is not None:
+            pool.shutdown()
+        close_repositories()
+        self.metrics.close()
+        self.catalog.close()
+
+    def next_run(self):
+        return self.scheduler.next_run()
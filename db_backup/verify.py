@@ -0,0 +1,249 @@
+#Verification of finished backups, off the production server or outside its busy hours
+import datetime
+import logging
+import ntpath
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backup_options import DEDUP_SUFFIX, PACKED_SUFFIXES, split_backup_name
+from catalog import VERIFY_FAILED, VERIFY_PASSED, VERIFY_QUEUED, VERIFY_SKIPPED
+from compress import decompress_file
+from dedup import rehydrate
+from offsite import RateLimiter
+from progress import follow_backup
+from retention import free_bytes
+from scheduler import DailyWindow
+
+logger = logging.getLogger(__name__)
+
+VERIFY_MODES = ("verifyonly", "restore")
+DEFAULT_VERIFY_WORKERS = 1
+SCRATCH_PREFIX = "verify_"
+# Beside the backups by default, so a path_map covering them covers it too
+SCRATCH_DIRECTORY = "verify_scratch"
+
+
+class VerifyQueueStage:
+    """Post-backup stage queueing the new set for the next verification run"""
+
+    name = "verify queue"
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def run(self, job, result):
+        if result.catalog_id is not None:
+            self.catalog.update(result.catalog_id, verify_status=VERIFY_QUEUED)
+
+
+def _disk_list(paths):
+    return ", ".join("DISK = ?" for _ in paths)
+
+
+def _quote(name):
+    return "[" + name.replace("]", "]]") + "]"
+
+
+class Verifier:
+    """Work through the verification queue of the catalog.
+
+    ``target_for(record)`` returns the job-like object (server and login)
+    to verify a backup on; pointing it at a spare server keeps the reads off
+    production. ``path_map`` rewrites backup paths into what that server
+    sees, e.g. ``{"D:\\\\Backups": "\\\\\\\\nas\\\\Backups"}``.
+
+    In ``verifyonly`` mode every set gets RESTORE VERIFYONLY. In ``restore``
+    mode full backups are restored under a scratch name, checked with
+    DBCC CHECKDB when ``check_db`` is set and dropped again; differential
+    and log sets, which cannot be restored alone, still get VERIFYONLY.
+    ``workers`` verifications run at once, ``bandwidth_limit`` paces them
+    to that many bytes per second on average, and with a ``window`` none
+    starts outside it.
+
+    Stripes compressed on the client or moved into the dedup repository are
+    unpacked into ``scratch_path`` (a ``verify_scratch`` folder beside them
+    by default) for the verification and removed afterwards.
+    """
+
+    def __init__(self, catalog, connections, target_for, mode="verifyonly",
+                 workers=DEFAULT_VERIFY_WORKERS, bandwidth_limit=None, window=None,
+                 path_map=None, data_path=None, check_db=True, scratch_path=None,
+                 clock=datetime.datetime.now):
+        if mode not in VERIFY_MODES:
+            raise ValueError(f"Unknown verify mode {mode!r}, expected one of {VERIFY_MODES}")
+        self.catalog = catalog
+        self.connections = connections
+        self.target_for = target_for
+        self.mode = mode
+        self.workers = max(1, int(workers))
+        self.limiter = RateLimiter(bandwidth_limit) if bandwidth_limit else None
+        self.window = DailyWindow(window) if isinstance(window, str) else window
+        self.path_map = dict(path_map or {})
+        self.data_path = data_path
+        self.check_db = check_db
+        self.scratch_path = scratch_path
+        self.clock = clock
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Let running verifications finish but start no more"""
+        self._stop.set()
+
+    def _may_start(self):
+        if self._stop.is_set():
+            return False
+        return self.window is None or self.clock() in self.window
+
+    def server_path(self, path):
+        for local, remote in self.path_map.items():
+            if path.lower().startswith(local.lower()):
+                return remote + path[len(local):]
+        return path
+
+    def run(self, databases=None, limit=None):
+        """Verify queued backups, newest first; returns {backup id: status}"""
+        self._stop.clear()
+        queue = self.catalog.queued_for_verification(databases)
+        if limit is not None:
+            queue = queue[:limit]
+        outcomes = {}
+        if not queue:
+            return outcomes
+        logger.info("Verifying %d backups in %s mode", len(queue), self.mode)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="verify") as pool:
+            for record, status in zip(queue, pool.map(self._verify_queued, queue)):
+                if status is not None:
+                    outcomes[record.id] = status
+        return outcomes
+
+    def _verify_queued(self, record):
+        if not self._may_start():
+            return None
+        if self.limiter and record.size:
+            self.limiter.consume(record.size)
+        if not self._may_start():
+            return None
+        return self.verify(record)
+
+    def _scratch_directory(self, path):
+        return self.scratch_path or os.path.join(os.path.dirname(path), SCRATCH_DIRECTORY)
+
+    def _room_to_unpack(self, record, packed):
+        free = free_bytes([self._scratch_directory(path) for path in packed])
+        return free is None or free >= (record.original_size or record.size or 0)
+
+    def _unpack(self, paths, unpacked):
+        """The stripes as RESTORE can read them, unpacking packed ones into scratch space"""
+        readable = []
+        for path in paths:
+            if not path.lower().endswith(PACKED_SUFFIXES):
+                readable.append(path)
+                continue
+            stem, extension, _ = split_backup_name(path)
+            directory = self._scratch_directory(path)
+            os.makedirs(directory, exist_ok=True)
+            destination = os.path.join(directory, stem + extension)
+            unpacked.append(destination)
+            if path.lower().endswith(DEDUP_SUFFIX):
+                rehydrate(path, destination)
+            else:
+                decompress_file(path, destination)
+            readable.append(destination)
+        return readable
+
+    def verify(self, record):
+        """Verify one catalogued backup and record the outcome"""
+        packed = [path for path in record.paths if path.lower().endswith(PACKED_SUFFIXES)]
+        if packed and not self._room_to_unpack(record, packed):
+            self.catalog.record_verification(record.id, VERIFY_SKIPPED,
+                                              "not enough scratch space to unpack it")
+            return VERIFY_SKIPPED
+
+        target = self.target_for(record)
+        started = time.monotonic()
+        conn = None
+        healthy = False
+        unpacked = []
+        try:
+            paths = [self.server_path(p) for p in self._unpack(record.paths, unpacked)]
+            conn = self.connections.acquire(target, "master")
+            cursor = conn.cursor()
+            if self.mode == "restore" and record.backup_type == "full":
+                self._test_restore(cursor, record, paths)
+            else:
+                cursor.execute(f"RESTORE VERIFYONLY FROM {_disk_list(paths)} WITH STATS = 10",
+                               paths)
+                follow_backup(cursor)
+            healthy = True
+            status, error = VERIFY_PASSED, None
+        except Exception as e:
+            status, error = VERIFY_FAILED, str(e)
+        finally:
+            if conn:
+                self.connections.release(target, conn, healthy)
+            _remove_scratch(unpacked)
+
+        self.catalog.record_verification(record.id, status, error)
+        elapsed = time.monotonic() - started
+        if status == VERIFY_PASSED:
+            logger.info("Verified %s on %s in %.1fs", record.set_key, target.server, elapsed)
+        else:
+            logger.error("Verification of %s failed: %s", record.set_key, error)
+        return status
+
+    def _test_restore(self, cursor, record, paths):
+        name = f"{SCRATCH_PREFIX}{record.database}_{record.id}"
+        cursor.execute(f"RESTORE FILELISTONLY FROM {_disk_list(paths)}", paths)
+        moves = []
+        for row in cursor.fetchall():
+            logical, physical = row[0], row[1]
+            directory = self.data_path or ntpath.dirname(physical)
+            moves.append((logical, ntpath.join(directory,
+                                               f"{name}_{logical}{ntpath.splitext(physical)[1]}")))
+        move_clause = "".join(", MOVE ? TO ?" for _ in moves)
+        params = paths + [value for move in moves for value in move]
+        try:
+            cursor.execute(f"RESTORE DATABASE {_quote(name)} FROM {_disk_list(paths)} "
+                           f"WITH REPLACE, RECOVERY, STATS = 10{move_clause}", params)
+            follow_backup(cursor)
+            if self.check_db:
+                cursor.execute(f"DBCC CHECKDB ({_quote(name)}) WITH NO_INFOMSGS, ALL_ERRORMSGS")
+                follow_backup(cursor)
+        finally:
+            try:
+                cursor.execute(f"IF DB_ID(?) IS NOT NULL DROP DATABASE {_quote(name)}", (name,))
+            except Exception as e:
+                logger.warning("Could not drop scratch database %s: %s", name, e)
+
+
+def _remove_scratch(paths):
+    for path in paths:
+        for leftover in (path, path + ".tmp"):
+            try:
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            except OSError as e:
+                logger.warning("Could not remove scratch file %s: %s", leftover, e)
+    for directory in {os.path.dirname(path) for path in paths}:
+        if os.path.basename(directory) == SCRATCH_DIRECTORY:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # Another verification still uses it
+                pass
+
+
+def verifier_from_config(config, catalog, connections, target_for):
+    mode = config.get("verify_mode")
+    if not mode:
+        return None
+    return Verifier(catalog, connections, target_for, mode,
+                    workers=config.get("verify_workers", DEFAULT_VERIFY_WORKERS),
+                    bandwidth_limit=config.get("verify_bandwidth_limit"),
+                    window=config.get("verify_window"),
+                    path_map=config.get("verify_path_map"),
+                    data_path=config.get("verify_data_path"),
+                    check_db=config.get("verify_check_db", True),
+                    scratch_path=config.get("verify_scratch_path"))
@@ -0,0 +1,56 @@
+#Shared fixtures: the flat modules on sys.path and a fresh simulated SQL Server per test
+import datetime
+import os
+import sys
+import threading
+
+import pytest
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "db_backup")
+sys.path.insert(0, PACKAGE_DIR)
+# Tests always run against the simulated server
+os.environ["DB_BACKUP_DRIVER"] = "fake"
+
+import fake_pyodbc  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fake_servers():
+    fake_pyodbc.reset()
+    yield fake_pyodbc
+    fake_pyodbc.reset()
+
+
+class TickingClock:
+    """A clock a second further on every time it is read, so backups never share a name"""
+
+    def __init__(self, start=datetime.datetime(2024, 3, 5, 23, 0)):
+        self.now = start
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.now += datetime.timedelta(seconds=1)
+            return self.now
+
+
+@pytest.fixture
+def clock():
+    return TickingClock()
+
+
+@pytest.fixture
+def make_service(tmp_path):
+    """Build BackupServices over ``tmp_path`` and close them after the test"""
+    from service import BackupService
+    services = []
+
+    def make(config, state_dir=None, **kwargs):
+        service = BackupService(dict({"driver": "fake"}, **config),
+                                str(state_dir or tmp_path / "state"), **kwargs)
+        services.append(service)
+        return service
+
+    yield make
+    for service in services:
+        service.close()
@@ -0,0 +1,52 @@
+import os
+
+from backup_options import BackupOptions, backup_set_key, build_backup_query, split_backup_name
+
+import pytest
+
+
+def test_defaults_keep_the_old_command():
+    assert BackupOptions().with_clause() == "FORMAT, STATS = 10"
+
+
+def test_with_clause_lists_every_set_option():
+    options = BackupOptions(compression=True, checksum=False, buffercount=50,
+                            maxtransfersize=4 * 1024 * 1024, blocksize=65536, stats=5)
+    assert options.with_clause("diff") == (
+        "FORMAT, DIFFERENTIAL, COMPRESSION, NO_CHECKSUM, BUFFERCOUNT = 50, "
+        "MAXTRANSFERSIZE = 4194304, BLOCKSIZE = 65536, STATS = 5")
+    assert "DIFFERENTIAL" not in options.with_clause("log")
+    assert BackupOptions(compression=False, stats=None).with_clause() == "FORMAT, NO_COMPRESSION"
+
+
+@pytest.mark.parametrize("settings", [
+    {"stripes": 65}, {"buffercount": 0}, {"maxtransfersize": 100_000},
+    {"maxtransfersize": 8 * 1024 * 1024}, {"blocksize": 3000}, {"stats": 0},
+])
+def test_invalid_options(settings):
+    with pytest.raises(ValueError):
+        BackupOptions(**settings)
+
+
+def test_stripes_spread_over_paths():
+    options = BackupOptions.from_dict({"stripes": 3, "stripe_paths": ["D:", "E:"]})
+    files = options.stripe_files("C:", "Sales", "20240305_230000", "log")
+    assert [os.path.basename(f) for f in files] == [
+        f"Sales_20240305_230000_{n}of3.trn" for n in (1, 2, 3)]
+    assert [os.path.dirname(f) for f in files] == ["D:", "E:", "D:"]
+    assert {backup_set_key(f) for f in files} == {"Sales_20240305_230000"}
+    assert BackupOptions.from_dict(options.to_dict()).to_dict() == options.to_dict()
+
+
+def test_query_has_a_disk_per_stripe():
+    query = build_backup_query("Sales", ["a.bak", "b.bak"], BackupOptions(stripes=2))
+    assert "BACKUP DATABASE [Sales]" in query
+    assert "TO DISK = ?, DISK = ?" in query
+    assert "BACKUP LOG" in build_backup_query("Sales", ["a.trn"], BackupOptions(), "log")
+    with pytest.raises(ValueError):
+        build_backup_query("Sales", ["a.bak"], BackupOptions(), "copy")
+
+
+def test_packed_suffix_split_off():
+    assert split_backup_name("x/Sales_1of2.bak.zst") == ("Sales_1of2", ".bak", ".zst")
+    assert split_backup_name("Sales.trn.dedup") == ("Sales", ".trn", ".dedup")
@@ -0,0 +1,116 @@
+import datetime
+import os
+import sqlite3
+
+from catalog import VERIFY_QUEUED, Catalog, parse_backup_name
+
+import pytest
+
+STARTED = datetime.datetime(2024, 3, 5, 23, 0)
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = Catalog(str(tmp_path / "catalog.db"))
+    yield catalog
+    catalog.close()
+
+
+def write(path, size):
+    path.write_bytes(bytes(size))
+    return str(path)
+
+
+def test_record_and_replace_files(tmp_path, catalog):
+    stripes = [write(tmp_path / f"Sales_20240305_230000_{n}of2.bak", 1000) for n in (1, 2)]
+    backup_id = catalog.record_backup("sql0", "Sales", "full", stripes, STARTED,
+                                      STARTED + datetime.timedelta(seconds=90),
+                                      checksum="abc", first_lsn=100, last_lsn=200)
+    record = catalog.get(backup_id)
+    assert (record.set_key, record.size, record.original_size) == ("Sales_20240305_230000", 2000,
+                                                                   2000)
+    assert (record.duration, record.first_lsn, record.paths) == (90, "100", stripes)
+
+    packed = [write(tmp_path / f"Sales_20240305_230000_{n}of2.bak.gz", 300) for n in (1, 2)]
+    catalog.replace_files(backup_id, packed)
+    record = catalog.get(backup_id)
+    assert (record.size, record.original_size, record.paths) == (600, 2000, packed)
+    assert catalog.find_by_path(packed[1]).id == backup_id
+    assert catalog.find_by_path(stripes[0]) is None
+
+
+def test_backups_filtered_by_server_and_type(tmp_path, catalog):
+    for server in ("sql0", "sql1"):
+        for backup_type, extension in (("full", "bak"), ("log", "trn")):
+            path = write(tmp_path / f"{server}_Sales_20240305_230000.{extension}", 10)
+            catalog.record_backup(server, "Sales", backup_type, [path], STARTED)
+    assert len(catalog.backups(database="Sales")) == 4
+    assert [(r.server, r.backup_type) for r in catalog.backups(server="sql1")] == [
+        ("sql1", "full"), ("sql1", "log")]
+    assert [r.server for r in catalog.backups(backup_type="log")] == ["sql0", "sql1"]
+    assert catalog.databases("sql0") == ["Sales"]
+    assert catalog.databases("sql2") == []
+
+
+def test_reconcile_adds_and_drops(tmp_path, catalog):
+    gone = write(tmp_path / "Sales_20240304_230000.bak", 10)
+    catalog.record_backup("sql0", "Sales", "full", [gone], STARTED)
+    os.remove(gone)
+    for name in ("Sales_20240305_230000_2of2.bak", "Sales_20240305_230000_1of2.bak",
+                 "Sales_20240305_231500.trn", "SalesArchive_20240305_230000.bak", "notes.txt"):
+        write(tmp_path / name, 10)
+
+    assert catalog.reconcile([str(tmp_path)], "Sales", "sql0") == (2, 1)
+    full, log = catalog.backups(database="Sales")
+    assert [p.rsplit("_", 1)[-1] for p in full.paths] == ["1of2.bak", "2of2.bak"]
+    assert (full.backup_type, log.backup_type) == ("full", "log")
+    assert log.started == datetime.datetime(2024, 3, 5, 23, 15)
+    assert catalog.reconcile([str(tmp_path)], "Sales", "sql0") == (0, 0)
+
+
+def test_verification_queue(tmp_path, catalog):
+    ids = [catalog.record_backup("sql0", "Sales", "full",
+                                 [write(tmp_path / f"Sales_2024030{day}_230000.bak", 10)],
+                                 STARTED + datetime.timedelta(days=day))
+           for day in range(1, 4)]
+    for backup_id in ids[:2]:
+        catalog.update(backup_id, verify_status=VERIFY_QUEUED)
+    assert [r.id for r in catalog.queued_for_verification()] == ids[1::-1]
+    assert catalog.queued_for_verification(["Stock"]) == []
+    catalog.record_verification(ids[1], "passed")
+    assert catalog.get(ids[1]).is_verified
+    assert [r.id for r in catalog.queued_for_verification()] == ids[:1]
+
+
+def test_columns_added_to_old_catalog(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE backups (id INTEGER PRIMARY KEY, server TEXT NOT NULL,
+                    database TEXT NOT NULL, backup_type TEXT NOT NULL, set_key TEXT NOT NULL,
+                    started TEXT NOT NULL, finished TEXT, duration REAL, size INTEGER,
+                    checksum TEXT, first_lsn TEXT, last_lsn TEXT, database_backup_lsn TEXT)""")
+    conn.execute("""INSERT INTO backups (server, database, backup_type, set_key, started, size)
+                    VALUES ('sql0', 'Sales', 'full', 'Sales_20240305_230000',
+                            '2024-03-05 23:00:00', 10)""")
+    conn.commit()
+    conn.close()
+
+    catalog = Catalog(path)
+    try:
+        record, = catalog.backups()
+        assert (record.size, record.original_size, record.verify_status) == (10, None, None)
+    finally:
+        catalog.close()
+
+
+@pytest.mark.parametrize("name, database, expected", [
+    ("Sales_20240305_230000.bak", None, ("Sales", "full", "Sales_20240305_230000")),
+    ("Sales_20240305_230000_3of4.dif.zst", "Sales", ("Sales", "diff", "Sales_20240305_230000")),
+    ("My_Db_20240305_230000.trn.dedup", None, ("My_Db", "log", "My_Db_20240305_230000")),
+    ("SalesArchive_20240305_230000.bak", "Sales", None),
+    ("Sales_20241305_230000.bak", None, None),
+    ("Sales_20240305_230000.bak.manifest.json", None, None),
+])
+def test_parse_backup_name(name, database, expected):
+    parsed = parse_backup_name(name, database)
+    assert (parsed[:3] if parsed else None) == expected
@@ -0,0 +1,67 @@
+import json
+
+from cli import main
+
+import pytest
+
+
+@pytest.fixture
+def config_file(tmp_path, fake_servers):
+    fake_servers.add_server("sql0", time_scale=0.01)
+    path = tmp_path / "state" / "backup_config.json"
+    path.parent.mkdir()
+    path.write_text(json.dumps({"server": "sql0", "databases": ["Sales", "Stock"],
+                                "backup_path": str(tmp_path / "bk")}))
+    return str(path)
+
+
+def test_run_then_list_and_export(config_file, capsys):
+    assert main(["--config", config_file, "run", "--db", "Sales"]) == 0
+    assert capsys.readouterr().out == "sql0/Sales: succeeded\n"
+
+    assert main(["--config", config_file, "list"]) == 0
+    listed = capsys.readouterr().out.splitlines()
+    assert len(listed) == 1 and "Sales" in listed[0] and " full " in listed[0]
+
+    assert main(["--config", config_file, "metrics", "--format", "json"]) == 0
+    job, = json.loads(capsys.readouterr().out)["jobs"]
+    assert (job["database"], job["status"]) == ("Sales", "succeeded")
+
+    assert main(["--config", config_file, "metrics"]) == 0
+    assert 'db_backup_last_run_success{server="sql0",database="Sales",backup_type="full"} 1' \
+        in capsys.readouterr().out
+
+
+def test_failed_backup_exits_nonzero(config_file, fake_servers, capsys):
+    fake_servers.get_server("sql0").fail_databases.add("Stock")
+    assert main(["--config", config_file, "run"]) == 1
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "sql0/Sales: succeeded"
+    assert lines[1].startswith("sql0/Stock: failed (")
+
+
+def test_reconcile_and_dry_run_prune(tmp_path, config_file, capsys):
+    (tmp_path / "bk").mkdir()
+    for day in (1, 2, 3):
+        (tmp_path / "bk" / f"Sales_2024030{day}_230000.bak").write_bytes(bytes(1024 * 1024))
+    assert main(["--config", config_file, "reconcile", "--db", "Sales"]) == 0
+    assert capsys.readouterr().out == "sql0/Sales: 3 added, 0 removed\n"
+
+    with open(config_file) as f:
+        config = json.load(f)
+    config["retention"] = {"keep_last": 1}
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    assert main(["--config", config_file, "prune", "--db", "Sales", "--dry-run"]) == 0
+    assert "Dry run: 2.0 MB would be reclaimed" in capsys.readouterr().out
+    assert len(list((tmp_path / "bk").iterdir())) == 3
+
+
+def test_errors_reported_not_raised(tmp_path, capsys):
+    assert main(["--config", str(tmp_path / "missing" / "config.json"), "rehydrate",
+                 str(tmp_path / "none.dedup")]) == 1
+
+
+def test_unknown_command_rejected(capsys):
+    with pytest.raises(SystemExit):
+        main(["explode"])
@@ -0,0 +1,75 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+from backup_engine import BackupEngine, jobs_from_config
+from compress import (CompressionStage, compress_file, decompress_file, index_path, read_index,
+                      read_range, zstandard)
+
+import pytest
+
+BLOCK = 64 * 1024
+CODECS = ["gzip"] + (["zstd"] if zstandard else [])
+
+
+@pytest.fixture
+def backup(tmp_path):
+    path = tmp_path / "Sales_20240101_000000.bak"
+    # Half random, half empty pages, like a real backup
+    path.write_bytes(b"".join(os.urandom(BLOCK // 2) + bytes(BLOCK // 2) for _ in range(9))
+                     + b"tail")
+    return str(path)
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_round_trip(tmp_path, backup, codec):
+    compressed = compress_file(backup, codec, block_size=BLOCK, workers=2)
+    assert os.path.getsize(compressed) < os.path.getsize(backup)
+    assert read_index(compressed)["original_size"] == os.path.getsize(backup)
+    restored = decompress_file(compressed, str(tmp_path / "restored.bak"))
+    assert open(restored, 'rb').read() == open(backup, 'rb').read()
+
+
+def test_read_range_across_blocks(backup):
+    compressed = compress_file(backup, "gzip", block_size=BLOCK, workers=2)
+    original = open(backup, 'rb').read()
+    for offset, length in ((0, 10), (BLOCK - 5, 10), (3 * BLOCK, 2 * BLOCK + 1),
+                           (len(original) - 3, 100), (len(original) + 1, 5)):
+        assert read_range(compressed, offset, length) == original[offset:offset + length]
+
+
+def test_stage_replaces_stripes_using_shared_pool(tmp_path, backup):
+    second = tmp_path / "Sales_20240101_000000_2.bak"
+    second.write_bytes(open(backup, 'rb').read()[::-1])
+    originals = {path: open(path, 'rb').read() for path in (backup, str(second))}
+    result = SimpleNamespace(backup_files=list(originals), catalog_id=None)
+    job = SimpleNamespace(name="sql0/Sales")
+
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        stage = CompressionStage("gzip", block_size=BLOCK, workers=2, pool=pool)
+        assert stage.run(job, result) == sum(map(len, originals.values()))
+        # The pool is the caller's and still usable
+        assert pool.submit(len, b"abc").result() == 3
+
+    assert all(os.path.exists(index_path(p)) for p in result.backup_files)
+    assert not any(os.path.exists(p) for p in originals)
+    for path, data in zip(originals, originals.values()):
+        compressed = path + ".gz"
+        assert compressed in result.backup_files
+        assert open(decompress_file(compressed, path), 'rb').read() == data
+
+
+def test_room_made_for_the_uncompressed_backup(tmp_path, make_service, fake_servers):
+    fake_servers.add_server("sql0", time_scale=0.01, write_bytes=256 * 1024)
+    service = make_service({"server": "sql0", "databases": ["Sales"],
+                            "backup_path": str(tmp_path / "bk"), "client_compression": "gzip"})
+    result, = service.backup()
+    assert result.backup_file.endswith(".gz")
+    record, = service.history()
+    assert record.original_size == 256 * 1024
+    assert record.size == os.path.getsize(result.backup_file)
+
+    engine = BackupEngine(catalog=service.catalog)
+    job, = jobs_from_config(service.config)
+    assert engine._expected_size(job, "full", 1000) == 256 * 1024
+    assert engine._expected_size(job, "full", 10 ** 9) == 10 ** 9
@@ -0,0 +1,38 @@
+from backup_engine import BackupJob
+from connections import ConnectionManager
+
+import pytest
+
+
+@pytest.fixture
+def connections():
+    connections = ConnectionManager(retries=1, driver="fake")
+    yield connections
+    connections.close()
+
+
+def test_server_info_cached_until_a_connection_fails(tmp_path, connections, fake_servers):
+    server = fake_servers.add_server("sql0")
+    job = BackupJob("sql0", "Sales", str(tmp_path))
+    assert connections.server_info(job).version == "16.0.1000.6"
+
+    server.version = "17.0.100.1"
+    conn = connections.acquire(job)
+    connections.release(job, conn)
+    assert connections.server_info(job).version == "16.0.1000.6"
+
+    conn = connections.acquire(job)
+    connections.release(job, conn, healthy=False)
+    assert connections.server_info(job).version == "17.0.100.1"
+
+
+def test_database_gone_drops_cached_info(tmp_path, connections, fake_servers):
+    server = fake_servers.add_server("sql0", auto_create=False)
+    server.add_database("Sales")
+    job = BackupJob("sql0", "Sales", str(tmp_path))
+    assert connections.server_info(job).has_database("Sales")
+
+    del server.databases["Sales"]
+    with pytest.raises(Exception, match="does not exist"):
+        connections.acquire(job)
+    assert not connections.server_info(job).has_database("Sales")
@@ -0,0 +1,161 @@
+import multiprocessing
+import os
+import random
+
+from backup_engine import BackupEngine, jobs_from_config
+from dedup import DedupRepository, pointer_path, read_pointer, rehydrate, write_pointer
+
+import pytest
+
+CHUNK = 16 * 1024
+
+
+def nightly_full(seed, base, size=1024 * 1024):
+    """``base`` with a few scattered pages changed and a header of varying length"""
+    data = bytearray(base[:size])
+    rng = random.Random(seed)
+    for _ in range(5):
+        offset = rng.randrange(0, size - 8192)
+        data[offset:offset + 8192] = rng.randbytes(8192)
+    return rng.randbytes(rng.randrange(100, 600)) + bytes(data)
+
+
+@pytest.fixture
+def repository(tmp_path):
+    repository = DedupRepository(str(tmp_path / "repo"), chunk_size=CHUNK)
+    yield repository
+    repository.close()
+
+
+def test_store_and_restore(tmp_path, repository):
+    source = tmp_path / "a.bak"
+    source.write_bytes(os.urandom(300_000))
+    stored = repository.store(str(source), "a")
+    assert stored.size == 300_000
+    assert repository.restore("a", str(tmp_path / "out.bak"))
+    assert (tmp_path / "out.bak").read_bytes() == source.read_bytes()
+
+
+def test_repeated_fulls_deduplicate(tmp_path, repository):
+    base = random.Random(0).randbytes(1024 * 1024)
+    paths = []
+    for night in range(5):
+        path = tmp_path / f"night{night}.bak"
+        path.write_bytes(nightly_full(night, base))
+        stored = repository.store(str(path), path.name)
+        paths.append(path)
+        if night:
+            # Most chunks are found again despite the shifted contents
+            assert stored.new_bytes < stored.size / 3
+    stats = repository.stats()
+    assert stats["files"] == 5
+    assert stats["ratio"] > 2.5
+    for path in paths:
+        repository.restore(path.name, str(tmp_path / "out.bak"))
+        assert (tmp_path / "out.bak").read_bytes() == path.read_bytes()
+
+
+def test_garbage_collection_keeps_live_files(tmp_path, repository):
+    files = {}
+    for name in ("old", "new"):
+        path = tmp_path / f"{name}.bak"
+        path.write_bytes(os.urandom(400_000))
+        repository.store(str(path), name)
+        files[name] = path.read_bytes()
+    before = repository.stats()["stored_bytes"]
+
+    assert repository.remove("old")
+    assert repository.collect_garbage(min_garbage_ratio=0.1) > 0
+    assert repository.stats()["stored_bytes"] < before
+    assert list(repository.files()) == ["new"]
+    repository.restore("new", str(tmp_path / "out.bak"))
+    assert (tmp_path / "out.bak").read_bytes() == files["new"]
+
+
+def test_pointer_rehydrates(tmp_path, repository):
+    source = tmp_path / "Sales_20240101_000000.bak"
+    data = os.urandom(100_000)
+    source.write_bytes(data)
+    stored = repository.store(str(source))
+    pointer = write_pointer(str(source), repository, stored)
+    assert pointer == pointer_path(str(source))
+    assert read_pointer(pointer)["sha256"] == stored.sha256
+    source.unlink()
+    assert open(rehydrate(pointer), 'rb').read() == data
+
+
+def test_backup_through_dedup_stage(tmp_path, make_service, fake_servers):
+    fake_servers.add_server("sql0", time_scale=0.01)
+    service = make_service({"server": "sql0", "databases": ["Sales"],
+                            "backup_path": str(tmp_path / "bk"),
+                            "dedup_repository": str(tmp_path / "repo"),
+                            "retention": {"keep_last": 1}})
+    result, = service.backup()
+    assert result.ok
+    assert result.backup_file.endswith(".dedup")
+    assert [r.paths for r in service.history()] == [result.backup_files]
+    assert service.dedup_stats()["files"] == 1
+
+
+def test_room_made_for_the_whole_backup_not_its_pointer(tmp_path, make_service, fake_servers):
+    fake_servers.add_server("sql0", time_scale=0.01, write_bytes=256 * 1024)
+    service = make_service({"server": "sql0", "databases": ["Sales"],
+                            "backup_path": str(tmp_path / "bk"),
+                            "dedup_repository": str(tmp_path / "repo")})
+    result, = service.backup()
+    assert result.backup_file.endswith(".dedup")
+    record, = service.history()
+    assert record.size == os.path.getsize(result.backup_file) < 1024
+
+    engine = BackupEngine(catalog=service.catalog)
+    job, = jobs_from_config(service.config)
+    assert engine._expected_size(job, "full", 1000) == 256 * 1024
+
+
+def store_files(path, sources):
+    repository = DedupRepository(path, chunk_size=CHUNK)
+    try:
+        for source in sources:
+            repository.store(source, os.path.basename(source))
+    finally:
+        repository.close()
+
+
+def test_processes_share_a_repository(tmp_path):
+    path = str(tmp_path / "repo")
+    sources = []
+    for number in range(8):
+        source = tmp_path / f"{number}.bak"
+        source.write_bytes(os.urandom(200_000) + bytes(50_000))
+        sources.append(str(source))
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=store_files, args=(path, sources[n::2])) for n in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    repository = DedupRepository(path, chunk_size=CHUNK)
+    try:
+        assert len(repository.files()) == 8
+        for source in sources:
+            repository.restore(os.path.basename(source), str(tmp_path / "out.bak"))
+            assert open(str(tmp_path / "out.bak"), 'rb').read() == open(source, 'rb').read()
+    finally:
+        repository.close()
+
+
+def test_garbage_collection_skipped_while_another_process_reads(tmp_path, repository):
+    source = tmp_path / "a.bak"
+    source.write_bytes(os.urandom(200_000))
+    repository.store(str(source), "a")
+    repository.remove("a")
+    other = DedupRepository(repository.path, chunk_size=CHUNK)
+    try:
+        # Stands in for a second process: its own lock file descriptor
+        with other._using():
+            assert repository.collect_garbage(min_garbage_ratio=0.0) == 0
+        assert repository.collect_garbage(min_garbage_ratio=0.0) > 0
+    finally:
+        other.close()
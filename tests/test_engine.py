@@ -0,0 +1,174 @@
+import os
+import threading
+import time
+
+from backup_engine import BackupEngine, BackupJob, JobResult, jobs_from_config
+from catalog import Catalog
+from connections import ConnectionManager
+from retention import RetentionPolicy
+
+import pytest
+
+
+class ConcurrencyProbe:
+    """A stage recording how many jobs per server run at the same time"""
+
+    name = "probe"
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.running = {}
+        self.peak = {}
+
+    def run(self, job, result):
+        with self.lock:
+            self.running[job.server] = self.running.get(job.server, 0) + 1
+            self.peak[job.server] = max(self.peak.get(job.server, 0), self.running[job.server])
+        time.sleep(self.delay)
+        with self.lock:
+            self.running[job.server] -= 1
+
+
+class FailingStage:
+    def __init__(self, name, optional):
+        self.name = name
+        self.optional = optional
+
+    def run(self, job, result):
+        raise OSError("target unreachable")
+
+
+def make_jobs(tmp_path, servers, databases, **settings):
+    return [BackupJob(f"sql{s}", f"db{d}", str(tmp_path / f"sql{s}"), **settings)
+            for s in range(servers) for d in range(databases)]
+
+
+def test_limits_per_server(tmp_path, fake_servers):
+    for s in range(2):
+        fake_servers.add_server(f"sql{s}", time_scale=0.01)
+    probe = ConcurrencyProbe()
+    engine = BackupEngine(max_workers=6, max_jobs_per_server=2, max_jobs_per_volume=6,
+                          server_limits={"sql1": 1}, stages=[probe])
+    results = engine.run(make_jobs(tmp_path, 2, 5))
+    assert all(r.ok for r in results)
+    assert probe.peak["sql0"] == 2
+    assert probe.peak["sql1"] == 1
+
+
+def test_results_keep_submission_order(tmp_path, fake_servers):
+    fake_servers.add_server("sql0", time_scale=0.01)
+    jobs = make_jobs(tmp_path, 1, 4)
+    results = BackupEngine(max_workers=4, max_jobs_per_server=4).run(jobs)
+    assert [r.job for r in results] == jobs
+    assert all(os.path.exists(r.backup_file) for r in results)
+
+
+def test_cancel_kills_running_backups(tmp_path, fake_servers):
+    server = fake_servers.add_server("sql0", time_scale=0.01)
+    server.hang_databases.add("db0")
+    engine = BackupEngine(max_workers=1, max_jobs_per_server=1,
+                          on_progress=lambda job, progress: None)
+    results = []
+    runner = threading.Thread(target=lambda: results.extend(engine.run(make_jobs(tmp_path, 1, 3))))
+    runner.start()
+    # Cancelled while the BACKUP of db0 is in flight
+    assert server.hanging.wait(5)
+    engine.cancel()
+    runner.join(10)
+    assert not runner.is_alive()
+    assert [r.status for r in results] == [JobResult.CANCELLED] * 3
+    # The stripes of the killed BACKUP are removed
+    assert not any(os.path.exists(p) for r in results for p in r.backup_files)
+
+
+def test_watchdog_aborts_overdue_backup(tmp_path, fake_servers):
+    server = fake_servers.add_server("sql0", time_scale=0.01)
+    server.hang_databases.add("db0")
+    engine = BackupEngine(watchdog_interval=0.05)
+    jobs = make_jobs(tmp_path, 1, 2, max_duration=0.3)
+    began = time.monotonic()
+    hung, healthy = engine.run(jobs)
+    assert time.monotonic() - began < 10
+    assert hung.status == JobResult.FAILED
+    assert "exceeded" in hung.error
+    assert healthy.ok
+
+
+def test_log_backup_promoted_without_full(tmp_path, fake_servers):
+    fake_servers.add_server("sql0", time_scale=0.01)
+    catalog = Catalog(str(tmp_path / "catalog.db"))
+    try:
+        engine = BackupEngine(catalog=catalog)
+        job = BackupJob("sql0", "db0", str(tmp_path / "bk"), backup_type="log")
+        first, = engine.run([job])
+        second, = engine.run([job])
+    finally:
+        catalog.close()
+    assert (first.backup_type, second.backup_type) == ("full", "log")
+
+
+def test_required_stage_failure_skips_retention(tmp_path, fake_servers, clock):
+    fake_servers.add_server("sql0", time_scale=0.01)
+    job = BackupJob("sql0", "db0", str(tmp_path / "bk"), retention=RetentionPolicy(keep_last=1))
+    BackupEngine(clock=clock).run([job])
+    result, = BackupEngine(stages=[FailingStage("manifest", optional=False)],
+                           clock=clock).run([job])
+    assert result.status == JobResult.FAILED
+    assert len(os.listdir(tmp_path / "bk")) == 2
+
+
+def test_optional_stage_failure_keeps_backup(tmp_path, fake_servers, clock):
+    fake_servers.add_server("sql0", time_scale=0.01)
+    job = BackupJob("sql0", "db0", str(tmp_path / "bk"), retention=RetentionPolicy(keep_last=1))
+    BackupEngine(clock=clock).run([job])
+    result, = BackupEngine(stages=[FailingStage("offsite copy", optional=True)],
+                           clock=clock).run([job])
+    assert result.ok
+    assert "offsite copy failed" in result.error
+    # Retention still ran
+    assert os.listdir(tmp_path / "bk") == [os.path.basename(result.backup_file)]
+
+
+def test_same_database_on_two_servers_kept_apart(tmp_path, make_service, fake_servers, clock):
+    for name in ("A", "B"):
+        fake_servers.add_server(name, time_scale=0.01)
+    service = make_service({
+        "databases": [{"server": "A", "database": "Sales"}, {"server": "B", "database": "Sales"}],
+        "servers": {"A": {"backup_path": str(tmp_path / "a")},
+                    "B": {"backup_path": str(tmp_path / "b")}},
+        "retention": {"keep_last": 1},
+    }, clock=clock)
+    for _ in range(2):
+        assert all(r.ok for r in service.backup())
+    assert sorted(record.server for record in service.history()) == ["A", "B"]
+    assert len(os.listdir(tmp_path / "a")) == len(os.listdir(tmp_path / "b"))
+
+
+def test_shared_directory_across_servers_refused(tmp_path):
+    config = {"databases": [{"server": "A", "database": "Sales"},
+                            {"server": "B", "database": "Sales"}],
+              "backup_path": str(tmp_path)}
+    with pytest.raises(ValueError, match="both back up to"):
+        jobs_from_config(config)
+
+
+def test_driver_loaded_on_first_connection(monkeypatch):
+    monkeypatch.delenv("DB_BACKUP_DRIVER")
+    connections = ConnectionManager(driver="no_such_driver_module")
+    job = BackupJob("sql0", "db0", "")
+    with pytest.raises(ImportError):
+        connections.acquire(job)
+
+
+def test_server_info_cached(fake_servers):
+    fake_servers.add_server("sql0").add_database("db0")
+    connections = ConnectionManager(server_info_ttl=60)
+    job = BackupJob("sql0", "db0", "")
+    try:
+        info = connections.server_info(job)
+        assert info.has_database("db0")
+        assert connections.server_info(job) is info
+        assert connections.server_info(job, refresh=True) is not info
+    finally:
+        connections.close()
@@ -0,0 +1,49 @@
+import os
+from types import SimpleNamespace
+
+from manifest import (ManifestError, ManifestStage, build_manifest, check_unchanged, read_manifest,
+                      set_digest)
+
+import pytest
+
+
+@pytest.fixture
+def stripes(tmp_path):
+    paths = []
+    for n in (1, 2):
+        path = tmp_path / f"Sales_20240101_000000_{n}of2.bak"
+        path.write_bytes(os.urandom(50_000))
+        paths.append(str(path))
+    return paths
+
+
+def test_unchanged_set_passes(stripes):
+    manifest = build_manifest(stripes)
+    check_unchanged(manifest)
+    assert [entry["size"] for entry in manifest["files"]] == [50_000, 50_000]
+
+
+@pytest.mark.parametrize("change, message", [
+    (lambda path: os.remove(path), "missing"),
+    (lambda path: open(path, 'ab').write(b"x"), "changed"),
+    (lambda path: os.utime(path, (1, 1)), "changed"),
+])
+def test_changed_stripe_refused(stripes, change, message):
+    manifest = build_manifest(stripes)
+    change(stripes[1])
+    with pytest.raises(ManifestError, match=message):
+        check_unchanged(manifest)
+    # Only the files asked about are checked
+    check_unchanged(manifest, [stripes[0]])
+
+
+def test_stage_writes_manifest_and_checksum(stripes):
+    result = SimpleNamespace(backup_files=stripes, backup_type="full", catalog_id=None,
+                             manifest=None, checksum=None)
+    job = SimpleNamespace(name="sql0/Sales", server="sql0", database="Sales")
+    ManifestStage(workers=2).run(job, result)
+    manifest = read_manifest(result.manifest)
+    assert result.manifest.endswith("Sales_20240101_000000.bak.manifest.json")
+    assert result.checksum == set_digest(manifest["files"])
+    assert (manifest["database"], manifest["backup_type"]) == ("Sales", "full")
+    check_unchanged(manifest)
@@ -0,0 +1,69 @@
+import datetime
+import json
+from types import SimpleNamespace
+
+from metrics import JobMetrics, MetricsHistory, Phase, json_summary, prometheus_text
+
+import pytest
+
+START = datetime.datetime(2024, 3, 5, 23, 0)
+
+
+@pytest.fixture
+def history():
+    history = MetricsHistory(":memory:")
+    yield history
+    history.close()
+
+
+def record(history, database, status="succeeded", error=None, day=0):
+    metrics = JobMetrics()
+    started = START + datetime.timedelta(days=day)
+    metrics.phases = [Phase("connect", started, 0.5), Phase("backup", started, 60.0, bytes=6000)]
+    job = SimpleNamespace(server="sql0", database=database)
+    history.record(SimpleNamespace(job=job, backup_type="full", status=status, error=error,
+                                   metrics=metrics, started=started, duration=61.0))
+
+
+def test_prometheus_text(history):
+    record(history, "Sales", status="failed", error="disk full")
+    record(history, "Sales", day=1)
+    record(history, 'We"ird', status="failed", error="disk full")
+    text = prometheus_text(history.latest())
+    lines = text.splitlines()
+    assert "# TYPE db_backup_last_run_success gauge" in lines
+    sales = 'server="sql0",database="Sales",backup_type="full"'
+    assert f"db_backup_last_run_success{{{sales}}} 1" in lines
+    assert 'db_backup_last_run_success{server="sql0",database="We\\"ird",backup_type="full"} 0' \
+        in lines
+    timestamp = (START + datetime.timedelta(days=1)).timestamp()
+    assert f"db_backup_last_run_timestamp_seconds{{{sales}}} {timestamp}" in lines
+    assert f'db_backup_phase_bytes{{{sales},phase="backup"}} 6000' in lines
+    assert not any(line.startswith("db_backup_phase_bytes") and 'phase="connect"' in line
+                   for line in lines)
+    assert text.endswith("\n")
+
+
+def test_json_summary(history):
+    record(history, "Sales")
+    record(history, "Stock", status="failed", error="disk full")
+    summary = json.loads(json_summary(history.latest()))
+    jobs = {job["database"]: job for job in summary["jobs"]}
+    assert jobs["Stock"]["error"] == "disk full"
+    assert jobs["Sales"]["bytes"] == 6000
+    assert jobs["Sales"]["started"] == START.isoformat()
+    backup = jobs["Sales"]["phases"][1]
+    assert (backup["phase"], backup["duration"], backup["bytes_per_second"]) == ("backup", 60.0,
+                                                                                 100.0)
+
+
+def test_runs_filtered(history):
+    for day in range(3):
+        record(history, "Sales", day=day)
+    record(history, "Sales", status="failed", day=3)
+    since = START + datetime.timedelta(days=1)
+    assert len(history.runs(database="Sales", since=since)) == 3
+    assert [run.status for run in history.runs(status="failed")] == ["failed"]
+    assert [run.started.day for run in history.runs(status="succeeded", last=2)] == [6, 7]
+    history.forget_before(since)
+    assert len(history.runs()) == 3
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+
+from manifest import ManifestError, build_manifest, manifest_path, write_manifest
+from offsite import PART_INFO_SUFFIX, PART_SUFFIX, CopyError, OffsiteCopier, copy_file
+
+import pytest
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "src" / "Sales_20240101_000000.bak"
+    path.parent.mkdir()
+    path.write_bytes(os.urandom(300_000))
+    return str(path)
+
+
+def signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def test_partial_copy_resumed(tmp_path, source):
+    destination = str(tmp_path / "dst" / "Sales_20240101_000000.bak")
+    os.makedirs(os.path.dirname(destination))
+    with open(source, 'rb') as f, open(destination + PART_SUFFIX, 'wb') as part:
+        part.write(f.read(100_000))
+    with open(destination + PART_INFO_SUFFIX, 'w') as f:
+        json.dump(signature(source), f)
+
+    expected = hashlib.sha256(open(source, 'rb').read()).hexdigest()
+    assert copy_file(source, destination, chunk_size=64 * 1024, expected_sha256=expected) == 200_000
+    assert open(destination, 'rb').read() == open(source, 'rb').read()
+    assert not os.path.exists(destination + PART_SUFFIX)
+    assert not os.path.exists(destination + PART_INFO_SUFFIX)
+    # Finished copies are skipped
+    assert copy_file(source, destination) == 0
+
+
+def test_partial_copy_of_changed_source_restarts(tmp_path, source):
+    destination = str(tmp_path / "dst" / "Sales_20240101_000000.bak")
+    os.makedirs(os.path.dirname(destination))
+    (tmp_path / "dst" / ("Sales_20240101_000000.bak" + PART_SUFFIX)).write_bytes(b"stale" * 100)
+    with open(destination + PART_INFO_SUFFIX, 'w') as f:
+        json.dump({"size": 1, "mtime": 0}, f)
+    assert copy_file(source, destination) == 300_000
+    assert open(destination, 'rb').read() == open(source, 'rb').read()
+
+
+def test_stale_destination_of_same_size_replaced(tmp_path, source):
+    destination = str(tmp_path / "dst.bak")
+    copy_file(source, destination)
+    with open(destination, 'r+b') as f:
+        f.write(b"corrupt")
+    os.utime(destination, (1, 1))
+    assert copy_file(source, destination) == 300_000
+    assert open(destination, 'rb').read() == open(source, 'rb').read()
+
+
+def test_digest_mismatch_rejected(tmp_path, source):
+    destination = str(tmp_path / "dst.bak")
+    with pytest.raises(CopyError):
+        copy_file(source, destination, expected_sha256="0" * 64)
+    assert not os.path.exists(destination)
+    assert not os.path.exists(destination + PART_SUFFIX)
+
+
+def test_copy_set_to_every_target(tmp_path, source):
+    write_manifest(build_manifest([source]), manifest_path([source]))
+    targets = [str(tmp_path / "t1"), str(tmp_path / "t2")]
+    copier = OffsiteCopier(targets, bandwidth_limit=10 * 1024 * 1024)
+    assert copier.copy_set([source]) == 600_000
+    for target in targets:
+        assert sorted(os.listdir(target)) == ["Sales_20240101_000000.bak",
+                                              "Sales_20240101_000000.bak.manifest.json"]
+    assert copier.copy_set([source]) == 0
+
+
+def test_sets_of_one_second_get_their_own_manifests(tmp_path):
+    paths = {extension: str(tmp_path / f"Sales_20240101_000000{extension}")
+             for extension in (".dif", ".trn")}
+    assert manifest_path([paths[".dif"]]) != manifest_path([paths[".trn"]])
+    assert manifest_path([paths[".dif"] + ".gz"]) == manifest_path([paths[".dif"]])
+    striped = str(tmp_path / "Sales_20240101_000000_2of2.trn.dedup")
+    assert manifest_path([striped]) == manifest_path([paths[".trn"]])
+
+
+def test_set_changed_since_manifest_refused(tmp_path, source):
+    write_manifest(build_manifest([source]), manifest_path([source]))
+    with open(source, 'r+b') as f:
+        f.write(b"tampered")
+    with pytest.raises(ManifestError):
+        OffsiteCopier([str(tmp_path / "t1")]).copy_set([source])
+
+
+def test_copy_command_catches_up_after_failure(tmp_path, make_service, fake_servers):
+    fake_servers.add_server("sql0", time_scale=0.01)
+    blocked = tmp_path / "offsite"
+    blocked.write_text("a file where the target directory should be")
+    service = make_service({"server": "sql0", "databases": ["Sales"],
+                            "backup_path": str(tmp_path / "bk"),
+                            "offsite_targets": [str(blocked / "copies")],
+                            "dedup_repository": str(tmp_path / "repo")})
+    result, = service.backup()
+    assert result.ok
+    assert "offsite copy failed" in result.error
+    assert result.backup_file.endswith(".dedup")
+
+    blocked.unlink()
+    assert service.copy_offsite() == 0
+    stripe = os.path.basename(result.backup_file)[:-len(".dedup")]
+    assert stripe in os.listdir(blocked / "copies")
+    # Rehydrated only for the copy
+    assert stripe not in os.listdir(tmp_path / "bk")
@@ -0,0 +1,71 @@
+import datetime
+from types import SimpleNamespace
+
+from backup_engine import BackupJob
+from metrics import JobMetrics, MetricsHistory
+from planner import Estimate, plan_jobs
+
+START = datetime.datetime(2024, 3, 5, 23, 0)
+
+
+def record(history, server, database, backup_type, seconds, status="succeeded", day=0):
+    metrics = JobMetrics()
+    with metrics.phase("backup") as phase:
+        phase.bytes = 1000
+    job = SimpleNamespace(server=server, database=database)
+    history.record(SimpleNamespace(
+        job=job, backup_type=backup_type, status=status, error=None, metrics=metrics,
+        started=START + datetime.timedelta(days=day), duration=seconds))
+
+
+def test_history_limited_per_job():
+    history = MetricsHistory(":memory:")
+    try:
+        for day in range(6):
+            record(history, "sql0", "Sales", "full", 100 + day, day=day)
+            record(history, "sql0", "Sales", "log", 1, day=day)
+            record(history, "sql1", "Sales", "full", 200 + day, day=day)
+        record(history, "sql0", "Sales", "full", 0, status="failed", day=7)
+
+        runs = history.runs(backup_type="full", status="succeeded", last=2)
+        assert sorted((run.server, run.duration) for run in runs) == [
+            ("sql0", 104), ("sql0", 105), ("sql1", 204), ("sql1", 205)]
+        assert all(run.phase("backup").bytes == 1000 for run in runs)
+        assert len(history.latest()) == 3
+    finally:
+        history.close()
+
+
+def test_plan_respects_server_limits(tmp_path):
+    jobs = [BackupJob("sql0", f"db{n}", str(tmp_path)) for n in range(3)]
+    jobs.append(BackupJob("sql1", "db0", str(tmp_path)))
+    estimates = {"sql0/db0": Estimate(60), "sql0/db1": Estimate(600), "sql0/db2": Estimate(300),
+                 "sql1/db0": Estimate(120)}
+    plan = plan_jobs(jobs, estimates, START, max_workers=4, max_jobs_per_server=1,
+                     max_jobs_per_volume=4)
+    assert [job.name for job in plan.jobs] == ["sql0/db1", "sql0/db2", "sql1/db0", "sql0/db0"]
+    starts = {entry.job.name: (entry.start - START).total_seconds() for entry in plan.entries}
+    assert starts == {"sql0/db1": 0, "sql1/db0": 0, "sql0/db2": 600, "sql0/db0": 900}
+    assert plan.finish == START + datetime.timedelta(seconds=960)
+
+
+def test_late_jobs_reported(tmp_path):
+    jobs = [BackupJob("sql0", f"db{n}", str(tmp_path), window="23:00-23:30") for n in range(2)]
+    estimates = {job.name: Estimate(20 * 60, source="history") for job in jobs}
+    plan = plan_jobs(jobs, estimates, START, max_workers=1)
+    assert [entry.job.name for entry in plan.late] == [jobs[1].name]
+    assert plan.overrun == 10 * 60
+    assert "past the maintenance window" in plan.warning()
+
+
+def test_log_batches_not_planned(tmp_path, make_service, fake_servers, monkeypatch):
+    fake_servers.add_server("sql0", time_scale=0.01)
+    service = make_service({"server": "sql0", "databases": ["Sales"],
+                            "backup_path": str(tmp_path / "bk"),
+                            "maintenance_window": "00:00-23:59"})
+    planned = []
+    monkeypatch.setattr(service, "plan", lambda **kwargs: planned.append(kwargs) or
+                        SimpleNamespace(warning=lambda: None, jobs=kwargs["jobs"]))
+    assert all(r.ok for r in service.backup("full"))
+    assert all(r.ok for r in service.backup("log"))
+    assert len(planned) == 1
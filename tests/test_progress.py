@@ -0,0 +1,73 @@
+import datetime
+
+from progress import ProgressTracker, follow_backup
+
+
+class Clock:
+    def __init__(self):
+        self.now = datetime.datetime(2024, 3, 5, 23, 0)
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += datetime.timedelta(seconds=seconds)
+
+
+class StatsCursor:
+    """Hands out one batch of STATS messages per result set"""
+
+    def __init__(self, clock, batches):
+        self.clock = clock
+        self.batches = list(batches)
+        self.messages = self.batches.pop(0)
+
+    def nextset(self):
+        if not self.batches:
+            return False
+        self.clock.advance(10)
+        self.messages = self.batches.pop(0)
+        return True
+
+
+def test_stats_messages_become_reports():
+    clock = Clock()
+    reports = []
+    tracker = ProgressTracker("sql0/Sales", total_bytes=1000, on_progress=reports.append,
+                              clock=clock)
+    cursor = StatsCursor(clock, [
+        [("[01000] (3211)", "10 percent processed.")],
+        [("[01000] (3211)", "20 percent processed."), ("[01000] (3211)", "Noise")],
+        [("[01000] (3211)", "100 percent processed."),
+         ("[01000] (3014)", "BACKUP DATABASE successfully processed 250 pages in 20.5 seconds "
+                            "(0.1 MB/sec).")],
+    ])
+    follow_backup(cursor, tracker)
+
+    assert [report.percent for report in reports] == [10, 20, 100, 100]
+    second = reports[1]
+    assert (second.bytes_done, second.elapsed, second.bytes_per_second) == (200, 10, 20)
+    assert second.eta == 40
+    assert second.describe() == "20% in 10s, 20.0 B/s, ETA 40s"
+    # The server's page count replaces the estimate
+    final = reports[-1]
+    assert final.finished and final.eta == 0
+    assert final.total_bytes == final.bytes_done == 250 * 8192
+
+
+def test_unknown_size_reports_percent_only():
+    clock = Clock()
+    tracker = ProgressTracker("sql0/Sales", clock=clock)
+    clock.advance(30)
+    tracker.feed(["50 percent processed."])
+    report = tracker.last_report
+    assert (report.bytes_done, report.bytes_per_second, report.eta) == (None, None, 30)
+    assert report.as_dict()["percent"] == 50
+
+
+def test_cancel_checked_between_result_sets():
+    clock = Clock()
+    cursor = StatsCursor(clock, [["10 percent processed."], ["20 percent processed."]])
+    calls = []
+    follow_backup(cursor, check_cancel=lambda: calls.append(clock()))
+    assert len(calls) == 2
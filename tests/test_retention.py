@@ -0,0 +1,106 @@
+import datetime
+import os
+from types import SimpleNamespace
+
+from catalog import Catalog
+from retention import (BackupSet, RetentionPolicy, plan_retention, prune_backups,
+                       scan_backup_sets, split_chains)
+
+START = datetime.datetime(2024, 1, 1)
+
+
+def backup_set(taken, backup_type="full", size=100):
+    extension = {"full": "bak", "diff": "dif", "log": "trn"}[backup_type]
+    key = f"Sales_{taken:%Y%m%d_%H%M%S}"
+    return BackupSet(key, backup_type, [f"{key}.{extension}"], taken,
+                     record=SimpleNamespace(size=size, is_verified=False))
+
+
+def nightly_chains(days, logs_per_day=2):
+    sets = []
+    for day in range(days):
+        night = START + datetime.timedelta(days=day)
+        sets.append(backup_set(night))
+        for hour in range(1, logs_per_day + 1):
+            sets.append(backup_set(night + datetime.timedelta(hours=hour), "log"))
+    return sets
+
+
+def deleted(plan):
+    return {s.key for s in plan.sets}
+
+
+def test_split_chains_orphans_precede_first_full():
+    orphan = backup_set(START - datetime.timedelta(hours=1), "log")
+    sets = [orphan] + nightly_chains(2)
+    chains, orphans = split_chains(sets)
+    assert orphans == [orphan]
+    assert [len(chain) for chain in chains] == [3, 3]
+
+
+def test_keep_last_removes_whole_chains():
+    sets = nightly_chains(5)
+    plan = plan_retention(sets, RetentionPolicy(keep_last=2))
+    kept = [s for s in sets if s.key not in deleted(plan)]
+    assert kept == sets[-6:]
+
+
+def test_dependents_never_outlive_their_full():
+    sets = nightly_chains(10)
+    plan = plan_retention(sets, RetentionPolicy(keep_last=1, keep_daily=5))
+    kept = [s for s in sets if s.key not in deleted(plan)]
+    chains, orphans = split_chains(kept)
+    assert not orphans
+    # Only the newest chain keeps its logs; four more days keep just the full
+    assert [len(chain) for chain in chains] == [1, 1, 1, 1, 3]
+
+
+def test_gfs_keeps_newest_full_per_period():
+    sets = [backup_set(START + datetime.timedelta(days=day)) for day in range(120)]
+    plan = plan_retention(sets, RetentionPolicy(keep_last=1, keep_daily=3, keep_weekly=2,
+                                                keep_monthly=3))
+    kept = sorted(s.taken for s in sets if s.key not in deleted(plan))
+    last = sets[-1].taken
+    assert last in kept
+    # Three days, of which the Sunday also ends the previous week, and the
+    # ends of the two months before
+    assert [t.date() for t in kept] == [
+        datetime.date(2024, 2, 29), datetime.date(2024, 3, 31),
+        datetime.date(2024, 4, 27), datetime.date(2024, 4, 28), datetime.date(2024, 4, 29)]
+
+
+def test_size_limit_keeps_newest_chain():
+    sets = nightly_chains(5, logs_per_day=0)
+    plan = plan_retention(sets, RetentionPolicy(keep_last=5, max_total_bytes=250))
+    assert [s for s in sets if s.key not in deleted(plan)] == sets[-2:]
+    plan = plan_retention(sets, RetentionPolicy(keep_last=5, max_total_bytes=1))
+    assert [s for s in sets if s.key not in deleted(plan)] == sets[-1:]
+
+
+def test_prune_from_directory_and_catalog(tmp_path):
+    for day in range(4):
+        night = START + datetime.timedelta(days=day)
+        for name in (f"Sales_{night:%Y%m%d_%H%M%S}.bak",
+                     f"Sales_{night + datetime.timedelta(hours=1):%Y%m%d_%H%M%S}.trn",
+                     f"SalesArchive_{night:%Y%m%d_%H%M%S}.bak"):
+            (tmp_path / name).write_bytes(b"x")
+    assert len(scan_backup_sets([str(tmp_path)], "Sales")) == 8
+
+    plan = prune_backups(str(tmp_path), "Sales", RetentionPolicy(keep_last=3), dry_run=True)
+    assert len(plan.sets) == 2
+    assert len(os.listdir(tmp_path)) == 12
+
+    catalog = Catalog(str(tmp_path / "catalog.db"))
+    try:
+        catalog.reconcile([str(tmp_path)], "Sales", "sql0")
+        prune_backups(str(tmp_path), "Sales", RetentionPolicy(keep_last=3), catalog,
+                      server="sql0")
+        assert len(catalog.backups(database="Sales")) == 6
+        # Another server's catalogue entries for the same name are not its to prune
+        assert prune_backups(str(tmp_path), "Sales", RetentionPolicy(keep_last=1), catalog,
+                             server="sql1").sets == []
+    finally:
+        catalog.close()
+    names = os.listdir(tmp_path)
+    assert sum(n.startswith("Sales_") for n in names) == 6
+    assert sum(n.startswith("SalesArchive_") for n in names) == 4
@@ -0,0 +1,109 @@
+import datetime
+import json
+import threading
+
+from scheduler import CronExpression, DailyWindow, Scheduler
+
+import pytest
+
+NOW = datetime.datetime(2024, 3, 5, 23, 30)
+
+
+def write_state(path, **last_runs):
+    path.write_text(json.dumps({name: moment.isoformat() for name, moment in last_runs.items()}))
+
+
+def test_missed_run_caught_up_once(tmp_path):
+    state = tmp_path / "state.json"
+    write_state(state, nightly=NOW.replace(hour=23, minute=0) - datetime.timedelta(days=1))
+    scheduler = Scheduler(state_file=str(state), clock=lambda: NOW)
+    job = scheduler.add_job("nightly", "daily 23:00", lambda: None)
+    assert job.next_run == NOW
+
+    ran = threading.Event()
+    job.func = ran.set
+    scheduler.start()
+    try:
+        assert ran.wait(5)
+    finally:
+        scheduler.stop()
+    assert job.next_run == datetime.datetime(2024, 3, 6, 23, 0)
+    assert json.loads(state.read_text())["nightly"] == NOW.isoformat()
+
+
+def test_no_catch_up_without_missed_run(tmp_path):
+    state = tmp_path / "state.json"
+    write_state(state, nightly=NOW.replace(hour=23, minute=0))
+    scheduler = Scheduler(state_file=str(state), clock=lambda: NOW)
+    job = scheduler.add_job("nightly", "daily 23:00", lambda: None)
+    assert job.next_run == datetime.datetime(2024, 3, 6, 23, 0)
+
+
+def test_catch_up_disabled(tmp_path):
+    state = tmp_path / "state.json"
+    write_state(state, nightly=NOW - datetime.timedelta(days=3))
+    scheduler = Scheduler(state_file=str(state), clock=lambda: NOW)
+    job = scheduler.add_job("nightly", "daily 23:00", lambda: None, catch_up=False)
+    assert job.next_run == datetime.datetime(2024, 3, 6, 23, 0)
+
+
+@pytest.mark.parametrize("spec, after, expected", [
+    ("every 15 minutes", NOW, datetime.datetime(2024, 3, 5, 23, 45)),
+    ("every 6 hours", NOW, datetime.datetime(2024, 3, 6, 0, 0)),
+    ("sunday 23:00", NOW, datetime.datetime(2024, 3, 10, 23, 0)),
+    ("0 2 1 * *", NOW, datetime.datetime(2024, 4, 1, 2, 0)),
+    ("0 0 29 2 *", NOW, datetime.datetime(2028, 2, 29, 0, 0)),
+])
+def test_next_after(spec, after, expected):
+    assert CronExpression(spec).next_after(after) == expected
+
+
+@pytest.mark.parametrize("spec", ["every 45 minutes", "every 5 hours", "every 0 minutes",
+                                  "* * *", "61 * * * *"])
+def test_invalid_schedules(spec):
+    with pytest.raises(ValueError):
+        CronExpression(spec)
+
+
+def test_window_past_midnight():
+    window = DailyWindow("22:00-04:00")
+    assert window.length == datetime.timedelta(hours=6)
+    assert NOW in window
+    start, end = window.occurrence(datetime.datetime(2024, 3, 6, 3, 0))
+    assert (start, end) == (datetime.datetime(2024, 3, 5, 22, 0), datetime.datetime(2024, 3, 6, 4, 0))
+    start, _ = window.occurrence(datetime.datetime(2024, 3, 6, 12, 0))
+    assert start == datetime.datetime(2024, 3, 6, 22, 0)
+
+
+def test_diff_skipped_while_full_running(tmp_path, make_service, fake_servers):
+    fake_servers.add_server("sql0", time_scale=0.01)
+    service = make_service({"server": "sql0", "databases": ["Sales"],
+                            "backup_path": str(tmp_path / "bk")})
+    diffs = []
+
+    def start_diff(job, report):
+        if not diffs:
+            diffs.append(service.backup("diff"))
+
+    service.on_progress = start_diff
+    result, = service.backup("full")
+    assert result.ok
+    assert diffs == [[]]
+    # Released once the full is over
+    assert [r.backup_type for r in service.backup("diff")] == ["diff"]
+
+
+@pytest.mark.parametrize("now, expected", [
+    (datetime.datetime(2024, 3, 10, 23, 0, 5), [("diff", ["Stock"])]),
+    (datetime.datetime(2024, 3, 11, 23, 0, 5), [("diff", ["Sales", "Stock"])]),
+])
+def test_diff_left_out_when_full_due(make_service, now, expected):
+    service = make_service({"server": "sql0", "backup_path": "bk",
+                            "schedule": {"full": "sunday 23:00", "diff": "daily 23:00"},
+                            "databases": ["Sales", {"database": "Stock", "schedule": {
+                                "full": "1 23 * * *", "diff": "daily 23:00"}}]},
+                           clock=lambda: now)
+    runs = []
+    service.backup = lambda backup_type, databases: runs.append((backup_type, databases))
+    service._scheduled_backup("diff", ["Sales", "Stock"])
+    assert runs == expected
@@ -0,0 +1,102 @@
+import datetime
+import os
+
+from backup_engine import BackupJob
+from catalog import VERIFY_FAILED, VERIFY_PASSED, VERIFY_QUEUED, Catalog
+from connections import ConnectionManager
+from verify import Verifier
+
+import pytest
+
+STARTED = datetime.datetime(2024, 3, 5, 23, 0)
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = Catalog(str(tmp_path / "catalog.db"))
+    yield catalog
+    catalog.close()
+
+
+@pytest.fixture
+def connections():
+    connections = ConnectionManager(driver="fake")
+    yield connections
+    connections.close()
+
+
+def queue(catalog, tmp_path, name, backup_type="full"):
+    path = tmp_path / name
+    path.write_bytes(b"backup" * 100)
+    backup_id = catalog.record_backup("sql0", "Sales", backup_type, [str(path)], STARTED)
+    catalog.update(backup_id, verify_status=VERIFY_QUEUED)
+    return backup_id
+
+
+def target(record):
+    return BackupJob("verify0", record.database, "")
+
+
+def test_corrupt_backup_fails_verification(tmp_path, catalog, connections, fake_servers):
+    server = fake_servers.add_server("verify0", time_scale=0)
+    good = queue(catalog, tmp_path, "Sales_20240305_230000.bak")
+    bad = queue(catalog, tmp_path, "Sales_20240306_230000.bak")
+    server.corrupt_files.add(str(tmp_path / "Sales_20240306_230000.bak"))
+
+    outcomes = Verifier(catalog, connections, target).run()
+    assert outcomes == {good: VERIFY_PASSED, bad: VERIFY_FAILED}
+    assert "incorrectly formed" in catalog.get(bad).verify_error
+    assert catalog.queued_for_verification() == []
+
+
+def test_restore_mode_drops_scratch_database(tmp_path, catalog, connections, fake_servers):
+    server = fake_servers.add_server("verify0", time_scale=0)
+    full = queue(catalog, tmp_path, "Sales_20240305_230000.bak")
+    log = queue(catalog, tmp_path, "Sales_20240305_231500.trn", "log")
+    outcomes = Verifier(catalog, connections, target, mode="restore").run()
+    assert outcomes == {full: VERIFY_PASSED, log: VERIFY_PASSED}
+    assert not any(name.startswith("verify_") for name in server.databases)
+
+
+def test_paths_mapped_for_the_verifying_server(tmp_path, catalog, connections):
+    verifier = Verifier(catalog, connections, target, path_map={"D:\\Backups": "\\\\nas\\b"})
+    assert verifier.server_path("d:\\backups\\Sales.bak") == "\\\\nas\\b\\Sales.bak"
+    assert verifier.server_path("E:\\Sales.bak") == "E:\\Sales.bak"
+
+
+def test_nothing_started_outside_window(tmp_path, catalog, connections):
+    queue(catalog, tmp_path, "Sales_20240305_230000.bak")
+    verifier = Verifier(catalog, connections, target, window="01:00-05:00",
+                        clock=lambda: datetime.datetime(2024, 3, 6, 12, 0))
+    assert verifier.run() == {}
+    assert len(catalog.queued_for_verification()) == 1
+
+
+@pytest.mark.parametrize("packing", ["compress", "dedup"])
+def test_packed_sets_unpacked_for_verification(tmp_path, make_service, fake_servers, packing):
+    fake_servers.add_server("sql0", time_scale=0.01)
+    config = {"server": "sql0", "databases": ["Sales"], "backup_path": str(tmp_path / "bk"),
+              "verify_mode": "verifyonly"}
+    if packing == "compress":
+        config["client_compression"] = "gzip"
+    else:
+        config["dedup_repository"] = str(tmp_path / "repo")
+    service = make_service(config)
+    result, = service.backup()
+    assert result.backup_file.endswith((".gz", ".dedup"))
+    assert service.verify() == {result.catalog_id: VERIFY_PASSED}
+    # Nothing is left of the scratch copy
+    assert not os.path.exists(tmp_path / "bk" / "verify_scratch")
+
+
+def test_damaged_compressed_set_fails(tmp_path, make_service, fake_servers):
+    fake_servers.add_server("sql0", time_scale=0.01)
+    service = make_service({"server": "sql0", "databases": ["Sales"],
+                            "backup_path": str(tmp_path / "bk"),
+                            "client_compression": "gzip", "verify_mode": "verifyonly"})
+    result, = service.backup()
+    with open(result.backup_file, 'r+b') as f:
+        f.seek(100)
+        f.write(b"\0" * 100)
+    assert service.verify() == {result.catalog_id: VERIFY_FAILED}
+    assert not os.path.exists(tmp_path / "bk" / "verify_scratch")